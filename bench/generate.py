@@ -0,0 +1,191 @@
+#!/usr/bin/python
+'''
+Generate synthetic square-note MEI documents, laid out like the
+documents Neon.js edits: a page of systems, each a staff line of
+clefs, neumes, divisions and a custos, with a zone for every element,
+in a single staff described by the score definition.
+
+    python bench/generate.py [options] out.mei
+
+The contents are random but reproducible for a given seed.
+'''
+
+import optparse
+import random
+import uuid
+from xml.sax.saxutils import quoteattr
+
+PNAMES = "cdefgab"
+
+# neume names by number of notes, and their intervals in steps
+NEUMES = {
+    1: [("punctum", ())],
+    2: [("podatus", (1,)), ("clivis", (-1,))],
+    3: [("torculus", (1, -1)), ("porrectus", (-1, 1)), ("scandicus", (1, 1)), ("climacus", (-1, -1))],
+}
+
+# geometry of the page, in pixels
+SYSTEM_WIDTH = 1000
+SYSTEM_HEIGHT = 150
+SYSTEM_SPACING = 250
+MARGIN = 40
+NOTE_WIDTH = 25
+STEP_HEIGHT = 12
+
+class Generator:
+    '''
+    Builds one MEI document as text. Every element gets an id of the
+    form the editor uses, and a zone unless `zoned` (the fraction of
+    elements with a zone) says otherwise.
+    '''
+
+    def __init__(self, systems=10, neumes=40, clefs=1, divisions=2, custodes=1, zoned=1.0, seed=0):
+        self.systems = systems
+        self.neumes = neumes
+        self.clefs = max(1, clefs)
+        self.divisions = divisions
+        self.custodes = custodes
+        self.zoned = zoned
+        self.random = random.Random(seed)
+
+        self.zones = []
+        # zone of each system, by system id
+        self.system_zones = {}
+
+    def generate(self):
+        system_ids = [self.new_id() for i in range(self.systems)]
+        page_id = self.new_id()
+
+        layer = []
+        for i, system_id in enumerate(system_ids):
+            layer.extend(self.system(i, system_id))
+
+        layout = ['<system xml:id="%s" facs="%s"/>' % (system_id, self.system_zones[system_id])
+                  for system_id in system_ids]
+
+        return "\n".join([
+            '<?xml version="1.0" encoding="UTF-8"?>',
+            '<mei xmlns="http://www.music-encoding.org/ns/mei" xml:id="%s" meiversion="2013">' % self.new_id(),
+            '<meiHead xml:id="%s"><fileDesc xml:id="%s"><titleStmt xml:id="%s"><title xml:id="%s"/></titleStmt>'
+            '<pubStmt xml:id="%s"/></fileDesc></meiHead>' % tuple(self.new_id() for i in range(5)),
+            '<music xml:id="%s">' % self.new_id(),
+            '<facsimile xml:id="%s"><surface xml:id="%s"><graphic xml:id="%s"/>' % tuple(self.new_id() for i in range(3)),
+            "\n".join('<zone xml:id="%s" ulx="%d" uly="%d" lrx="%d" lry="%d"/>' % zone for zone in self.zones),
+            '</surface></facsimile>',
+            '<layout xml:id="%s"><page xml:id="%s" n="1">' % (self.new_id(), page_id),
+            "\n".join(layout),
+            '</page></layout>',
+            '<body xml:id="%s"><mdiv xml:id="%s" type="solesmes"><score xml:id="%s">'
+            % tuple(self.new_id() for i in range(3)),
+            # one staff definition per staff, as final divisions keep them matched
+            '<scoreDef xml:id="%s"><staffGrp xml:id="%s"><staffDef xml:id="%s" n="1"/></staffGrp></scoreDef>'
+            % tuple(self.new_id() for i in range(3)),
+            '<section xml:id="%s">' % self.new_id(),
+            '<pb xml:id="%s" epageref="%s"/>' % (self.new_id(), page_id),
+            '<staff xml:id="%s" n="1"><layer xml:id="%s" n="1">' % (self.new_id(), self.new_id()),
+            "\n".join(layer),
+            '</layer></staff></section></score></mdiv></body></music></mei>',
+            ''])
+
+    # HELPER FUNCTIONS
+    def system(self, n, system_id):
+        '''
+        The layer contents of the nth system, starting with its system break.
+        '''
+
+        top = MARGIN + n * SYSTEM_SPACING
+        self.system_zones[system_id] = self.new_id()
+        self.zones.append((self.system_zones[system_id], MARGIN, top, MARGIN + SYSTEM_WIDTH, top + SYSTEM_HEIGHT))
+
+        # lay the elements out from left to right: a clef first, the
+        # other clefs and the divisions spread among the neumes
+        kinds = ["neume"] * self.neumes + ["clef"] * (self.clefs - 1) + ["division"] * self.divisions
+        self.random.shuffle(kinds)
+        kinds = ["clef"] + kinds + ["custos"] * self.custodes
+
+        step = max(1, (SYSTEM_WIDTH - 2 * NOTE_WIDTH) // max(1, len(kinds)))
+        elements = ['<sb xml:id="%s" n="%d" systemref="%s"/>' % (self.new_id(), n + 1, system_id)]
+        # pitch of the melody, in steps above c3
+        pitch = 10
+        for i, kind in enumerate(kinds):
+            x = MARGIN + NOTE_WIDTH + i * step
+            if kind == "clef":
+                line = self.random.choice([2, 3, 4])
+                facs = self.zone(x, top + 20, x + 20, top + 85)
+                elements.append('<clef xml:id="%s" shape="C" line="%d"%s/>' % (self.new_id(), line, facs))
+            elif kind == "division":
+                form = self.random.choice(["small", "minor", "major"])
+                facs = self.zone(x, top + 10, x + 5, top + 60)
+                elements.append('<division xml:id="%s" form="%s"%s/>' % (self.new_id(), form, facs))
+            elif kind == "custos":
+                y = self.pitch_y(top, pitch)
+                facs = self.zone(x, y, x + 15, y + 30)
+                elements.append('<custos xml:id="%s" pname="%s" oct="%d"%s/>' % ((self.new_id(),) + self.pname_oct(pitch) + (facs,)))
+            else:
+                pitch = min(18, max(4, pitch + self.random.randint(-2, 2)))
+                elements.append(self.neume(x, top, pitch))
+
+        return elements
+
+    def neume(self, x, top, pitch):
+        name, intervals = self.random.choice(NEUMES[self.random.choice([1, 1, 1, 2, 2, 3])])
+        pitches = [pitch]
+        for interval in intervals:
+            pitches.append(pitches[-1] + interval)
+
+        ys = [self.pitch_y(top, p) for p in pitches]
+        facs = self.zone(x, min(ys), x + NOTE_WIDTH * len(pitches), max(ys) + 30)
+
+        parts = ['<neume xml:id="%s" name="%s"%s><nc xml:id="%s">' % (self.new_id(), name, facs, self.new_id())]
+        for p in pitches:
+            parts.append('<note xml:id="%s" pname="%s" oct="%d"/>' % ((self.new_id(),) + self.pname_oct(p)))
+        parts.append('</nc></neume>')
+        return "".join(parts)
+
+    def zone(self, ulx, uly, lrx, lry):
+        '''
+        Make a zone with the given box, and return the facs attribute
+        referencing it; an empty string for an element without a zone.
+        '''
+
+        if self.random.random() >= self.zoned:
+            return ""
+        zone_id = self.new_id()
+        self.zones.append((zone_id, ulx, uly, lrx, lry))
+        return ' facs=%s' % quoteattr(zone_id)
+
+    def pitch_y(self, top, pitch):
+        return top + SYSTEM_HEIGHT - pitch * STEP_HEIGHT // 2
+
+    def pname_oct(self, pitch):
+        return PNAMES[pitch % 7], 3 + pitch // 7
+
+    def new_id(self):
+        return "m-" + str(uuid.UUID(int=self.random.getrandbits(128), version=4))
+
+def generate(path, **options):
+    '''
+    Write a synthetic MEI document to path; options are those of Generator.
+    '''
+
+    fp = open(path, "w")
+    try:
+        fp.write(Generator(**options).generate())
+    finally:
+        fp.close()
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [options] out.mei")
+    parser.add_option("--systems", type="int", default=10, help="number of systems")
+    parser.add_option("--neumes", type="int", default=40, help="neumes per system")
+    parser.add_option("--clefs", type="int", default=1, help="clefs per system, at least 1")
+    parser.add_option("--divisions", type="int", default=2, help="divisions per system")
+    parser.add_option("--custodes", type="int", default=1, help="custodes per system")
+    parser.add_option("--zoned", type="float", default=1.0, help="fraction of elements with a zone")
+    parser.add_option("--seed", type="int", default=0, help="random seed")
+    options, paths = parser.parse_args()
+    if len(paths) != 1:
+        parser.error("give one output file")
+
+    generate(paths[0], systems=options.systems, neumes=options.neumes, clefs=options.clefs,
+             divisions=options.divisions, custodes=options.custodes, zoned=options.zoned, seed=options.seed)
@@ -0,0 +1,184 @@
+#!/usr/bin/python
+'''
+Time the ModifyDocument operations on synthetic documents of several
+sizes (see generate.py).
+
+    python bench/operations.py [-n repeat] [-s systems,...] [-o results.json] [operation ...]
+
+Every operation is run `repeat` times on elements picked at random,
+each run reverted before the next, so that all runs see the same
+document. Prints a table and, with -o, writes the results as JSON:
+{"python", "time", "repeat", "results": [{"operation", "systems",
+"elements", "runs", "min_ms", "median_ms", "mean_ms", "max_ms"}, ...]}
+'''
+
+import json
+import optparse
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from neonsrv.modifymei import ModifyDocument, AUTO_PITCH
+
+from generate import generate
+
+def pick(md, name, rng, other_than=None):
+    '''
+    An element of the given name at random, other than the given one.
+    '''
+
+    return rng.choice([e for e in md.get_elements_by_name(name) if e is not other_than])
+
+# Each operation takes the document and a random number generator, and
+# returns the call to time, on elements it picked.
+def insert_punctum(md, rng):
+    before = pick(md, "neume", rng).getId()
+    return lambda: md.insert_punctum("punctum", None, None, before, "c", "4", None, None, "10", "10", "40", "40")
+
+def move_neume(md, rng):
+    neume = pick(md, "neume", rng)
+    # a neume cannot be moved before itself
+    before = pick(md, "neume", rng, neume).getId()
+    pitch_info = [{"pname": "d", "oct": "4"} for note in neume.getDescendantsByName("note")]
+    return lambda: md.move_neume(neume.getId(), before, pitch_info, "10", "10", "40", "40")
+
+def neumify(md, rng):
+    # two neighbouring neumes
+    neumes = md.get_elements_by_name("neume")
+    i = rng.randrange(len(neumes) - 1)
+    ids = [neumes[i].getId(), neumes[i + 1].getId()]
+    notes = len(neumes[i].getDescendantsByName("note")) + len(neumes[i + 1].getDescendantsByName("note"))
+    return lambda: md.neumify(ids, "compound", None, ["punctum"] * notes, "10", "10", "40", "40")
+
+def ungroup(md, rng):
+    neume = rng.choice([n for n in md.get_elements_by_name("neume") if len(n.getDescendantsByName("note")) > 1])
+    bboxes = [[{"ulx": 10, "uly": 10, "lrx": 40, "lry": 40} for note in neume.getDescendantsByName("note")]]
+    return lambda: md.ungroup([neume.getId()], bboxes)
+
+def insert_division(md, rng):
+    before = pick(md, "neume", rng).getId()
+    return lambda: md.insert_division(before, "minor", "10", "10", "15", "40")
+
+def insert_final_division(md, rng):
+    before = pick(md, "neume", rng).getId()
+    return lambda: md.insert_division(before, "final", "10", "10", "15", "40")
+
+def insert_clef(md, rng):
+    before = pick(md, "neume", rng).getId()
+    return lambda: md.insert_clef("2", "C", AUTO_PITCH, before, "10", "10", "30", "70")
+
+def delete_clef(md, rng):
+    clef = pick(md, "clef", rng).getId()
+    return lambda: md.delete_clef([{"id": clef}])
+
+def elements_in_region(md, rng):
+    x = rng.randrange(1000)
+    y = rng.randrange(1000)
+    return lambda: md.elements_in_region(x, y, x + 200, y + 200)
+
+def render_model(md, rng):
+    # a full render, as after a load
+    md.model = None
+    md.rendered = {}
+    return md.render_model
+
+def write_doc(md, rng):
+    return md.write_doc
+
+OPERATIONS = [
+    ("insert_punctum", insert_punctum),
+    ("move_neume", move_neume),
+    ("neumify", neumify),
+    ("ungroup", ungroup),
+    ("insert_division", insert_division),
+    ("insert_division_final", insert_final_division),
+    ("insert_clef", insert_clef),
+    ("delete_clef", delete_clef),
+    ("elements_in_region", elements_in_region),
+    ("render_model", render_model),
+    ("write_doc", write_doc),
+]
+
+def summary(name, systems, elements, times):
+    times = sorted(t * 1000 for t in times)
+    return {
+        "operation": name,
+        "systems": systems,
+        "elements": elements,
+        "runs": len(times),
+        "min_ms": times[0],
+        "median_ms": times[len(times) // 2],
+        "mean_ms": sum(times) / len(times),
+        "max_ms": times[-1],
+    }
+
+def bench(directory, systems, operations, repeat, seed):
+    '''
+    Generate a document of the given number of systems in directory,
+    and time loading it and every one of operations on it.
+    '''
+
+    # the undo history goes next to the document type directory
+    path = os.path.join(directory, "squarenote", "bench-%d.mei" % systems)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    generate(path, systems=systems, clefs=2, seed=seed)
+
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        md = ModifyDocument(path[:-len(".mei")])
+        times.append(time.time() - start)
+    elements = len(md.get_elements_by_name("neume")) + len(md.get_elements_by_name("clef")) + \
+        len(md.get_elements_by_name("division")) + len(md.get_elements_by_name("custos"))
+    results = [summary("load", systems, elements, times)]
+
+    rng = random.Random(seed)
+    for name, operation in operations:
+        times = []
+        for i in range(repeat):
+            call = operation(md, rng)
+            start = time.time()
+            call()
+            times.append(time.time() - start)
+            md.rollback()
+        results.append(summary(name, systems, elements, times))
+
+    return results
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [-n repeat] [-s systems,...] [-o results.json] [operation ...]")
+    parser.add_option("-n", dest="repeat", type="int", default=20, help="runs per operation and size")
+    parser.add_option("-s", dest="sizes", default="1,10,50", help="document sizes, in systems of 40 neumes")
+    parser.add_option("-o", dest="output", help="write the results to this JSON file")
+    parser.add_option("--seed", type="int", default=0, help="random seed")
+    options, names = parser.parse_args()
+
+    known = dict(OPERATIONS)
+    for name in names:
+        if name not in known:
+            parser.error("unknown operation %s (one of %s)" % (name, ", ".join(n for n, o in OPERATIONS)))
+    operations = [(name, operation) for name, operation in OPERATIONS if not names or name in names]
+
+    directory = tempfile.mkdtemp()
+    results = []
+    try:
+        print "%-24s %8s %9s %10s %10s %10s" % ("operation", "systems", "elements", "min ms", "median ms", "max ms")
+        for systems in [int(s) for s in options.sizes.split(",")]:
+            for result in bench(directory, systems, operations, options.repeat, options.seed):
+                print "%-24s %8d %9d %10.2f %10.2f %10.2f" % (result["operation"], result["systems"], result["elements"],
+                                                             result["min_ms"], result["median_ms"], result["max_ms"])
+                results.append(result)
+    finally:
+        shutil.rmtree(directory)
+
+    if options.output:
+        fp = open(options.output, "w")
+        json.dump({"python": platform.python_version(), "time": time.time(), "repeat": options.repeat,
+                   "results": results}, fp, indent=2)
+        fp.close()
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+'''
+Compare loading MEI files through the parse cache with parsing them
+with XmlImport.
+
+    python bench/parsecache.py [-n repeat] file.mei ...
+
+For each file prints its size, the best of `repeat` XmlImport.read
+times and the best of `repeat` parsecache.read times with a warm cache.
+'''
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pymei import XmlImport
+from neonsrv import parsecache
+
+def best_time(fn, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def bench(path, repeat):
+    # work on a copy, so no cache file is left next to the original
+    directory = tempfile.mkdtemp()
+    try:
+        copy = os.path.join(directory, os.path.basename(path))
+        shutil.copy(path, copy)
+
+        xml = best_time(lambda: XmlImport.read(copy), repeat)
+        # the first read makes the cache
+        cold = best_time(lambda: parsecache.read(copy), 1)
+        warm = best_time(lambda: parsecache.read(copy), repeat)
+        cache_size = os.path.getsize(parsecache.cache_path(copy))
+    finally:
+        shutil.rmtree(directory)
+
+    return os.path.getsize(path), cache_size, xml, cold, warm
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [-n repeat] file.mei ...")
+    parser.add_option("-n", dest="repeat", type="int", default=5, help="runs per measurement (best is kept)")
+    options, paths = parser.parse_args()
+    if not paths:
+        parser.error("no MEI files given")
+
+    print "%-40s %10s %10s %10s %10s %10s %8s" % ("file", "mei bytes", "cache", "xml ms", "cold ms", "warm ms", "speedup")
+    for path in paths:
+        size, cache_size, xml, cold, warm = bench(path, options.repeat)
+        print "%-40s %10d %10d %10.1f %10.1f %10.1f %7.2fx" % (os.path.basename(path)[-40:], size, cache_size,
+                                                              xml * 1000, cold * 1000, warm * 1000, xml / warm)
@@ -0,0 +1,208 @@
+#!/usr/bin/python
+'''
+Replay editing sessions recorded by the server (see EDIT_LOG in conf.py)
+against a running server, to see how many editors it keeps up with.
+
+    python bench/replay.py [-c copies] [-u url] [--paced] [-o results.json] edits.log
+
+The requests to each document in the log make one session. Every
+session is played `copies` times at once, each copy on a copy of the
+document made in MEI_DIRECTORY for the purpose and removed afterwards;
+ids of the elements made during the recorded session are replaced by
+those the server makes during the replay. Sessions are played as fast
+as the server answers, or with the recorded pauses with --paced.
+
+Prints the requests, errors (responses with another status than the
+recorded one), throughput and latency percentiles of every route and,
+with -o, writes them as JSON: {"copies", "sessions", "seconds",
+"routes": [{"route", "requests", "errors", "per_second", "p50_ms",
+"p95_ms", "p99_ms", "max_ms"}, ...]}
+'''
+
+import json
+import optparse
+import os
+import posixpath
+import re
+import shutil
+import sys
+import time
+
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import conf
+from neonsrv.undo import undo_directory
+
+ID_RE = re.compile(r"m-[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+def read_sessions(path):
+    '''
+    The entries of the log (see neonsrv/recorder.py) by document,
+    in the order they were recorded.
+    '''
+
+    sessions = {}
+    fp = open(path)
+    try:
+        for line in fp:
+            if line.strip():
+                entry = json.loads(line)
+                sessions.setdefault(entry[2], []).append(entry)
+    finally:
+        fp.close()
+    return sessions
+
+class Copy:
+    '''
+    A copy of a document for one replayed session: the MEI file and its
+    backup, if any, under the name <name>-replay<n>. The document is
+    <type>/<name>, or just <name> for editors without a document type.
+    '''
+
+    def __init__(self, mei_directory, document, n):
+        self.mei_directory = mei_directory
+        directory, name = posixpath.split(document)
+        self.name = "%s-replay%d" % (name, n)
+        self.document = posixpath.join(directory, self.name)
+
+        self.path = os.path.join(mei_directory, self.document + ".mei")
+        shutil.copy(os.path.join(mei_directory, document + ".mei"), self.path)
+
+        backup = os.path.join(mei_directory, "backup", name + ".mei")
+        self.backup = os.path.join(mei_directory, "backup", self.name + ".mei")
+        if os.path.exists(backup):
+            shutil.copy(backup, self.backup)
+
+    def remove(self):
+        directory, name = os.path.split(self.path)
+        # along with what the server made for it
+        for path in (self.path, self.backup, os.path.join(directory, "." + name + ".parsed")):
+            if os.path.exists(path):
+                os.remove(path)
+        shutil.rmtree(undo_directory(self.path), ignore_errors=True)
+
+def match_ids(recorded, replayed, ids):
+    '''
+    Map the ids in a recorded result to those in the same places
+    of the result of its replay.
+    '''
+
+    if isinstance(recorded, basestring) and isinstance(replayed, basestring):
+        if recorded != replayed and ID_RE.match(recorded):
+            ids[recorded] = replayed
+    elif isinstance(recorded, list) and isinstance(replayed, list):
+        for r, p in zip(recorded, replayed):
+            match_ids(r, p, ids)
+    elif isinstance(recorded, dict) and isinstance(replayed, dict):
+        for key in recorded:
+            if key in replayed:
+                match_ids(recorded[key], replayed[key], ids)
+
+@gen.coroutine
+def play(client, base_url, session, copy, paced, timings):
+    '''
+    Send the requests of a session to the copy of its document, adding
+    (route, seconds, error) to timings for each of them.
+    '''
+
+    ids = {}
+    substitute = lambda text: ID_RE.sub(lambda m: ids.get(m.group(0), m.group(0)), text)
+
+    previous = None
+    for when, method, document, route, body, status, result in session:
+        if paced and previous is not None and when > previous:
+            yield gen.sleep(when - previous)
+        previous = when
+
+        request = HTTPRequest(base_url + "edit/" + copy.document + "/" + substitute(route), method=method,
+                              body=substitute(body).encode("utf-8") if method == "POST" else None,
+                              headers={"Content-Type": "application/x-www-form-urlencoded"},
+                              request_timeout=300)
+        response = yield client.fetch(request, raise_error=False)
+
+        timings.append((method + " " + route.split("?")[0], response.request_time, response.code != status))
+        if result is not None and response.code == 200:
+            try:
+                match_ids(result, json.loads(response.body), ids)
+            except ValueError:
+                pass
+
+def percentile(times, p):
+    return times[min(len(times) - 1, int(len(times) * p / 100.0))]
+
+def summarize(timings, seconds):
+    routes = {}
+    for route, elapsed, error in timings:
+        routes.setdefault(route, []).append((elapsed, error))
+
+    results = []
+    for route in sorted(routes):
+        times = sorted(elapsed * 1000 for elapsed, error in routes[route])
+        results.append({
+            "route": route,
+            "requests": len(times),
+            "errors": sum(1 for elapsed, error in routes[route] if error),
+            "per_second": len(times) / seconds,
+            "p50_ms": percentile(times, 50),
+            "p95_ms": percentile(times, 95),
+            "p99_ms": percentile(times, 99),
+            "max_ms": times[-1],
+        })
+    return results
+
+@gen.coroutine
+def replay(sessions, copies, base_url, mei_directory, paced):
+    made = []
+    try:
+        plays = []
+        for document, session in sorted(sessions.items()):
+            for n in range(copies):
+                made.append(Copy(mei_directory, document, n))
+                plays.append((session, made[-1]))
+
+        AsyncHTTPClient.configure(None, max_clients=len(plays))
+        client = AsyncHTTPClient()
+        timings = []
+        start = time.time()
+        yield [play(client, base_url, session, copy, paced, timings) for session, copy in plays]
+        seconds = time.time() - start
+    finally:
+        for copy in made:
+            copy.remove()
+
+    raise gen.Return((summarize(timings, seconds), seconds))
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [-c copies] [-u url] [--paced] [-o results.json] edits.log")
+    parser.add_option("-c", dest="copies", type="int", default=10, help="copies of each session played at once")
+    parser.add_option("-u", dest="url", default="http://localhost:8080" + conf.APP_ROOT.rstrip("/") + "/",
+                      help="root of the server, default %default")
+    parser.add_option("-d", dest="mei_directory", default=conf.MEI_DIRECTORY,
+                      help="MEI_DIRECTORY of the server, default %default")
+    parser.add_option("--paced", action="store_true", default=False, help="keep the recorded pauses between requests")
+    parser.add_option("-o", dest="output", help="write the results to this JSON file")
+    options, paths = parser.parse_args()
+    if len(paths) != 1:
+        parser.error("give one log file")
+
+    sessions = read_sessions(paths[0])
+    if not sessions:
+        parser.error("no sessions in %s" % paths[0])
+
+    results, seconds = IOLoop.current().run_sync(
+        lambda: replay(sessions, options.copies, options.url.rstrip("/") + "/", options.mei_directory, options.paced))
+
+    print "%d sessions x %d copies in %.1f s" % (len(sessions), options.copies, seconds)
+    print "%-32s %8s %7s %8s %9s %9s %9s %9s" % ("route", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms", "max ms")
+    for result in results:
+        print "%-32s %8d %7d %8.1f %9.1f %9.1f %9.1f %9.1f" % (result["route"][:32], result["requests"], result["errors"],
+                                                              result["per_second"], result["p50_ms"], result["p95_ms"],
+                                                              result["p99_ms"], result["max_ms"])
+
+    if options.output:
+        fp = open(options.output, "w")
+        json.dump({"copies": options.copies, "sessions": len(sessions), "seconds": seconds, "routes": results}, fp, indent=2)
+        fp.close()
@@ -0,0 +1,144 @@
+import os
+import threading
+from collections import OrderedDict
+
+import conf
+
+class DocumentCache:
+    '''
+    Process-wide cache of parsed documents, keyed by absolute path.
+    An entry is only served while the modification time and size of
+    the file on disk still match the ones recorded when it was loaded
+    (or last written back). Entries are evicted least recently used
+    first once either the entry count or the byte budget is exceeded.
+    The byte budget is measured in on-disk MEI size. If set, on_evict
+    is called with the path and value of every evicted entry.
+
+    The cache may be shared between threads. Values are loaded without
+    holding its lock, so callers must not load the same path from two
+    threads at once (see Workers.submit_document).
+    '''
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # path -> (stamp, value), oldest first
+        self.entries = OrderedDict()
+        self.size = 0
+
+        self.on_evict = None
+        self.lock = threading.Lock()
+
+    def get(self, path, load):
+        '''
+        Return the cached value for path, calling load(path) to
+        (re)build it when there is no valid entry.
+        '''
+
+        path = os.path.abspath(path)
+        stamp = self.stamp(path)
+
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                if entry[0] == stamp:
+                    # re-insert to mark as most recently used
+                    self.entries[path] = entry
+                    self.hits += 1
+                    return entry[1]
+                self.size -= entry[0][1]
+
+            self.misses += 1
+
+        value = load(path)
+
+        with self.lock:
+            evicted = self.store(path, stamp, value)
+        self.evicted(evicted)
+
+        return value
+
+    def refresh(self, path):
+        '''
+        Record the current state of the file on disk for an entry whose
+        value was just written back, so that it stays valid.
+        '''
+
+        path = os.path.abspath(path)
+        stamp = self.stamp(path)
+
+        evicted = []
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                self.size -= entry[0][1]
+                evicted = self.store(path, stamp, entry[1])
+        self.evicted(evicted)
+
+    def invalidate(self, path):
+        '''
+        Drop the entry for path, if any.
+        '''
+
+        with self.lock:
+            entry = self.entries.pop(os.path.abspath(path), None)
+            if entry is not None:
+                self.size -= entry[0][1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+    def __contains__(self, path):
+        with self.lock:
+            return os.path.abspath(path) in self.entries
+
+    # HELPER FUNCTIONS
+    def stamp(self, path):
+        st = os.stat(path)
+        return (st.st_mtime, st.st_size)
+
+    def store(self, path, stamp, value):
+        '''
+        Insert an entry and return the (path, value) pairs it evicted.
+        Called with the lock held.
+        '''
+
+        self.entries[path] = (stamp, value)
+        self.size += stamp[1]
+
+        # evict least recently used entries, but always keep the newest
+        evicted = []
+        while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+            old_path, old_entry = self.entries.popitem(last=False)
+            self.size -= old_entry[0][1]
+            self.evictions += 1
+            evicted.append((old_path, old_entry[1]))
+
+        return evicted
+
+    def evicted(self, evicted):
+        if self.on_evict is not None:
+            for path, value in evicted:
+                self.on_evict(path, value)
+
+documents = DocumentCache(conf.DOCUMENT_CACHE_ENTRIES, conf.DOCUMENT_CACHE_BYTES)
+
+# (etag, gzip-compressed contents) of MEI files, for downloads
+compressed_files = DocumentCache(conf.COMPRESSED_CACHE_ENTRIES, conf.COMPRESSED_CACHE_BYTES)
@@ -0,0 +1,86 @@
+import os
+from collections import deque
+
+import tornado.ioloop
+
+import conf
+
+class Channel:
+    '''
+    The subscribers of one document and its most recent messages.
+    '''
+
+    def __init__(self, backlog):
+        self.subscribers = set()
+        self.backlog = deque(maxlen=backlog)
+
+class ChangeFeed:
+    '''
+    Publishes the changes applied to each document to the clients
+    viewing it, as {"revision": ..., "delta": ...} messages (see
+    ModifyDocument.describe_changes), or {"revision": ..., "reload": true}
+    when the document changed in a way a delta can't describe.
+
+    The last `backlog` messages of each document are kept, so that a
+    client joining or reconnecting with the revision it has can catch
+    up without fetching the whole document again.
+
+    Subscribers are objects with a send(message) method. Publishing is
+    safe from any thread; messages are delivered on the IOLoop, in the
+    order they were published.
+    '''
+
+    def __init__(self, backlog):
+        self.backlog = backlog
+
+        # absolute path -> Channel
+        self.channels = {}
+
+    def publish(self, path, message):
+        tornado.ioloop.IOLoop.instance().add_callback(self.deliver, os.path.abspath(path), message)
+
+    def subscribe(self, path, subscriber, since=None):
+        '''
+        Start sending the messages of the document at path to subscriber.
+        Returns the backlogged messages newer than revision since, or None
+        if the backlog doesn't reach back that far.
+        '''
+
+        channel = self.channel(os.path.abspath(path))
+        channel.subscribers.add(subscriber)
+
+        if since is None:
+            return []
+
+        missed = [message for message in channel.backlog if message["revision"] > since]
+        if missed and missed[0]["revision"] != since + 1:
+            return None
+        if not missed and not channel.backlog:
+            return None
+        return missed
+
+    def unsubscribe(self, path, subscriber):
+        path = os.path.abspath(path)
+        channel = self.channels.get(path)
+        if channel is None:
+            return
+
+        channel.subscribers.discard(subscriber)
+        if not channel.subscribers and not channel.backlog:
+            del self.channels[path]
+
+    # HELPER FUNCTIONS
+    def channel(self, path):
+        channel = self.channels.get(path)
+        if channel is None:
+            channel = self.channels[path] = Channel(self.backlog)
+        return channel
+
+    def deliver(self, path, message):
+        channel = self.channel(path)
+        channel.backlog.append(message)
+
+        for subscriber in list(channel.subscribers):
+            subscriber.send(message)
+
+feed = ChangeFeed(conf.FEED_BACKLOG)
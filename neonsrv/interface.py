@@ -1,33 +1,75 @@
+import gzip
+import hashlib
 import json
 import mimetypes
 import os
 import shutil
+from cStringIO import StringIO
 
 from pymei import XmlImport, XmlExport
 
+from tornado import gen
 import tornado.web
 
 import conf
-
-class RootHandler(tornado.web.RequestHandler):
+from doccache import documents, compressed_files
+from writebehind import pending_writes
+from workers import workers
+from tornadoapi import EditHandler
+from undo import UndoStore, undo_directory
+from feed import feed
+import parsecache
+from manifest import manifests, COUNTED
+from upload import start_spool, upload_jobs
+from tiles import tiler
+from previews import previews
+
+def discover_image(image_path):
+    tiler.discover(image_path)
+    previews.discover(image_path)
+
+# make the tiles, thumbnails and previews of pages found in the directories
+manifests.on_new_image = discover_image
+
+@tornado.web.stream_request_body
+class SpoolingHandler(tornado.web.RequestHandler):
+    '''
+    Base of the handlers taking uploads. The body of a POST is parsed as
+    it arrives and the uploaded files are spooled to disk (see
+    MultipartSpool), instead of being buffered in memory.
+    '''
+
+    def prepare(self):
+        self.spool = None
+        if self.request.method == "POST":
+            self.request.connection.set_max_body_size(conf.MAX_UPLOAD_BYTES)
+            self.spool = start_spool(self.request)
+
+    def data_received(self, chunk):
+        try:
+            self.spool.feed(chunk)
+        except Exception:
+            self.spool.discard()
+            raise
+
+    def on_connection_close(self):
+        if self.spool is not None:
+            self.spool.discard()
+
+class RootHandler(SpoolingHandler):
     def get_files(self, document_type):
         if(document_type != "cheironomic"):
-            root_dir = os.path.abspath(conf.MEI_DIRECTORY)
-            mei_dir = os.path.join(root_dir, document_type)
-
             # only list mei files (not jpeg)
-            meiFiles = []
-            for f in os.listdir(mei_dir):
-                if f.endswith(".mei"):
-                    meiFiles.append(f)
-            return meiFiles
+            return [entry["name"] for entry in manifests.files(document_type)]
 
     def get_document_types(self):
-        mei_dir = os.path.abspath(conf.MEI_DIRECTORY)
-        
         # list subdirectories in the mei root directory
-        return os.walk(mei_dir).next()[1] 
+        return manifests.document_types()
+
+    def get_listing(self, document_type):
+        return self.get_files(document_type), self.get_document_types()
 
+    @gen.coroutine
     def get(self, url):
         #default and permissions are set in server.py
         url = url or self.settings["default"]
@@ -38,77 +80,64 @@ class RootHandler(tornado.web.RequestHandler):
 
         #else, page handlers
         elif url == "index.html":
+            rootfiles, document_types = yield workers.submit(self.get_listing, '')
             self.render(url, 
-                    rootfiles=self.get_files(''),
-                    document_types=self.get_document_types(),
+                    rootfiles=rootfiles,
+                    document_types=document_types,
                     errors="", 
                     prefix=conf.get_prefix())
 
         elif url == "demo.html":
+            squarenotefiles, document_types = yield workers.submit(self.get_listing, 'squarenote')
             self.render(url, 
-                    squarenotefiles=self.get_files('squarenote'), 
+                    squarenotefiles=squarenotefiles, 
                     # stafflessfiles=self.get_files('cheironomic'),
-                    document_types=self.get_document_types(),
+                    document_types=document_types,
                     errors="", 
                     prefix=conf.get_prefix())
 
+    @gen.coroutine
     def post(self, request):
-        mei = self.request.files.get("mei", [])
-        mei_img = self.request.files.get("mei_img", [])
-        document_type = "squarenote"
-        mei_root_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        mei_directory = os.path.join(mei_root_directory, document_type)
-        mei_directory_backup = os.path.join(mei_root_directory, "backup")
-        errors = ""
-        mei_fn = ""
-        if len(mei):
-            mei_fn = mei[0]["filename"]
-            mei_fn_split = os.path.splitext(mei_fn)
-            mei_zero, mei_ext = mei_fn_split
-            contents = mei[0]["body"]
-            # TODO: Figure out how to validate MEI files properly using pymei
-            try:
-                mei = XmlImport.documentFromText(contents)
-            # if not mei_fn.endswith('.mei'):
-            #     errors = "not in mei file format"
-                if os.path.exists(os.path.join(mei_directory, mei_fn)):
-                    errors = "mei file already exists"
-                else:
-                    # write to working directory and backup
-                    fp = open(os.path.join(mei_directory, mei_fn), "w")
-                    fp.write(contents)
-                    fp.close()
-                    fp = open(os.path.join(mei_directory_backup, mei_fn), "w")
-                    fp.write(contents)
-                    fp.close()
+        files, fields = self.spool.close()
 
-            except Exception, e:
-                errors = "invalid mei file"
-
-        if len(mei_img):
-            # derive image filename from mei filename
-            if mei_fn != "":
-                img_fn = os.path.splitext(mei_fn)[0] + ".jpg"
-            else:
-                img_fn = mei_img[0]["filename"]
-            img_contents = mei_img[0]["body"]
-            try:
-                if os.path.exists(os.path.join(mei_directory, img_fn)):
-                    errors += "image file already exists"
-                else:
-                    fp = open(os.path.join(mei_directory, img_fn), "w")
-                    fp.write(img_contents)
-                    fp.close()
-            except Exception, e:
-                errors += "invalid image file"
+        # validating and storing the upload is left to the workers
+        job_id, future = upload_jobs.submit(save_upload, files)
+        errors = yield future
+        squarenotefiles, document_types = yield workers.submit(self.get_listing, 'squarenote')
 
         self.render("demo.html",
-                    squarenotefiles=self.get_files('squarenote'), 
+                    squarenotefiles=squarenotefiles, 
                     # stafflessfiles=self.get_files('cheironomic'),
-                    document_types=self.get_document_types(),
+                    document_types=document_types,
                     errors=errors, 
                     prefix=conf.get_prefix())
 
+class UploadHandler(SpoolingHandler):
+    def post(self):
+        '''
+        Accept an upload like the form on the demo page does, but answer
+        right away with the id of the job storing it: {"job": <id>}.
+        Its outcome is then found at /upload/<id> (see UploadStatusHandler).
+        '''
+        files, fields = self.spool.close()
+        job_id, future = upload_jobs.submit(save_upload, files)
+
+        self.set_status(202)
+        self.set_header("Location", conf.get_prefix() + "/upload/" + job_id)
+        self.write(json.dumps({"job": job_id}))
+
+class UploadStatusHandler(tornado.web.RequestHandler):
+    def get(self, job_id):
+        '''
+        The state of an upload job: {"state": "pending" | "done" | "failed", "errors": ...}
+        '''
+        status = upload_jobs.status(job_id)
+        if status is None:
+            raise tornado.web.HTTPError(404)
+
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(status))
+
 class SquareNoteEditorHandler(tornado.web.RequestHandler):
     def get(self, page):
         debug = self.get_argument("debug", None)
@@ -120,28 +149,14 @@ class SquareNoteEditorHandler(tornado.web.RequestHandler):
         imagepath = conf.PROD_IMAGE_PATH.replace("PAGE", page)
         self.render(conf.get_neonHtmlFileName(square=True), page=page, debug=dstr, prefix=conf.get_prefix(), imagepath=imagepath)
 
-class DeleteUndosHandler(tornado.web.RequestHandler):
+class DeleteUndosHandler(EditHandler):
+    @gen.coroutine
     def post(self, documentType, filename):
-
-        mei_directory = os.path.join(os.path.abspath(conf.MEI_DIRECTORY), documentType)
-        meiworking = os.path.join(mei_directory, filename + ".mei")
-        mei_directory_undo = os.path.join(conf.MEI_DIRECTORY, "undo")
-
-        file_list = [f for f in os.listdir(mei_directory_undo)
-                     if os.path.isfile(os.path.join(mei_directory_undo, f))]
-
-        if len(file_list) != 0:
-            for f in file_list:
-                os.remove(mei_directory_undo + "/" + f)
-
-        file_list = [f for f in os.listdir(mei_directory_undo)
-                     if os.path.isfile(os.path.join(mei_directory_undo, f))]
-
-        if len(file_list) == 0:
-            meiundo = os.path.join(mei_directory_undo, filename + "_0" + str(1) + ".mei")
-
-            if meiundo:
-                shutil.copy(meiworking, meiundo)
+        '''
+        Start a fresh undo history for the given document.
+        '''
+        response = yield self.edit(os.path.join(documentType, filename), lambda md: md.reset_undo())
+        self.write(json.dumps(response))
 
 class StafflessEditorHandler(tornado.web.RequestHandler):
     def get(self, page):
@@ -154,48 +169,98 @@ class StafflessEditorHandler(tornado.web.RequestHandler):
         imagepath = conf.PROD_IMAGE_PATH.replace("PAGE", page)
         self.render(conf.get_neonHtmlFileName(square=False), page=page, debug=dstr, prefix=conf.get_prefix(), imagepath=imagepath)
 
-class FileHandler(tornado.web.RequestHandler):
+class FileHandler(tornado.web.StaticFileHandler):
+    '''
+    Serves files of the MEI directory in chunks, answering conditional
+    (ETag, Last-Modified) and range requests (see StaticFileHandler).
+    Pending edits of an MEI file are written before it is served, and it
+    is sent gzip-compressed to clients that accept it, from a cache of
+    compressed revisions rather than compressed on every hit. Other
+    files are served as they are.
+    '''
     mimetypes.add_type("text/xml", ".mei")
 
-    def get(self, filename):
-        fullpath = os.path.join(conf.MEI_DIRECTORY, filename)
-        if not os.path.exists(os.path.abspath(fullpath)):
-            self.send_error(403)
-        else:
-            fp = open(fullpath, "r")
-            response = fp.read()
-            # derive mime type from file for generic serving
-            self.set_header("Content-Type", mimetypes.guess_type(fullpath)[0]);
-            self.write(response)
+    def initialize(self, path, default_filename=None):
+        tornado.web.StaticFileHandler.initialize(self, path, default_filename)
+        # (etag, gzip-compressed content) of the requested MEI file, if sent compressed
+        self.compressed = None
+
+    @gen.coroutine
+    def get(self, path, include_body=True):
+        root = os.path.abspath(self.root)
+        fullpath = os.path.abspath(os.path.join(root, path))
+        if not fullpath.startswith(root + os.sep):
+            raise tornado.web.HTTPError(403)
+
+        # only documents have edits to write; images and the like are
+        # served right away, without waiting behind the edits
+        if fullpath.endswith(".mei"):
+            compress = "gzip" in self.request.headers.get("Accept-Encoding", "")
+            self.compressed = yield workers.submit_document(fullpath, prepare_file, fullpath, compress)
+
+        yield tornado.web.StaticFileHandler.get(self, path, include_body)
+
+    def compute_etag(self):
+        if self.compressed is not None:
+            return self.compressed[0]
+
+        # derived from the file's stat, as the file changes with every edit
+        stat = self._stat()
+        return '"%x-%x"' % (int(stat.st_mtime * 1000000), stat.st_size)
+
+    def set_extra_headers(self, path):
+        if self.absolute_path.endswith(".mei"):
+            self.set_header("Vary", "Accept-Encoding")
+        if self.compressed is not None:
+            self.set_header("Content-Encoding", "gzip")
+
+    def get_content_size(self):
+        if self.compressed is not None:
+            return len(self.compressed[1])
+        return tornado.web.StaticFileHandler.get_content_size(self)
+
+    def get_content(self, abspath, start=None, end=None):
+        if self.compressed is not None:
+            return self.compressed[1][start:end]
+        return tornado.web.StaticFileHandler.get_content(abspath, start, end)
 
 class DeleteFileHandler(tornado.web.RequestHandler):
     mimetypes.add_type("text/xml", ".mei")
 
+    @gen.coroutine
     def post(self, filename):
         fullpath = os.path.join(conf.MEI_DIRECTORY + "/squarenote/", filename)
-        if not os.path.exists(os.path.abspath(fullpath)):
+        deleted = yield workers.submit_document(os.path.abspath(fullpath), self.delete_file, fullpath)
+        if not deleted:
             self.send_error(403)
         else:
-            os.remove(fullpath)
-            jpgPath, mei_extension = os.path.splitext(fullpath)
-            os.remove(jpgPath + ".jpg")
             self.redirect('/')
 
-class DemoFileHandler(tornado.web.RequestHandler):
-    mimetypes.add_type("text/xml", ".mei")
-
-    def get(self, documentType, filename):
-        fullpath = os.path.join(conf.MEI_DIRECTORY, documentType, filename)
+    def delete_file(self, fullpath):
         if not os.path.exists(os.path.abspath(fullpath)):
-            self.send_error(403)
-        else:
-            fp = open(fullpath, "r")
-            response = fp.read()
-            # derive mime type from file for generic serving
-            self.set_header("Content-Type", mimetypes.guess_type(fullpath)[0]);
-            self.write(response)
+            return False
+
+        # the deleted document must not be written back later on
+        pending_writes.discard(fullpath)
+        documents.invalidate(fullpath)
+        os.remove(fullpath)
+        parsecache.invalidate(fullpath)
+        jpgPath, mei_extension = os.path.splitext(fullpath)
+        os.remove(jpgPath + ".jpg")
+        tiler.remove(jpgPath + ".jpg")
+        previews.remove(jpgPath + ".jpg")
+        manifests.invalidate("squarenote")
+        return True
+
+class DemoFileHandler(FileHandler):
+    def get(self, documentType, filename, include_body=True):
+        return FileHandler.get(self, os.path.join(documentType, filename), include_body)
+
+    def head(self, documentType, filename):
+        return self.get(documentType, filename, include_body=False)
 
 class FileRevertHandler(tornado.web.RequestHandler):
+    @gen.coroutine
     def post(self, documentType, filename):
         '''
         Move the given filename from the backup directory to the
@@ -203,39 +268,235 @@ class FileRevertHandler(tornado.web.RequestHandler):
         '''
         mei_directory = os.path.join(os.path.abspath(conf.MEI_DIRECTORY), documentType)
         meiworking = os.path.join(mei_directory, filename + ".mei")
+        yield workers.submit_document(meiworking, self.revert, filename, meiworking)
+
+    def revert(self, filename, meiworking):
         mei_directory_backup = os.path.join(conf.MEI_DIRECTORY, "backup")
         meibackup = os.path.join(mei_directory_backup, filename + ".mei")
+        pending_writes.flush(meiworking)
 
         if meibackup:
             shutil.copy(meibackup, meiworking)
+            documents.invalidate(meiworking)
+
+            # the recorded edits no longer apply to the reverted document
+            undo_store = UndoStore(undo_directory(meiworking), document=meiworking)
+            undo_store.reset()
+            undo_store.bump()
+            undo_store.flush()
+
+            feed.publish(meiworking, {"revision": undo_store.revision(), "reload": True})
 
-class FileUndoHandler(tornado.web.RequestHandler):
+class FileUndoHandler(EditHandler):
+    @gen.coroutine
     def post(self, documentType, filename):
         '''
-        Move the given filename from the undo directory to the
-        working directory. Overwrites changes made by the editor!
+        Revert the most recent edit of the given document.
         '''
-        mei_directory = os.path.join(os.path.abspath(conf.MEI_DIRECTORY), documentType)
-        meiworking = os.path.join(mei_directory, filename + ".mei")
-        mei_directory_undo = os.path.join(conf.MEI_DIRECTORY, "undo")
+        response = yield self.edit(os.path.join(documentType, filename), lambda md: md.undo())
+        self.write(json.dumps(response))
 
-        file_list = [f for f in os.listdir(mei_directory_undo)
-                     if os.path.isfile(os.path.join(mei_directory_undo, f))]
+class FileListHandler(tornado.web.RequestHandler):
+    SORT_KEYS = ("name", "size", "mtime")
 
-        list_length = len(file_list)
+    @gen.coroutine
+    def get(self, document_type):
+        '''
+        List the MEI files of a document type from its cached manifest,
+        sorted and a page at a time:
+        ?sort=name|size|mtime|<counted element>&reverse=1&offset=0&limit=100
+        {"total": ..., "files": [{"name", "size", "mtime", "image", "counts": {<element>: ...}}, ...]}
+        '''
+        root = os.path.abspath(conf.MEI_DIRECTORY)
+        directory = os.path.abspath(os.path.join(root, document_type))
+        if directory != root and not directory.startswith(root + os.sep):
+            raise tornado.web.HTTPError(403)
+
+        sort = self.get_argument("sort", "name")
+        if sort in self.SORT_KEYS:
+            key = lambda entry: entry[sort]
+        elif sort in COUNTED:
+            key = lambda entry: entry["counts"][sort]
+        else:
+            raise tornado.web.HTTPError(400, "unknown sort key %s" % sort)
 
-        if list_length > 1:
-            if list_length < 10:
-                meicurrent = os.path.join(mei_directory_undo, filename + "_0" + str(list_length) + ".mei")
-                meiundo = os.path.join(mei_directory_undo, filename + "_0" + str(list_length - 1) + ".mei")
-            elif list_length == 10:
-                meicurrent = os.path.join(mei_directory_undo, filename + "_" + str(list_length) + ".mei")
-                meiundo = os.path.join(mei_directory_undo, filename + "_0" + str(list_length - 1) + ".mei")
-            else:
-                meicurrent = os.path.join(mei_directory_undo, filename + "_" + str(list_length) + ".mei")
-                meiundo = os.path.join(mei_directory_undo, filename + "_" + str(list_length - 1) + ".mei")
+        try:
+            offset = int(self.get_argument("offset", 0))
+            limit = int(self.get_argument("limit", 100))
+        except ValueError:
+            raise tornado.web.HTTPError(400, "offset and limit must be integers")
+
+        try:
+            entries = yield workers.submit(manifests.files, document_type)
+        except OSError:
+            raise tornado.web.HTTPError(404)
+
+        entries = sorted(entries, key=key, reverse=bool(self.get_argument("reverse", "")))
+
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps({"total": len(entries), "files": entries[offset:offset + limit]}))
+
+class TileInfoHandler(tornado.web.RequestHandler):
+    @gen.coroutine
+    def get(self, documentType, page):
+        '''
+        Describe the tile pyramid of the image of a page (see Tiler),
+        making it first if need be:
+        {"version", "width", "height", "tile_size", "levels", "url"}
+        where url is the template of the tile urls, with {level},
+        {column} and {row} to fill in. Level 0 is the full size image.
+        '''
+        image_path = page_image(documentType, page)
+        info = yield tiler.ensure(image_path)
+
+        url = "%s/tiles/%s/%s/%s/{level}/{column}_{row}.jpg" % (conf.get_prefix(), documentType, page, info["version"])
+        self.set_header("Content-Type", "application/json")
+        self.set_header("Cache-Control", "no-cache")
+        self.write(json.dumps(dict(info, url=url)))
+
+class TileHandler(tornado.web.StaticFileHandler):
+    '''
+    Serves the tiles of page images. Their urls name the version of the
+    image they were cut from, so they never change and may be cached
+    for good.
+    '''
+    def get(self, documentType, page, version, level, tile, include_body=True):
+        path = os.path.join(documentType, ".tiles", page, version, level, tile + ".jpg")
+        return tornado.web.StaticFileHandler.get(self, path, include_body)
+
+    def head(self, documentType, page, version, level, tile):
+        return self.get(documentType, page, version, level, tile, include_body=False)
+
+    def get_cache_time(self, path, modified, mime_type):
+        return 365 * 24 * 60 * 60
+
+class PreviewHandler(tornado.web.StaticFileHandler):
+    '''
+    Serves the thumbnail or preview of the image of a page (see
+    Previews), making it first if need be. Sent with ?v=<version> of
+    the image, they may be cached for good; otherwise they are
+    revalidated against their ETag.
+    '''
+    @gen.coroutine
+    def get(self, documentType, page, size, include_body=True):
+        renditions = yield previews.ensure(page_image(documentType, page))
+        self.immutable = self.get_argument("v", None) == renditions["version"]
+
+        path = os.path.relpath(renditions[size], os.path.abspath(self.root))
+        yield tornado.web.StaticFileHandler.get(self, path, include_body)
+
+    def head(self, documentType, page, size):
+        return self.get(documentType, page, size, include_body=False)
+
+    def get_cache_time(self, path, modified, mime_type):
+        if self.immutable:
+            return 365 * 24 * 60 * 60
+        return 0
+
+    def set_extra_headers(self, path):
+        if not self.immutable:
+            self.set_header("Cache-Control", "no-cache")
+
+class StatsHandler(tornado.web.RequestHandler):
+    def get(self):
+        '''
+        Report server-side counters, e.g. document cache hits and misses.
+        '''
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps({
+            "documents": documents.stats(),
+            "compressed_files": compressed_files.stats(),
+            "workers": workers.stats()
+        }))
+
+def save_upload(files):
+    '''
+    Store an uploaded MEI file, in the working and backup directories,
+    and its image, from the spool files they were received into (see
+    MultipartSpool). Returns the errors to report, if any.
+    '''
+    document_type = "squarenote"
+    mei_root_directory = os.path.abspath(conf.MEI_DIRECTORY)
+    mei_directory = os.path.join(mei_root_directory, document_type)
+    mei_directory_backup = os.path.join(mei_root_directory, "backup")
+    mei = files.get("mei", [])
+    mei_img = files.get("mei_img", [])
+    errors = ""
+    mei_fn = ""
+    try:
+        if len(mei):
+            mei_fn = os.path.basename(mei[0]["filename"])
+            # TODO: Figure out how to validate MEI files properly using pymei
+            try:
+                XmlImport.read(mei[0]["path"])
+            # if not mei_fn.endswith('.mei'):
+            #     errors = "not in mei file format"
+                if os.path.exists(os.path.join(mei_directory, mei_fn)):
+                    errors = "mei file already exists"
+                else:
+                    # copy to backup, then move to the working directory
+                    shutil.copyfile(mei[0]["path"], os.path.join(mei_directory_backup, mei_fn))
+                    shutil.move(mei[0]["path"], os.path.join(mei_directory, mei_fn))
+                    if conf.PARSE_CACHE:
+                        parsecache.read(os.path.join(mei_directory, mei_fn))
 
-            if meiundo:
-                shutil.copy(meiundo, meiworking)
+            except Exception, e:
+                errors = "invalid mei file"
 
-            os.remove(meicurrent)
+        if len(mei_img):
+            # derive image filename from mei filename
+            if mei_fn != "":
+                img_fn = os.path.splitext(mei_fn)[0] + ".jpg"
+            else:
+                img_fn = os.path.basename(mei_img[0]["filename"])
+            try:
+                if os.path.exists(os.path.join(mei_directory, img_fn)):
+                    errors += "image file already exists"
+                else:
+                    shutil.move(mei_img[0]["path"], os.path.join(mei_directory, img_fn))
+                    if tiler.available():
+                        tiler.ensure(os.path.join(mei_directory, img_fn))
+                        previews.ensure(os.path.join(mei_directory, img_fn))
+            except Exception, e:
+                errors += "invalid image file"
+    finally:
+        # spool files that were not moved into place
+        for parts in files.values():
+            for part in parts:
+                if os.path.exists(part["path"]):
+                    os.remove(part["path"])
+
+    manifests.invalidate(document_type)
+    return errors
+
+def page_image(documentType, page):
+    root = os.path.abspath(conf.MEI_DIRECTORY)
+    image_path = os.path.abspath(os.path.join(root, documentType, page + ".jpg"))
+    if not image_path.startswith(root + os.sep):
+        raise tornado.web.HTTPError(403)
+    return image_path
+
+def prepare_file(fullpath, compress):
+    '''
+    Write out any pending edits of the file before it is served. If
+    compress is set, return the etag and the gzip-compressed contents
+    of the file (None if there is no such file).
+    '''
+    pending_writes.flush(fullpath)
+    if compress and os.path.isfile(fullpath):
+        return compressed_files.get(fullpath, compress_file)
+    return None
+
+def compress_file(fullpath):
+    fp = open(fullpath, "rb")
+    contents = fp.read()
+    fp.close()
+
+    buf = StringIO()
+    # no file name or time in the header, so that equal files compress alike
+    gz = gzip.GzipFile(filename="", mode="wb", fileobj=buf, mtime=0)
+    gz.write(contents)
+    gz.close()
+    compressed = buf.getvalue()
+
+    return ('"%s-gz"' % hashlib.md5(compressed).hexdigest(), compressed)
@@ -0,0 +1,173 @@
+import os
+import re
+import threading
+import time
+
+import conf
+
+# elements counted in each MEI file of a listing
+COUNTED = ("neume", "clef", "division", "custos", "sb")
+COUNTED_RE = re.compile(r"<(%s)[\s/>]" % "|".join(COUNTED))
+
+class Manifest:
+    '''
+    What is known about the MEI files of one directory: an entry
+    {"name", "size", "mtime", "image", "counts"} per file, keyed by name.
+    '''
+
+    def __init__(self):
+        self.entries = {}
+        self.names = []
+        # image name -> (size, mtime) of the page images of the entries
+        self.images = {}
+        # names in the directory when it was last listed
+        self.listing = []
+        # names of the subdirectories, once asked for
+        self.list_directories = False
+        self.directories = []
+        # mtime of the directory the entries were read at, None if they
+        # may miss changes made in the same second
+        self.mtime = None
+        self.checked = 0
+
+class Manifests:
+    '''
+    Cached listings of the document type directories, so that listing
+    pages don't walk the (possibly remote) file system on every load.
+
+    A directory is looked at again at most every `ttl` seconds, and only
+    relisted when its mtime changed; the files are stat'ed every time,
+    as overwriting one in place leaves the mtime of the directory alone.
+    Files whose size and mtime are the same keep their entries, so only
+    new and changed files are read to count their elements. Uploads and
+    deletions invalidate the listing right away. Page images are told
+    apart by their own size and mtime, so that one added or replaced
+    next to an unchanged MEI file is passed to on_new_image all the same.
+    '''
+
+    def __init__(self, root, ttl):
+        self.root = root
+        self.ttl = ttl
+
+        # directory -> Manifest
+        self.manifests = {}
+        self.lock = threading.Lock()
+
+        # called with the path of every new or changed page image
+        # found next to an MEI file, if set
+        self.on_new_image = None
+
+    def files(self, document_type):
+        '''
+        The entries of the MEI files of a document type, by name.
+        '''
+
+        directory = os.path.join(os.path.abspath(self.root), document_type)
+        with self.lock:
+            manifest = self.manifests.get(directory)
+            if manifest is None:
+                manifest = self.manifests[directory] = Manifest()
+            self.refresh(directory, manifest)
+            return [manifest.entries[name] for name in manifest.names]
+
+    def document_types(self):
+        root = os.path.abspath(self.root)
+        with self.lock:
+            manifest = self.manifests.get(root)
+            if manifest is None:
+                manifest = self.manifests[root] = Manifest()
+            if not manifest.list_directories:
+                manifest.list_directories = True
+                manifest.checked = 0
+                manifest.mtime = None
+            self.refresh(root, manifest)
+            return list(manifest.directories)
+
+    def invalidate(self, document_type):
+        directory = os.path.join(os.path.abspath(self.root), document_type)
+        with self.lock:
+            manifest = self.manifests.get(directory)
+            if manifest is not None:
+                manifest.checked = 0
+                manifest.mtime = None
+
+    # HELPER FUNCTIONS
+    def refresh(self, directory, manifest):
+        '''
+        Bring the manifest up to date, if it is due. Called with the lock held.
+        '''
+
+        now = time.time()
+        if now - manifest.checked < self.ttl:
+            return
+        manifest.checked = now
+
+        mtime = os.stat(directory).st_mtime
+        if mtime == manifest.mtime:
+            names = manifest.listing
+        else:
+            names = os.listdir(directory)
+        present = set(names)
+        entries = {}
+        images = {}
+        found = []
+        for name in names:
+            if not name.endswith(".mei"):
+                continue
+
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+                entry = manifest.entries.get(name)
+                if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+                    entry = {"name": name, "size": stat.st_size, "mtime": stat.st_mtime, "counts": count_elements(path)}
+            except (IOError, OSError):
+                # removed since it was listed
+                continue
+
+            image = name[:-len(".mei")] + ".jpg"
+            if image in present:
+                try:
+                    stat = os.stat(os.path.join(directory, image))
+                    images[image] = (stat.st_size, stat.st_mtime)
+                    if manifest.images.get(image) != images[image]:
+                        found.append(image)
+                except OSError:
+                    present.discard(image)
+
+            entries[name] = dict(entry, image=image in present)
+
+        manifest.entries = entries
+        manifest.names = sorted(entries)
+        manifest.images = images
+        manifest.listing = names
+        if manifest.list_directories:
+            manifest.directories = sorted(name for name in names if os.path.isdir(os.path.join(directory, name)))
+
+        if self.on_new_image is not None:
+            for image in found:
+                self.on_new_image(os.path.join(directory, image))
+
+        # changes within the second the directory was last modified
+        # may not show in its mtime, so look again next time
+        if now - mtime > 1:
+            manifest.mtime = mtime
+        else:
+            manifest.mtime = None
+
+def count_elements(path):
+    '''
+    Count the COUNTED elements of an MEI file by scanning its text,
+    which is much cheaper than parsing it.
+    '''
+
+    counts = dict((name, 0) for name in COUNTED)
+    fp = open(path, "rb")
+    try:
+        for match in COUNTED_RE.finditer(fp.read()):
+            counts[match.group(1)] += 1
+    finally:
+        fp.close()
+    return counts
+
+manifests = Manifests(conf.MEI_DIRECTORY, conf.MANIFEST_TTL)
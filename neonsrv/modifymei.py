@@ -1,12 +1,69 @@
+import math
 import os
 from pymei import MeiElement, MeiAttribute, XmlImport, XmlExport
 
+from undo import UndoStore, undo_directory
+from spatial import GridIndex
+import pitch
+
+# pitch_info value asking clef operations to recompute the pitches of
+# the affected neumes themselves (see ModifyDocument.apply_pitch_info)
+AUTO_PITCH = "auto"
+
 class ModifyDocument:
+
+    # edit operations that may be requested by name, e.g. in a batch
+    OPERATIONS = ("insert_punctum", "move_neume", "delete_neume", "update_neume_head_shape",
+                  "neumify", "ungroup", "insert_division", "move_division", "delete_division",
+                  "update_division_shape", "add_episema", "delete_episema", "add_dot", "delete_dot",
+                  "insert_clef", "move_clef", "update_clef_shape", "delete_clef",
+                  "insert_custos", "move_custos", "delete_custos",
+                  "insert_system", "insert_system_break", "modify_system_break",
+                  "delete_system", "delete_system_break", "update_system_zone")
     
-    def __init__(self, filename):
-        self.mei = XmlImport.read(filename + ".mei")
+    def __init__(self, filename, debug_index=False, read=XmlImport.read):
+        self.mei = read(filename + ".mei")
         self.filename = filename + ".mei"
 
+        # id -> element, for every element attached to the document
+        self.elements = {}
+        # element id -> id of the zone in its facs attribute
+        self.facs = {}
+        # zone id -> ids of the elements referencing it
+        self.zone_refs = {}
+        # element name -> elements in document order, filled on demand
+        self.by_name = {}
+        # section id -> (its staves in order, staff id -> position),
+        # filled on demand
+        self.staff_tables = {}
+        # zone boxes, built by the first region query; zones added, moved
+        # or removed since the last query are brought up to date by the next
+        self.spatial = None
+        self.moved_zones = set()
+        # the render model, and the render entries of the elements of
+        # its systems by id, dropped as far as edits touch them
+        self.model = None
+        self.rendered = {}
+        # ids of the sections and staff groups that gained or lost staves
+        # or staff definitions since the last write, whose numbers have
+        # to be brought up to date
+        self.unnumbered = set()
+        self.index_element(self.mei.getRootElement())
+        # the numbers of the file as read are kept
+        self.unnumbered.clear()
+
+        # check the index against the tree after every edit
+        self.debug_index = debug_index
+
+        self.undo_store = UndoStore(undo_directory(self.filename), document=self.filename)
+
+        # changes made to the document tree since the last commit or rollback
+        self.changes = []
+        # changes made by an undo, which are not recorded for undo themselves
+        self.undone = []
+        # the delta of the last committed edit (see describe_changes)
+        self.delta = None
+
     def write_doc(self, **kwargs):
         '''
         Write the modified MEI document out to a file,
@@ -19,37 +76,327 @@ class ModifyDocument:
         else:
             filename = self.filename
 
-        filename_split_initial = os.path.split(filename)
-        filename_dir, mei_filename = filename_split_initial
+        if self.unnumbered:
+            self.renumber_staves()
 
-        filename_split = os.path.split(filename_dir)
-        filename_split_beg, filename_split_end = filename_split
-        undo_path = filename_split_beg + "/undo/"
+        # write aside and rename, so the file is never served half written
+        XmlExport.write(self.mei, filename + ".tmp")
+        os.rename(filename + ".tmp", filename)
 
-        file_list = [f for f in os.listdir(undo_path)
-                        if os.path.isfile(os.path.join(undo_path, f))]
+        # the undo history follows the document to disk, never ahead of it
+        if filename == self.filename:
+            self.undo_store.flush()
 
-        file_num = 1 + len(file_list)
+    def commit(self):
+        '''
+        Close the current edit: record the changes it made to the
+        document in the undo history, and describe them in self.delta.
+        '''
 
-        mei_filename_split = os.path.splitext(mei_filename)
-        mei_name, mei_ext = mei_filename_split
+        if self.changes:
+            self.undo_store.push(self.changes)
+        self.delta = self.describe_changes(self.undone + self.changes)
+        self.changes = []
+        self.undone = []
 
-        if(file_num > 50):
-            file_num = 50
-            os.remove(undo_path + mei_name + '_01' + mei_ext)
-            file_list.pop(0)
-            for idx, f in enumerate(file_list):
-                if(idx < 9):
-                    os.rename(undo_path + f, undo_path + mei_name + '_0' + str(idx + 1) + mei_ext)
-                else:
-                    os.rename(undo_path + f, undo_path + mei_name + '_' + str(idx + 1) + mei_ext)
+        if self.debug_index:
+            self.check_index()
 
-        if (file_num < 10):
-            XmlExport.write(self.mei, undo_path + mei_name + '_0' + str(file_num) + mei_ext)
-            XmlExport.write(self.mei, filename)
-        else:
-            XmlExport.write(self.mei, undo_path + mei_name + '_' + str(file_num) + mei_ext)
-            XmlExport.write(self.mei, filename)
+    def rollback(self):
+        '''
+        Revert the changes made since the last commit, e.g. by
+        an edit that failed halfway through.
+        '''
+
+        changes = self.undone + self.changes
+        self.changes = []
+        self.undone = []
+        self.revert_changes(changes)
+        self.changes = []
+
+        if self.debug_index:
+            self.check_index()
+
+    def undo(self):
+        '''
+        Revert the most recent edit recorded in the undo history.
+        Returns False if there is nothing left to undo.
+        '''
+
+        changes = self.undo_store.pop()
+        if changes is None:
+            return False
+
+        try:
+            self.revert_changes(changes)
+        except:
+            self.rollback()
+            self.undo_store.push(changes)
+            raise
+
+        # the undo itself is not recorded
+        self.undone.extend(self.changes)
+        self.changes = []
+        return True
+
+    def revision(self):
+        return self.undo_store.revision()
+
+    def reset_undo(self):
+        self.undo_store.reset()
+
+    def describe_changes(self, changes):
+        '''
+        Describe the outcome of the given changes compactly, for clients
+        to patch their copy of the document with:
+        {"revision": document revision after the changes,
+         "added": [{"parent", "before", "element": render entry}, ...],
+         "moved": [{"id", "parent", "before"}, ...],
+         "removed": [id, ...],
+         "changed": [render entry without children, ...]}
+        "before" is the id of the next sibling, or None for the last child.
+        Zones are included like any other element; the elements using
+        a changed zone are reported as changed, with their new box.
+        Elements within an added element come with it, and are not
+        reported again.
+        '''
+
+        added = []
+        removed = []
+        changed = []
+        for change in changes:
+            if change[0] == "add":
+                added.append(change[2])
+            elif change[0] == "remove":
+                removed.append(change[3][1])
+            else:
+                changed.append(change[1])
+
+        delta = {"revision": self.revision(), "added": [], "moved": [], "removed": [], "changed": []}
+        reported = set()
+
+        was_added = set(added)
+        was_removed = set(removed)
+        fresh = set(id for id in was_added - was_removed if self.get_element(id) is not None)
+        for id in unique(added + removed):
+            element = self.get_element(id)
+            if element is None:
+                if id not in was_added:
+                    delta["removed"].append(id)
+                continue
+            if within(element, fresh):
+                continue
+
+            parent, before = self.position(element)
+            if id in was_removed:
+                delta["moved"].append({"id": id, "parent": parent, "before": before})
+            else:
+                delta["added"].append({"parent": parent, "before": before, "element": self.render_element(element)})
+                reported.add(id)
+
+        for id in unique(changed):
+            element = self.get_element(id)
+            if element is None:
+                continue
+            elements = [element]
+            if element.getName() == "zone":
+                elements.extend(self.get_element(ref) for ref in self.zone_refs.get(id, ()))
+            for e in elements:
+                if e is not None and e.getId() not in reported and not within(e, fresh):
+                    entry = self.render_element(e)
+                    entry.pop("children", None)
+                    delta["changed"].append(entry)
+                    reported.add(e.getId())
+
+        return delta
+
+    def position(self, element):
+        '''
+        (parent id, next sibling id or None) of an element.
+        '''
+
+        parent = element.getParent()
+        ids = [c.getId() for c in parent.getChildren()]
+        index = ids.index(element.getId())
+        if index + 1 < len(ids):
+            return parent.getId(), ids[index + 1]
+        return parent.getId(), None
+
+    def get_element(self, id):
+        '''
+        The element of the document with the given id, or None.
+        '''
+
+        return self.elements.get(id)
+
+    def get_elements_by_name(self, name):
+        '''
+        The elements of the document with the given name, in document
+        order. The list is kept until an element of that name is added
+        or removed, so e.g. the surface and the last layer are found
+        without walking the tree on every edit.
+        '''
+
+        if name not in self.by_name:
+            self.by_name[name] = list(self.mei.getElementsByName(name))
+        return self.by_name[name]
+
+    def section_staves(self, section):
+        '''
+        The staves of a section in order, and the position of each by
+        id. The table of a section is only rebuilt after one of its own
+        staves was added or removed.
+        '''
+
+        table = self.staff_tables.get(section.getId())
+        if table is None:
+            staves = list(section.getChildrenByName("staff"))
+            table = (staves, dict((s.getId(), i) for i, s in enumerate(staves)))
+            self.staff_tables[section.getId()] = table
+        return table
+
+    def renumber_staves(self):
+        '''
+        Number the staves of the sections and the staff definitions of
+        the staff groups that changed since the last write, in order.
+        The numbers follow from the tree, so this is not recorded as a
+        change.
+        '''
+
+        for parent_id in self.unnumbered:
+            parent = self.get_element(parent_id)
+            if parent is None:
+                continue
+            for name in ("staff", "staffDef"):
+                for i, element in enumerate(parent.getChildrenByName(name)):
+                    if attribute_value(element, "n") != str(i+1):
+                        element.addAttribute("n", str(i+1))
+                        self.touched(element)
+
+        self.unnumbered = set()
+
+    def get_zone(self, element):
+        '''
+        The zone referenced by the facs attribute of the element, or None.
+        '''
+
+        zone = self.get_element(self.facs.get(element.getId()))
+        if zone and zone.getName() == "zone":
+            return zone
+        return None
+
+    def elements_in_region(self, ulx, uly, lrx, lry, inside=False):
+        '''
+        The elements whose zone overlaps the given region, or lies
+        inside it if inside is True, as [{id, type, ulx, uly, lrx, lry}].
+        '''
+
+        if self.spatial is None:
+            self.spatial = GridIndex()
+            self.moved_zones = set(self.zone_refs)
+        for id in self.moved_zones:
+            box = zone_box(self.get_element(id))
+            if box is None:
+                self.spatial.remove(id)
+            else:
+                self.spatial.insert(id, box)
+        self.moved_zones = set()
+
+        region = (min(ulx, lrx), min(uly, lry), max(ulx, lrx), max(uly, lry))
+        elements = []
+        for zone_id in self.spatial.query(region, inside):
+            box = self.spatial.boxes[zone_id]
+            for id in self.zone_refs.get(zone_id, ()):
+                elements.append({
+                    "id": id,
+                    "type": self.get_element(id).getName(),
+                    "ulx": box[0],
+                    "uly": box[1],
+                    "lrx": box[2],
+                    "lry": box[3]
+                })
+
+        return elements
+
+    def render_model(self):
+        '''
+        The page as the editor draws it: its systems in order, each with
+        its elements in order, every element with its attributes and its
+        bounding box joined in from its zone:
+        {"systems": [{"id", "n", "box", "elements": [
+            {"id", "type", "attrs", "box", "children": [...]}, ...]}, ...]}
+        Only the elements touched since the last call are rendered again.
+        '''
+
+        if self.model is not None:
+            return self.model
+
+        systems = []
+        for layer in self.get_elements_by_name("layer"):
+            for element in layer.getChildren():
+                if element.getName() == "sb":
+                    system = self.get_element(attribute_value(element, "systemref"))
+                    systems.append({
+                        "id": system and system.getId(),
+                        "n": attribute_value(element, "n"),
+                        "box": system and zone_box(self.get_zone(system)),
+                        "elements": []
+                    })
+                    continue
+
+                if not systems:
+                    # elements before the first system break
+                    systems.append({"id": None, "n": None, "box": None, "elements": []})
+
+                id = element.getId()
+                if id not in self.rendered:
+                    self.rendered[id] = self.render_element(element)
+                systems[-1]["elements"].append(self.rendered[id])
+
+        self.model = {"systems": systems}
+        return self.model
+
+    def render_element(self, element):
+        entry = {
+            "id": element.getId(),
+            "type": element.getName(),
+            "attrs": dict((a.getName(), a.getValue()) for a in element.getAttributes() if a.getName() != "facs"),
+            "box": zone_box(self.get_zone(element))
+        }
+        children = [self.render_element(c) for c in element.getChildren()]
+        if children:
+            entry["children"] = children
+
+        return entry
+
+    def orphaned_zones(self):
+        '''
+        Ids of the zones no element references.
+        '''
+
+        return [id for id, refs in self.zone_refs.items() if not refs and id in self.elements]
+
+    def check_index(self):
+        '''
+        Raise an AssertionError if the element index or the zone table
+        does not match the document tree.
+        '''
+
+        ids = set()
+        facs = {}
+        stack = [self.mei.getRootElement()]
+        while stack:
+            element = stack.pop()
+            ids.add(element.getId())
+            if element.hasAttribute("facs"):
+                facs[element.getId()] = element.getAttribute("facs").getValue()
+            stack.extend(element.getChildren())
+
+        if ids != set(self.elements):
+            raise AssertionError("element index out of date: missing %s, stale %s"
+                                 % (sorted(ids - set(self.elements)), sorted(set(self.elements) - ids)))
+        if facs != self.facs:
+            raise AssertionError("zone table out of date")
 
     def insert_punctum(self, name, inclinatum, deminutus, before_id, pname, oct, dot_form, episema_form, ulx, uly, lrx, lry):
         '''
@@ -97,17 +444,17 @@ class ModifyDocument:
         # perform the insertion
         if before_id is None:
             # get last layer
-            layers = self.mei.getElementsByName("layer")
+            layers = self.get_elements_by_name("layer")
             if len(layers):
-                layers[-1].addChild(punctum)
+                self.add_child(layers[-1], punctum)
         else:
-            before = self.mei.getElementById(str(before_id))
+            before = self.get_element(str(before_id))
 
             # get layer element
             parent = before.getParent()
 
             if parent and before:
-                parent.addChildBefore(before, punctum)
+                self.add_child_before(parent, before, punctum)
 
         # get the generated ID for the client
         result = {"id": punctum.getId()}
@@ -120,47 +467,47 @@ class ModifyDocument:
         If the neume moves position relative to other elements, re-insert
         the neume before a given MeiElement.
         '''
-        neume = self.mei.getElementById(id)
+        neume = self.get_element(id)
 
         # if the neume moves vertically, perform a pitch shift
         if pitch_info is not None:
             notes = neume.getDescendantsByName("note")
             if len(notes):
                 for n, pinfo in zip(notes, pitch_info):
-                    n.addAttribute("pname", str(pinfo["pname"]))
-                    n.addAttribute("oct", str(pinfo["oct"]))
+                    self.set_attribute(n, "pname", str(pinfo["pname"]))
+                    self.set_attribute(n, "oct", str(pinfo["oct"]))
 
         # update the position of the neume in the document
         # first, remove the neume
         parent = neume.getParent()
-        parent.removeChild(neume)
+        self.remove_child(parent, neume)
 
         # re-insert in the correct position
         if before_id is None:
             # get last layer
-            layers = self.mei.getElementsByName("layer")
+            layers = self.get_elements_by_name("layer")
             if len(layers):
-                layers[-1].addChild(neume)
+                self.add_child(layers[-1], neume)
         else:
-            before = self.mei.getElementById(before_id)
+            before = self.get_element(before_id)
 
             # get layer element
             parent = before.getParent()
 
             if parent and before:
-                parent.addChildBefore(before, neume)
+                self.add_child_before(parent, before, neume)
 
         self.update_or_add_zone(neume, ulx, uly, lrx, lry)
 
     def delete_neume(self, ids):
         for id in ids:
-            element = self.mei.getElementById(id)
+            element = self.get_element(id)
             
             # remove the bounding box attached to this element
             self.remove_zone(element)
             
             # remove the element
-            element.getParent().removeChild(element)
+            self.remove_child(element.getParent(), element)
 
     def update_neume_head_shape(self, id, shape, ulx, uly, lrx, lry):
         """
@@ -169,45 +516,45 @@ class ModifyDocument:
         Update neume name, if the new head shape changes the name.
         """
 
-        neume = self.mei.getElementById(id)
+        neume = self.get_element(id)
         
         nc = neume.getChildrenByName("nc")[0]
 
         if shape == "punctum":
             neume_name = "punctum"
-            nc.setAttributes([])
+            self.set_attributes(nc, [])
         elif shape == "punctum_inclinatum":
             neume_name = "punctum"
             attrs = [MeiAttribute("inclinatum", "true")]
-            nc.setAttributes(attrs)
+            self.set_attributes(nc, attrs)
         elif shape == "punctum_inclinatum_parvum":
             neume_name = "punctum"
             attrs = [MeiAttribute("inclinatum", "true"), MeiAttribute("deminutus", "true")];
-            nc.setAttributes(attrs)
+            self.set_attributes(nc, attrs)
         elif shape == "quilisma":
             neume_name = "punctum"
             attrs = [MeiAttribute("quilisma", "true")]
-            nc.setAttributes(attrs)
+            self.set_attributes(nc, attrs)
         elif shape == "virga":
             neume_name = "virga"
-            nc.setAttributes([])
+            self.set_attributes(nc, [])
         elif shape == "cavum":
             neume_name = "cavum"
-            nc.setAttributes([])
+            self.set_attributes(nc, [])
         elif shape == "tractulus":
             neume_name = "tractulus"
-            nc.setAttributes([])
+            self.set_attributes(nc, [])
         elif shape == "gravis":
             neume_name = "gravis"
-            nc.setAttributes([])
+            self.set_attributes(nc, [])
         elif shape == "oriscus":
             neume_name = "oriscus"
-            nc.setAttributes([])
+            self.set_attributes(nc, [])
         elif shape == "stropha":
             neume_name = "stropha"
-            nc.setAttributes([])
+            self.set_attributes(nc, [])
 
-        neume.addAttribute("name", neume_name)
+        self.set_attribute(neume, "name", neume_name)
 
         self.update_or_add_zone(neume, ulx, uly, lrx, lry)
         
@@ -247,7 +594,7 @@ class ModifyDocument:
 
         iNote = 0
         for id in ids:
-            ref_neume = self.mei.getElementById(str(id))
+            ref_neume = self.get_element(str(id))
             if ref_neume:
                 # get underlying notes
                 notes = ref_neume.getDescendantsByName("note")
@@ -277,33 +624,30 @@ class ModifyDocument:
                         ncs.append(MeiElement("nc"))
                         cur_nc = 'punctum'
 
+                    # detach the note through remove_child, so that an undo
+                    # restores it in its old place and keeps it indexed
+                    self.remove_child(n.getParent(), n)
                     ncs[-1].addChild(n)
                     iNote += 1
 
         new_neume.setChildren(ncs)
 
         # insert the new neume
-        before = self.mei.getElementById(ids[0])
+        before = self.get_element(ids[0])
         parent = before.getParent()
 
         if before and parent:
-            parent.addChildBefore(before, new_neume)
+            self.add_child_before(parent, before, new_neume)
 
         # remove the old neumes from the mei document
         for id in ids:
-            neume = self.mei.getElementById(str(id))
+            neume = self.get_element(str(id))
             if neume:
                 # remove facs data
-                facs = neume.getAttribute("facs")
-                if facs:
-                    facsid = facs.value
-                    # Remove the zone if it exists
-                    zone = self.mei.getElementById(str(facsid))
-                    if zone and zone.name == "zone":
-                        zone.parent.removeChild(zone)
+                self.remove_zone(neume)
 
                 # now remove the neume
-                neume.parent.removeChild(neume)
+                self.remove_child(neume.parent, neume)
 
         # update bounding box data
         self.update_or_add_zone(new_neume, ulx, uly, lrx, lry)
@@ -319,7 +663,7 @@ class ModifyDocument:
 
         newids = []
         for id, bbox in zip(ids, bboxes):
-            ref_neume = self.mei.getElementById(id)
+            ref_neume = self.get_element(id)
             parent = ref_neume.getParent()
 
             # get underlying notes
@@ -329,6 +673,8 @@ class ModifyDocument:
                 punctum = MeiElement("neume")
                 punctum.addAttribute("name", "punctum")
                 nc = MeiElement("nc")
+                # detached like in neumify
+                self.remove_child(n.getParent(), n)
                 nc.addChild(n)
                 punctum.addChild(nc)
 
@@ -339,18 +685,18 @@ class ModifyDocument:
                 self.update_or_add_zone(punctum, str(bb["ulx"]), str(bb["uly"]), str(bb["lrx"]), str(bb["lry"]))
 
                 # insert the punctum before the reference neume
-                parent.addChildBefore(ref_neume, punctum)
+                self.add_child_before(parent, ref_neume, punctum)
 
             newids.append(nids)
 
             # delete the old neume
-            neume = self.mei.getElementById(id)
+            neume = self.get_element(id)
             if neume:
                 # remove bounding box information
                 self.remove_zone(neume)
 
                 # now remove the neume
-                neume.getParent().removeChild(neume)
+                self.remove_child(neume.getParent(), neume)
         
         result = {"nids": newids}
         return result
@@ -369,16 +715,16 @@ class ModifyDocument:
         self.update_or_add_zone(division, ulx, uly, lrx, lry)
 
         if (before_id is None):
-            layers = self.mei.getElementsByName("layer")
+            layers = self.get_elements_by_name("layer")
             if len(layers):
-                layers[-1].addChild(division)
+                self.add_child(layers[-1], division)
         else:
-            before = self.mei.getElementById(str(before_id))
+            before = self.get_element(str(before_id))
             # get layer element
             layer = before.getParent()
 
             if layer and before:
-                layer.addChildBefore(before, division)
+                self.add_child_before(layer, before, division)
 
                 if type == "final":
                     # if final division, close layer and staff
@@ -394,32 +740,27 @@ class ModifyDocument:
                     element_peers = before.getPeers()
                     e_ind = list(element_peers).index(before)
                     for e in element_peers[e_ind:]:
+                        # remove element from the current staff/layer
+                        self.remove_child(layer, e)
                         # add element to the new staff/layer
                         new_layer.addChild(e)
-                        # remove element from the current staff/layer
-                        layer.removeChild(e)
 
+                    staves, ordinals = self.section_staves(section_parent)
+                    s_ind = ordinals[staff.getId()]
                     new_staff.addChild(new_layer)
+                    new_staff.addAttribute("n", str(s_ind+2))
 
-                    # insert new staff into the document
-                    staves = section_parent.getChildrenByName("staff")
-                    s_ind = list(staves).index(staff)
+                    # insert new staff into the document, the following
+                    # staves are renumbered when the document is written
                     if s_ind+1 < len(staves):
                         # there are staff elements after the new staff to insert
                         before_staff = staves[s_ind+1]
-
-                        # update staff numbers staves
-                        for i, s in enumerate(staves[s_ind+1:]):
-                            s.addAttribute("n", str(s_ind+i+3))
-
-                        section_parent.addChildBefore(before_staff, new_staff)
+                        self.add_child_before(section_parent, before_staff, new_staff)
                     else:
-                        section_parent.addChild(new_staff)
-
-                    new_staff.addAttribute("n", str(s_ind+2))
+                        self.add_child(section_parent, new_staff)
 
                     # insert and update staff definitions
-                    staff_group = self.mei.getElementsByName("staffGrp")
+                    staff_group = self.get_elements_by_name("staffGrp")
                     if len(staff_group):
                         staff_defs = staff_group[0].getChildrenByName("staffDef")
                         if len(staff_defs) == len(staves):
@@ -427,14 +768,9 @@ class ModifyDocument:
                             staff_def.addAttribute("n", str(s_ind+2))
                             if s_ind+1 < len(staff_defs):
                                 before_staff_def = staff_defs[s_ind+1]
-
-                                # update staff number for all following staff defs
-                                for i, sd in enumerate(staff_defs[s_ind+1:]):
-                                    sd.addAttribute("n", str(s_ind+i+3))
-
-                                staff_group[0].addChildBefore(before_staff_def, staff_def)
+                                self.add_child_before(staff_group[0], before_staff_def, staff_def)
                             else:
-                                staff_group[0].addChild(staff_def)
+                                self.add_child(staff_group[0], staff_def)
 
         result = {"id": division.getId()}
         return result
@@ -449,7 +785,7 @@ class ModifyDocument:
         comes from final divisions, where elements have to be shifted.
         '''
 
-        division = self.mei.getElementById(id)
+        division = self.get_element(id)
         self.update_or_add_zone(division, ulx, uly, lrx, lry)
 
         # move the position of the division in the document
@@ -463,8 +799,8 @@ class ModifyDocument:
             # if final division, close layer and staff
             staff = layer.getParent()
             section = staff.getParent()
-            staves = section.getChildrenByName("staff")
-            s_ind = list(staves).index(staff)
+            staves, ordinals = self.section_staves(section)
+            s_ind = ordinals[staff.getId()]
 
             if s_ind+1 < len(staves):
                 next_staff = staves[s_ind+1]
@@ -474,20 +810,20 @@ class ModifyDocument:
                     next_staff_elements = next_staff_layer[0].getChildren()
 
                     # remove the next staff/layer from the MEI document
-                    section.removeChild(next_staff)
+                    self.remove_child(section, next_staff)
 
                     for e in next_staff_elements:
-                        layer.addChild(e)
+                        self.add_child(layer, e)
 
         # remove the division from the document
-        layer.removeChild(division)
+        self.remove_child(layer, division)
         
-        before = self.mei.getElementById(before_id)
+        before = self.get_element(before_id)
         # get layer element
         layer_before = before.getParent()
 
         if layer_before and before:
-            layer_before.addChildBefore(before, division)
+            self.add_child_before(layer_before, before, division)
 
             if final_division:
                 # if final division, close layer and staff
@@ -503,29 +839,24 @@ class ModifyDocument:
                 element_peers = before.getPeers()
                 e_ind = list(element_peers).index(before)
                 for e in element_peers[e_ind:]:
+                    # remove element from the current staff/layer
+                    self.remove_child(layer_before, e)
                     # add element to the new staff/layer
                     new_layer.addChild(e)
-                    # remove element from the current staff/layer
-                    layer.removeChild(e)
 
+                staves, ordinals = self.section_staves(section)
+                s_ind = ordinals[staff.getId()]
                 new_staff.addChild(new_layer)
+                new_staff.addAttribute("n", str(s_ind+2))
 
-                # insert new staff into the document
-                staves = section.getChildrenByName("staff")
-                s_ind = list(staves).index(staff)
+                # insert new staff into the document, the following
+                # staves are renumbered when the document is written
                 if s_ind+1 < len(staves):
                     # there are staff elements after the new staff to insert
                     before_staff = staves[s_ind+1]
-
-                    # update staff numbers staves
-                    for i, s in enumerate(staves[s_ind+1:]):
-                        s.addAttribute("n", str(s_ind+i+3))
-
-                    section.addChildBefore(before_staff, new_staff)
+                    self.add_child_before(section, before_staff, new_staff)
                 else:
-                    section.addChild(new_staff)
-
-                new_staff.addAttribute("n", str(s_ind+2))
+                    self.add_child(section, new_staff)
 
     def delete_division(self, ids):
         '''
@@ -535,7 +866,7 @@ class ModifyDocument:
         '''
 
         for id in ids:
-            division = self.mei.getElementById(id)
+            division = self.get_element(id)
             self.remove_zone(division)
 
             if division.getAttribute("form").getValue() == "final":
@@ -543,8 +874,8 @@ class ModifyDocument:
                 staff = layer.getParent()
                 section = staff.getParent()
 
-                staves = section.getChildrenByName("staff")
-                s_ind = list(staves).index(staff)
+                staves, ordinals = self.section_staves(section)
+                s_ind = ordinals[staff.getId()]
 
                 # get elements from next staff/layer, if any
                 # and move them to the previous staff/layer
@@ -554,29 +885,23 @@ class ModifyDocument:
                         elements = next_layer[0].getChildren()
 
                         # remove the next staff/layer
-                        section.removeChild(staves[s_ind+1])
+                        self.remove_child(section, staves[s_ind+1])
 
                         # add these elements to the previous staff/layer
                         for e in elements:
-                            layer.addChild(e)
+                            self.add_child(layer, e)
 
                         # remove the staffDef for the removed layer
-                        staff_group = self.mei.getElementsByName("staffGrp")
+                        staff_group = self.get_elements_by_name("staffGrp")
                         if len(staff_group):
                             staff_defs = staff_group[0].getChildrenByName("staffDef")
                             if len(staff_defs) == len(staves):
-                                # renumber subsequent staff defs
-                                for i, sd in enumerate(staff_defs[s_ind+2:]):
-                                    sd.addAttribute("n", str(s_ind+i+2))
-
-                                staff_group[0].removeChild(staff_defs[s_ind+1])
-
-                        # renumber subsequent staves
-                        for i, s in enumerate(staves[s_ind+2:]):
-                            s.addAttribute("n", str(s_ind+i+2))
+                                # subsequent staff defs and staves are
+                                # renumbered when the document is written
+                                self.remove_child(staff_group[0], staff_defs[s_ind+1])
 
             # delete the division
-            division.getParent().removeChild(division)
+            self.remove_child(division.getParent(), division)
 
     def update_division_shape(self, id, type, ulx, uly, lrx, lry):
         '''
@@ -585,7 +910,7 @@ class ModifyDocument:
         different shapes.
         '''
 
-        division = self.mei.getElementById(id)
+        division = self.get_element(id)
 
         # update division shape, changing the type to the proper mei form
         if type == "div_small":
@@ -597,7 +922,7 @@ class ModifyDocument:
         elif type == "div_final":
             div_type = "final"
 
-        division.addAttribute("form", div_type)
+        self.set_attribute(division, "form", div_type)
 
         self.update_or_add_zone(division, ulx, uly, lrx, lry)
 
@@ -607,7 +932,7 @@ class ModifyDocument:
         Add a episema ornament to a given element.
         '''
 
-        punctum = self.mei.getElementById(id)
+        punctum = self.get_element(id)
         # check that a neume with one note is given
         notes = punctum.getDescendantsByName("note")
         if punctum.getName() == "neume" and len(notes) == 1:
@@ -616,7 +941,7 @@ class ModifyDocument:
                 if len(notes[0].getChildrenByName("episema")) == 0:
                     episema = MeiElement("episema")
                     episema.addAttribute("form", form)
-                    notes[0].addChild(episema)
+                    self.add_child(notes[0], episema)
 
             self.update_or_add_zone(punctum, ulx, uly, lrx, lry)
 
@@ -625,7 +950,7 @@ class ModifyDocument:
         Remove a episema ornament to a given element.
         '''
 
-        punctum = self.mei.getElementById(id)
+        punctum = self.get_element(id)
         # check that a punctum element was provided
         if punctum.getName() == "neume":
             note = punctum.getDescendantsByName("note")
@@ -633,7 +958,7 @@ class ModifyDocument:
                 episema = note[0].getChildrenByName("episema")
                 # if a episema exists
                 if len(episema) == 1:
-                    note[0].removeChild(episema[0])
+                    self.remove_child(note[0], episema[0])
 
             self.update_or_add_zone(punctum, ulx, uly, lrx, lry)
 
@@ -642,7 +967,7 @@ class ModifyDocument:
         Add a dot ornament to a given element.
         '''
 
-        punctum = self.mei.getElementById(id)
+        punctum = self.get_element(id)
         # check that a neume with one note is given
         notes = punctum.getDescendantsByName("note")
         if punctum.getName() == "neume" and len(notes) == 1:
@@ -651,7 +976,7 @@ class ModifyDocument:
                 if len(notes[0].getChildrenByName("dot")) == 0:
                     dot = MeiElement("dot")
                     dot.addAttribute("form", form)
-                    notes[0].addChild(dot)
+                    self.add_child(notes[0], dot)
 
             self.update_or_add_zone(punctum, ulx, uly, lrx, lry)
 
@@ -660,7 +985,7 @@ class ModifyDocument:
         Remove a dot ornament to a given element.
         '''
 
-        punctum = self.mei.getElementById(id)
+        punctum = self.get_element(id)
         # check that a punctum element was provided
         if punctum.getName() == "neume":
             note = punctum.getDescendantsByName("note")
@@ -668,7 +993,7 @@ class ModifyDocument:
                 dot = note[0].getChildrenByName("dot")
                 # if a dot exists
                 if len(dot) == 1:
-                    note[0].removeChild(dot[0])
+                    self.remove_child(note[0], dot[0])
 
             self.update_or_add_zone(punctum, ulx, uly, lrx, lry)
 
@@ -682,23 +1007,26 @@ class ModifyDocument:
         clef = MeiElement("clef")
         clef.addAttribute("shape", shape)
         clef.addAttribute("line", line)
+        new_clef = clef_info(clef)
 
         # perform clef insertion
         if before_id is None:
             # get last layer
-            layers = self.mei.getElementsByName("layer")
+            layers = self.get_elements_by_name("layer")
             if len(layers):
-                layers[-1].addChild(clef)
+                self.add_child(layers[-1], clef)
         else:
-            before = self.mei.getElementById(str(before_id))
+            before = self.get_element(str(before_id))
             parent = before.getParent()
 
             if parent and before:
-                parent.addChildBefore(before, clef)
+                self.add_child_before(parent, before, clef)
 
         self.update_or_add_zone(clef, ulx, uly, lrx, lry)
-        if pitch_info:
-            self.update_pitched_elements(pitch_info)
+
+        # the following neumes were read with the previous clef
+        previous, governed = self.clef_context(clef)
+        self.apply_pitch_info(pitch_info, governed, clef_info(previous), new_clef)
 
         result = {"id": clef.getId()}
         return result
@@ -711,13 +1039,14 @@ class ModifyDocument:
         octave) of all pitched elements on the affected staff.
         '''
 
-        clef = self.mei.getElementById(id)
+        clef = self.get_element(id)
+        old_clef = clef_info(clef)
 
         # update staff line the clef is on
-        clef.addAttribute("line", line)
+        self.set_attribute(clef, "line", line)
 
         self.update_or_add_zone(clef, ulx, uly, lrx, lry)
-        self.update_pitched_elements(pitch_info)
+        self.apply_pitch_info(pitch_info, self.clef_context(clef)[1], old_clef, clef_info(clef))
 
     def update_clef_shape(self, id, shape, pitch_info, ulx, uly, lrx, lry):
         '''
@@ -727,13 +1056,14 @@ class ModifyDocument:
         affected staff to correspond with the new clef shape.
         '''
 
-        clef = self.mei.getElementById(id)
+        clef = self.get_element(id)
+        old_clef = clef_info(clef)
 
         # update clef shape
-        clef.addAttribute("shape", shape.upper())
+        self.set_attribute(clef, "shape", shape.upper())
 
         self.update_or_add_zone(clef, ulx, uly, lrx, lry)
-        self.update_pitched_elements(pitch_info)
+        self.apply_pitch_info(pitch_info, self.clef_context(clef)[1], old_clef, clef_info(clef))
 
     def delete_clef(self, clef_data):
         '''
@@ -741,18 +1071,21 @@ class ModifyDocument:
         Must also update pitched elements on the staff
         that are affected by the deletion of this clef
         element.
-        clef_data: [{id, pitch_info}, ...]
+        clef_data: [{id, pitchInfo}, ...], pitchInfo may be left out
+        to have the pitches recomputed (see apply_pitch_info).
         '''
 
         for c in clef_data:
-            clef = self.mei.getElementById(str(c["id"]))
+            clef = self.get_element(str(c["id"]))
+            # the following neumes are now read with the previous clef
+            previous, governed = self.clef_context(clef)
+
             # remove the clef bounding box
             self.remove_zone(clef)
             # remove the clef
-            clef.getParent().removeChild(clef)
+            self.remove_child(clef.getParent(), clef)
 
-            if c["pitchInfo"] is not None:
-                self.update_pitched_elements(c["pitchInfo"])
+            self.apply_pitch_info(c.get("pitchInfo", AUTO_PITCH), governed, clef_info(clef), clef_info(previous))
 
     def insert_custos(self, pname, oct, before_id, ulx, uly, lrx, lry):
         '''
@@ -769,15 +1102,15 @@ class ModifyDocument:
         # insert the custos
         if before_id is None:
             # get last layer
-            layers = self.mei.getElementsByName("layer")
+            layers = self.get_elements_by_name("layer")
             if len(layers):
-                layers[-1].addChild(custos)
+                self.add_child(layers[-1], custos)
         else:
-            before = self.mei.getElementById(str(before_id))
+            before = self.get_element(str(before_id))
             parent = before.getParent()
 
             if parent and before:
-                parent.addChildBefore(before, custos)
+                self.add_child_before(parent, before, custos)
 
         # update the bounding box
         self.update_or_add_zone(custos, ulx, uly, lrx, lry)
@@ -794,8 +1127,8 @@ class ModifyDocument:
         system = MeiElement("system")
 
         # add system to page
-        page = self.mei.getElementById(page_id)
-        page.addChild(system)
+        page = self.get_element(page_id)
+        self.add_child(page, system)
 
         # update system bounding box
         self.update_or_add_zone(system, ulx, uly, lrx, lry)
@@ -816,14 +1149,14 @@ class ModifyDocument:
 
         # Perform insertion.  If we have no next reference, just add to last layer.
         if next_sb_id is None:
-            layers = self.mei.getElementsByName("layer")
+            layers = self.get_elements_by_name("layer")
             if len(layers):
-                layers[-1].addChild(sb)
+                self.add_child(layers[-1], sb)
         else:
-            next_sb = self.mei.getElementById(str(next_sb_id))
+            next_sb = self.get_element(str(next_sb_id))
             parent = next_sb.getParent()
             if parent and next_sb:
-                parent.addChildBefore(next_sb, sb)
+                self.add_child_before(parent, next_sb, sb)
 
         result = {"id": sb.getId()}
         return result
@@ -834,8 +1167,8 @@ class ModifyDocument:
         '''
 
         # modify system
-        sb = self.mei.getElementById(sb_id)
-        sb.addAttribute("n", order_number)
+        sb = self.get_element(sb_id)
+        self.set_attribute(sb, "n", order_number)
 
         result = {"id": sb_id}
         return result
@@ -847,11 +1180,11 @@ class ModifyDocument:
         '''
 
         for id in ids:
-            system = self.mei.getElementById(id)
+            system = self.get_element(id)
             # remove the bounding box data
             self.remove_zone(system)
             # remove the system from the document
-            system.getParent().removeChild(system)
+            self.remove_child(system.getParent(), system)
 
     def delete_system_break(self, ids):
         '''
@@ -859,9 +1192,9 @@ class ModifyDocument:
         '''
         
         for id in ids:
-            sb = self.mei.getElementById(id)
+            sb = self.get_element(id)
             # remove the system from the document
-            sb.getParent().removeChild(sb)
+            self.remove_child(sb.getParent(), sb)
 
     def update_system_zone(self, system_id, ulx, uly, lrx, lry):
         '''
@@ -869,7 +1202,7 @@ class ModifyDocument:
         '''
 
         # modify system
-        system = self.mei.getElementById(system_id)
+        system = self.get_element(system_id)
         if system:
             self.update_or_add_zone(system, ulx, uly, lrx, lry)
 
@@ -879,10 +1212,10 @@ class ModifyDocument:
         Also update the bounding box information.
         '''
 
-        custos = self.mei.getElementById(id)
+        custos = self.get_element(id)
         if pname and oct:
-            custos.addAttribute("pname", str(pname))
-            custos.addAttribute("oct", str(oct))
+            self.set_attribute(custos, "pname", str(pname))
+            self.set_attribute(custos, "oct", str(oct))
 
         self.update_or_add_zone(custos, ulx, uly, lrx, lry)
 
@@ -893,11 +1226,11 @@ class ModifyDocument:
         '''
 
         for id in ids:
-            custos = self.mei.getElementById(id)
+            custos = self.get_element(id)
             # remove the bounding box data
             self.remove_zone(custos)
             # remove the custos from the document
-            custos.getParent().removeChild(custos)
+            self.remove_child(custos.getParent(), custos)
 
     # HELPER FUNCTIONS
     def update_or_add_zone(self, element, ulx, uly, lrx, lry):
@@ -905,20 +1238,22 @@ class ModifyDocument:
         Update the bounding box information attached to an element
         '''
 
-        facsid = element.getAttribute("facs")
-        if facsid:
-            zone = self.mei.getElementById(facsid.getValue())
+        zone = self.get_zone(element)
+        if zone:
+            self.set_attribute(zone, "ulx", ulx)
+            self.set_attribute(zone, "uly", uly)
+            self.set_attribute(zone, "lrx", lrx)
+            self.set_attribute(zone, "lry", lry)
         else:
             zone = MeiElement("zone")
-            element.addAttribute("facs", zone.getId())
-            surfaces = self.mei.getElementsByName("surface")
+            zone.addAttribute("ulx", ulx)
+            zone.addAttribute("uly", uly)
+            zone.addAttribute("lrx", lrx)
+            zone.addAttribute("lry", lry)
+            self.set_attribute(element, "facs", zone.getId())
+            surfaces = self.get_elements_by_name("surface")
             if len(surfaces):
-                surfaces[0].addChild(zone)
-
-        zone.addAttribute("ulx", ulx)
-        zone.addAttribute("uly", uly)
-        zone.addAttribute("lrx", lrx)
-        zone.addAttribute("lry", lry)
+                self.add_child(surfaces[0], zone)
 
     def remove_zone(self, element):
         '''
@@ -926,19 +1261,370 @@ class ModifyDocument:
         from the document
         '''
 
-        facs_id = element.getAttribute("facs")
-        if facs_id:
-            zone = self.mei.getElementById(facs_id.getValue())
-            zone.getParent().removeChild(zone)
+        zone = self.get_zone(element)
+        if zone:
+            self.remove_child(zone.getParent(), zone)
+
+    def apply_pitch_info(self, pitch_info, governed, old_clef, new_clef):
+        '''
+        Update the pitches of the elements governed by a clef that changed
+        from old_clef to new_clef ((shape, line) pairs). pitch_info is
+        either the new pitches as computed by the client, None to leave
+        the pitches alone, or AUTO_PITCH to recompute them from the staff
+        positions of the notes, which don't move. Custodes keep their pitch,
+        and so do neumes that had or get no clef.
+        '''
+
+        if pitch_info is None:
+            return
+        if pitch_info != AUTO_PITCH:
+            self.update_pitched_elements(pitch_info)
+            return
+
+        if old_clef is None or new_clef is None:
+            return
+
+        notes = []
+        for element in governed:
+            if element.getName() == "neume":
+                notes.extend(n for n in element.getDescendantsByName("note")
+                             if n.hasAttribute("pname") and n.hasAttribute("oct"))
+
+        old = [(n.getAttribute("pname").getValue(), n.getAttribute("oct").getValue()) for n in notes]
+        new = pitch.reclef(old, old_clef, new_clef)
+        for n, (old_pname, old_oct), (pname, oct) in zip(notes, old, new):
+            if (old_pname, old_oct) != (pname, str(oct)):
+                self.set_attribute(n, "pname", pname)
+                self.set_attribute(n, "oct", str(oct))
+
+    def clef_context(self, clef):
+        '''
+        The clef acting before the given one on its system, if any, and
+        the elements the given clef governs: those following it up to the
+        next clef or system break.
+        '''
+
+        children = list(clef.getParent().getChildren())
+        index = [c.getId() for c in children].index(clef.getId())
+
+        previous = None
+        for element in reversed(children[:index]):
+            if element.getName() == "clef":
+                previous = element
+                break
+            if element.getName() == "sb":
+                break
+
+        governed = []
+        for element in children[index+1:]:
+            if element.getName() in ("clef", "sb"):
+                break
+            governed.append(element)
+
+        return previous, governed
 
     def update_pitched_elements(self, pitch_info):
         for ele in pitch_info:
-            pitched_ele = self.mei.getElementById(str(ele["id"]))
+            pitched_ele = self.get_element(str(ele["id"]))
             if pitched_ele.getName() == "custos":
-                pitched_ele.addAttribute("pname", str(ele["noteInfo"]["pname"]))
-                pitched_ele.addAttribute("oct", str(ele["noteInfo"]["oct"]))
+                self.set_attribute(pitched_ele, "pname", str(ele["noteInfo"]["pname"]))
+                self.set_attribute(pitched_ele, "oct", str(ele["noteInfo"]["oct"]))
             elif pitched_ele.getName() == "neume":
                 notes = pitched_ele.getDescendantsByName("note")
                 for n_info, n in zip(ele["noteInfo"], notes):
-                    n.addAttribute("pname", str(n_info["pname"]))
-                    n.addAttribute("oct", str(n_info["oct"]))
+                    self.set_attribute(n, "pname", str(n_info["pname"]))
+                    self.set_attribute(n, "oct", str(n_info["oct"]))
+
+    # TREE MUTATIONS
+    # All changes to elements attached to the document go through these,
+    # so that every edit leaves a list of changes it can be reverted with:
+    #   ["add", parent id, child id]
+    #   ["remove", parent id, index, element snapshot]
+    #   ["attr", element id, attribute name, previous value or None]
+    #   ["attrs", element id, previous [name, value] pairs]
+    # Elements that are not (yet) part of the document are modified directly.
+    # The element index is kept up to date along the way.
+    def add_child(self, parent, child):
+        parent.addChild(child)
+        if self.is_attached(parent):
+            self.changes.append(["add", parent.getId(), child.getId()])
+            self.index_element(child)
+            self.touched(parent)
+
+    def add_child_before(self, parent, before, child):
+        parent.addChildBefore(before, child)
+        if self.is_attached(parent):
+            self.changes.append(["add", parent.getId(), child.getId()])
+            self.index_element(child)
+            self.touched(parent)
+
+    def remove_child(self, parent, child):
+        if self.is_attached(parent):
+            index = [c.getId() for c in parent.getChildren()].index(child.getId())
+            self.changes.append(["remove", parent.getId(), index, snapshot_element(child)])
+            self.unindex_element(child)
+            self.touched(parent)
+            self.rendered.pop(child.getId(), None)
+        parent.removeChild(child)
+
+    def set_attribute(self, element, name, value):
+        '''
+        Set an attribute of the element, or remove it if value is None.
+        '''
+
+        if self.is_attached(element):
+            old = element.getAttribute(name)
+            if old:
+                old = old.getValue()
+            else:
+                old = None
+            self.changes.append(["attr", element.getId(), name, old])
+            self.touched(element)
+
+            if name == "facs":
+                self.link_zone(element.getId(), value)
+            elif element.getName() == "zone":
+                self.zone_moved(element.getId())
+
+        if value is None:
+            if element.hasAttribute(name):
+                element.removeAttribute(name)
+        else:
+            element.addAttribute(name, value)
+
+    def set_attributes(self, element, attrs):
+        if self.is_attached(element):
+            old = [[a.getName(), a.getValue()] for a in element.getAttributes()]
+            self.changes.append(["attrs", element.getId(), old])
+            self.touched(element)
+
+            facs = [a.getValue() for a in attrs if a.getName() == "facs"]
+            self.link_zone(element.getId(), (facs or [None])[0])
+            if element.getName() == "zone":
+                self.zone_moved(element.getId())
+
+        element.setAttributes(attrs)
+
+    def is_attached(self, element):
+        return element.getId() in self.elements
+
+    def index_element(self, element):
+        for e in subtree(element):
+            id = e.getId()
+            self.elements[id] = e
+            self.forget_named(e)
+
+            if e.getName() == "zone":
+                self.zone_refs.setdefault(id, set())
+                self.zone_moved(id)
+            facs = e.getAttribute("facs")
+            if facs:
+                self.link_zone(id, facs.getValue())
+
+    def unindex_element(self, element):
+        for e in subtree(element):
+            id = e.getId()
+            self.elements.pop(id, None)
+            self.forget_named(e)
+
+            self.link_zone(id, None)
+            if not self.zone_refs.get(id, True):
+                del self.zone_refs[id]
+            if e.getName() == "zone":
+                self.zone_moved(id)
+
+    def touched(self, element):
+        '''
+        Drop the render entries the change of the element affects: its
+        own and its ancestors', or those of the elements using it as zone.
+        '''
+
+        self.model = None
+
+        elements = [element]
+        if element.getName() == "zone":
+            elements.extend(self.get_element(id) for id in self.zone_refs.get(element.getId(), ()))
+
+        for e in elements:
+            while e is not None and self.rendered:
+                self.rendered.pop(e.getId(), None)
+                e = e.getParent()
+
+    def zone_moved(self, id):
+        if self.spatial is not None:
+            self.moved_zones.add(id)
+
+    def forget_named(self, element):
+        '''
+        Drop what is cached about the elements with the name of the
+        given element, after it was added or removed.
+        '''
+
+        name = element.getName()
+        self.by_name.pop(name, None)
+        if name in ("staff", "staffDef"):
+            parent = element.getParent()
+            if parent is not None:
+                self.staff_tables.pop(parent.getId(), None)
+                self.unnumbered.add(parent.getId())
+
+    def link_zone(self, id, zone_id):
+        '''
+        Record that the element with the given id references the given
+        zone, or no zone if zone_id is None.
+        '''
+
+        old = self.facs.pop(id, None)
+        if old is not None:
+            refs = self.zone_refs[old]
+            refs.discard(id)
+            if not refs and old not in self.elements:
+                del self.zone_refs[old]
+
+        if zone_id is not None:
+            self.facs[id] = zone_id
+            self.zone_refs.setdefault(zone_id, set()).add(id)
+
+    def revert_changes(self, changes):
+        '''
+        Apply the inverse of the given changes, newest first.
+        '''
+
+        for change in reversed(changes):
+            if change[0] == "add":
+                child = self.get_element(utf8(change[2]))
+                if child:
+                    self.remove_child(child.getParent(), child)
+            elif change[0] == "remove":
+                parent = self.get_element(utf8(change[1]))
+                child = build_element(change[3])
+                children = parent.getChildren()
+                if change[2] < len(children):
+                    self.add_child_before(parent, children[change[2]], child)
+                else:
+                    self.add_child(parent, child)
+            elif change[0] == "attr":
+                element = self.get_element(utf8(change[1]))
+                value = change[3]
+                if value is not None:
+                    value = utf8(value)
+                self.set_attribute(element, utf8(change[2]), value)
+            elif change[0] == "attrs":
+                element = self.get_element(utf8(change[1]))
+                self.set_attributes(element, [MeiAttribute(utf8(n), utf8(v)) for n, v in change[2]])
+
+def subtree(element):
+    '''
+    The element and its descendants. Children that were since added to
+    another parent (addChild does not detach them) belong to that parent
+    and are left out.
+    '''
+
+    elements = [element]
+    stack = [element]
+    while stack:
+        parent = stack.pop()
+        for child in parent.getChildren():
+            if is_child(parent, child):
+                elements.append(child)
+                stack.append(child)
+
+    return elements
+
+def unique(ids):
+    seen = set()
+    return [id for id in ids if not (id in seen or seen.add(id))]
+
+def attribute_value(element, name):
+    if element.hasAttribute(name):
+        return element.getAttribute(name).getValue()
+    return None
+
+def zone_box(zone):
+    '''
+    (ulx, uly, lrx, lry) of a zone element, or None if it has no
+    (valid) coordinates or is not a zone of the document.
+    '''
+
+    if not zone or zone.getName() != "zone":
+        return None
+    try:
+        box = tuple(float(zone.getAttribute(name).getValue()) for name in ("ulx", "uly", "lrx", "lry"))
+    except (AttributeError, ValueError):
+        return None
+    if not all(is_finite(x) for x in box):
+        return None
+    return box
+
+def within(element, ids):
+    '''
+    Whether one of the ancestors of the element has one of the given ids.
+    '''
+
+    parent = element.getParent()
+    while parent is not None:
+        if parent.getId() in ids:
+            return True
+        parent = parent.getParent()
+    return False
+
+def is_finite(x):
+    return not (math.isinf(x) or math.isnan(x))
+
+def clef_info(clef):
+    '''
+    (shape, line) of a clef element, or None.
+    '''
+
+    if clef is None:
+        return None
+    return (clef.getAttribute("shape").getValue(), clef.getAttribute("line").getValue())
+
+def is_child(parent, element):
+    child_parent = element.getParent()
+    return child_parent is not None and child_parent.getId() == parent.getId()
+
+def snapshot_element(element):
+    '''
+    Serialize an element and its descendants into nested lists:
+    [name, id, [[attribute name, value], ...], value, [children]]
+    '''
+
+    return [element.getName(),
+            element.getId(),
+            [[a.getName(), a.getValue()] for a in element.getAttributes()],
+            element.getValue(),
+            [snapshot_element(c) for c in element.getChildren()]]
+
+def build_element(snapshot):
+    '''
+    Recreate an element (keeping its id) from snapshot_element output.
+    '''
+
+    name, id, attrs, value, children = snapshot
+    element = MeiElement(utf8(name))
+    element.setId(utf8(id))
+    element.setAttributes([MeiAttribute(utf8(n), utf8(v)) for n, v in attrs])
+    if value:
+        element.setValue(utf8(value))
+    for c in children:
+        element.addChild(build_element(c))
+
+    return element
+
+def utf8(s):
+    # json hands back unicode; pymei expects utf-8 encoded str
+    if isinstance(s, unicode):
+        return s.encode("utf-8")
+    return s
+
+def utf8_all(data):
+    '''
+    utf8 applied throughout decoded json data.
+    '''
+
+    if isinstance(data, dict):
+        return dict((utf8(k), utf8_all(v)) for k, v in data.items())
+    elif isinstance(data, list):
+        return [utf8_all(v) for v in data]
+    return utf8(data)
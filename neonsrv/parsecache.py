@@ -0,0 +1,114 @@
+import hashlib
+import marshal
+import os
+import tempfile
+
+from pymei import MeiDocument, XmlImport, XmlExport
+
+from modifymei import snapshot_element, build_element
+
+# bumped whenever the layout of cache files changes
+FORMAT = 2
+
+def cache_path(path):
+    '''
+    The parse cache of the MEI file at path: a hidden file next to it.
+    '''
+
+    directory, name = os.path.split(path)
+    return os.path.join(directory, "." + name + ".parsed")
+
+def read(path):
+    '''
+    Parse the MEI file at path, like XmlImport.read. The tree is
+    rebuilt from the parse cache if the cache was made from the same
+    contents; otherwise the file is parsed and the cache made anew.
+
+    The cache holds the element tree as nested lists (see
+    snapshot_element) in marshal format, which loads without any XML
+    parsing and is checked against the MD5 of the MEI file. That keeps
+    only the elements with their ids, attributes and values, so a file
+    is only cached if the tree rebuilt from it writes out exactly like
+    the parsed one; saving a document loaded from the cache then never
+    rewrites what the cache leaves out (namespaces, XML declaration).
+    '''
+
+    fp = open(path, "rb")
+    digest = hashlib.md5(fp.read()).hexdigest()
+    fp.close()
+
+    snapshot = load(cache_path(path), digest)
+    if snapshot is not None:
+        return rebuild(snapshot)
+
+    doc = XmlImport.read(path)
+    snapshot = snapshot_element(doc.getRootElement())
+    contents = written(doc, path)
+    if contents is not None and contents == written(rebuild(snapshot), path):
+        store(cache_path(path), digest, snapshot)
+    return doc
+
+def invalidate(path):
+    try:
+        os.remove(cache_path(path))
+    except OSError:
+        pass
+
+# HELPER FUNCTIONS
+def rebuild(snapshot):
+    doc = MeiDocument()
+    doc.setRootElement(build_element(snapshot))
+    return doc
+
+def written(doc, path):
+    '''
+    The contents XmlExport writes for the document, by way of a
+    temporary file next to the MEI file at path; None if it can't.
+    '''
+
+    directory, name = os.path.split(path)
+    try:
+        fd, out = tempfile.mkstemp(prefix="." + name, dir=directory)
+        os.close(fd)
+        try:
+            XmlExport.write(doc, out)
+            fp = open(out, "rb")
+            try:
+                return fp.read()
+            finally:
+                fp.close()
+        finally:
+            os.remove(out)
+    except (IOError, OSError):
+        return None
+def load(cache, digest):
+    '''
+    The snapshot stored in the cache file, if it was made from
+    contents with the given digest.
+    '''
+
+    try:
+        fp = open(cache, "rb")
+        try:
+            format, cached_digest, snapshot = marshal.load(fp)
+        finally:
+            fp.close()
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+
+    if format != FORMAT or cached_digest != digest:
+        return None
+    return snapshot
+
+def store(cache, digest, snapshot):
+    # write aside and rename, so a reader never sees a torn file;
+    # a cache that can't be written is simply not used
+    try:
+        fp = open(cache + ".tmp", "wb")
+        try:
+            marshal.dump((FORMAT, digest, snapshot), fp)
+        finally:
+            fp.close()
+        os.rename(cache + ".tmp", cache)
+    except (IOError, OSError):
+        pass
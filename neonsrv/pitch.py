@@ -0,0 +1,48 @@
+'''
+Pitch arithmetic for square-note staves. A staff position counts lines
+and spaces upwards (one step per line or space), so it is only defined
+relative to a clef: a C clef puts c4 on its line, an F clef f3. Octaves
+change at c, as in MEI.
+
+All functions work on whole lists at once, so every pitched element
+governed by a clef is recomputed in one call.
+'''
+
+PITCH_NAMES = ["c", "d", "e", "f", "g", "a", "b"]
+CLEF_OCTAVES = {"c": 4, "f": 3}
+
+def clef_offset(shape, line):
+    '''
+    Diatonic step of staff position 0 under the given clef.
+    '''
+
+    shape = shape.lower()
+    return diatonic_step(shape, CLEF_OCTAVES[shape]) - 2 * int(line)
+
+def diatonic_step(pname, oct):
+    return int(oct) * 7 + PITCH_NAMES.index(pname.lower())
+
+def staff_positions(pitches, shape, line):
+    '''
+    Staff positions of the given (pname, oct) pairs under a clef.
+    '''
+
+    offset = clef_offset(shape, line)
+    return [diatonic_step(pname, oct) - offset for pname, oct in pitches]
+
+def pitches_at(positions, shape, line):
+    '''
+    (pname, oct) pairs at the given staff positions under a clef.
+    '''
+
+    offset = clef_offset(shape, line)
+    return [(PITCH_NAMES[(p + offset) % 7], (p + offset) // 7) for p in positions]
+
+def reclef(pitches, old_clef, new_clef):
+    '''
+    New (pname, oct) pairs of notes that keep their staff positions
+    while their clef changes from old_clef to new_clef, both given
+    as (shape, line).
+    '''
+
+    return pitches_at(staff_positions(pitches, *old_clef), *new_clef)
@@ -0,0 +1,123 @@
+import os
+import shutil
+import threading
+
+from concurrent.futures import Future
+
+import tornado.web
+
+import conf
+from tiles import Image, tiler, image_version
+
+class Previews:
+    '''
+    Small renditions of page images for document listings: a thumbnail
+    and a low-resolution preview of each, at most `sizes[name]` pixels
+    wide and high. They are made in the pool of image processes (see
+    Tiler.submit) when an image is uploaded or discovered, or when
+    first asked for.
+
+    The renditions of <type>/<page>.jpg are kept as
+    <type>/.previews/<page>/<version>-<name>.jpg, keyed by the version
+    (mtime and size) of the image they were made from; those of older
+    versions are removed.
+    '''
+
+    def __init__(self, sizes, quality):
+        self.sizes = sizes
+        self.quality = quality
+
+        # image path -> Future of the renditions being made
+        self.building = {}
+        self.lock = threading.Lock()
+
+    def ensure(self, image_path):
+        '''
+        A Future of {"version": ..., <name>: <path>, ...}, the renditions
+        of the current version of the image at image_path, made if they
+        don't exist yet.
+        '''
+
+        if Image is None:
+            raise tornado.web.HTTPError(501, "image previews need PIL")
+
+        image_path = os.path.abspath(image_path)
+        version = image_version(image_path)
+        paths = rendition_paths(image_path, version, self.sizes)
+        if all(os.path.exists(path) for path in paths.values()):
+            future = Future()
+            future.set_result(dict(paths, version=version))
+            return future
+
+        with self.lock:
+            future = self.building.get(image_path)
+            if future is None:
+                future = tiler.submit(build_previews, image_path, version, self.sizes, self.quality)
+                self.building[image_path] = future
+                future.add_done_callback(lambda future: self.built(image_path))
+            return future
+
+    def discover(self, image_path):
+        '''
+        Make the renditions of a newly found image in the background.
+        '''
+
+        if Image is None:
+            return
+        try:
+            self.ensure(image_path)
+        except tornado.web.HTTPError:
+            # gone again
+            pass
+
+    def remove(self, image_path):
+        shutil.rmtree(previews_directory(os.path.abspath(image_path)), ignore_errors=True)
+
+    # HELPER FUNCTIONS
+    def built(self, image_path):
+        with self.lock:
+            self.building.pop(image_path, None)
+
+def previews_directory(image_path):
+    directory, name = os.path.split(image_path)
+    return os.path.join(directory, ".previews", os.path.splitext(name)[0])
+
+def rendition_paths(image_path, version, sizes):
+    directory = previews_directory(image_path)
+    return dict((name, os.path.join(directory, "%s-%s.jpg" % (version, name))) for name in sizes)
+
+def build_previews(image_path, version, sizes, quality):
+    '''
+    Make the renditions of an image, largest first, each scaled down
+    from the one before. Runs in a pool process.
+    '''
+
+    directory = previews_directory(image_path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # made concurrently
+            pass
+
+    image = Image.open(image_path)
+    image.load()
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    paths = rendition_paths(image_path, version, sizes)
+    for name in sorted(sizes, key=sizes.get, reverse=True):
+        image.thumbnail((sizes[name], sizes[name]), Image.ANTIALIAS)
+        image.save(paths[name] + ".tmp", "JPEG", quality=quality)
+        os.rename(paths[name] + ".tmp", paths[name])
+
+    for name in os.listdir(directory):
+        if not name.startswith(version + "-"):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+    return dict(paths, version=version)
+
+previews = Previews({"thumbnail": conf.THUMBNAIL_SIZE, "preview": conf.PREVIEW_SIZE}, conf.TILE_QUALITY)
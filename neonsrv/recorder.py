@@ -0,0 +1,110 @@
+import json
+import threading
+import time
+
+import tornado.web
+
+import conf
+from tornadoapi import find_route
+
+# routes under edit/ other than the edits of EDIT_ROUTES
+DOCUMENT_ROUTES = ("batch", "region", "render", "undo", "revert", "delete")
+
+class Recorder:
+    '''
+    Appends the requests of editing sessions to a log, for bench/replay.py
+    to play back. Every request under <APP_ROOT>edit/ makes one line,
+    a JSON list:
+        [time, method, document, route, body, status, result]
+    time is when the request arrived, in seconds since the epoch, document
+    is the path of the document as the server resolves it (<type>/<name>,
+    or just <name> for editors without a document type) and route the
+    rest of the path with the query, if any.
+    result is the response of an edit without its delta and revision,
+    which names the ids of any elements it made; None for other requests.
+    '''
+
+    def __init__(self, path, prefix):
+        self.path = path
+        self.prefix = prefix
+
+        # opened on the first request recorded
+        self.fp = None
+        self.lock = threading.Lock()
+
+    def recording(self, request):
+        return bool(self.path) and request.path.startswith(self.prefix)
+
+    def record(self, request, status, response):
+        split = split_edit_path(request.path[len(self.prefix):])
+        if split is None:
+            return
+
+        document, route = split
+        if request.query:
+            route += "?" + request.query
+
+        entry = [round(time.time() - request.request_time(), 3), request.method, document, route,
+                 request.body.decode("utf-8", "replace"), status, None]
+        if request.method == "POST":
+            entry[6] = edit_result(response)
+
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self.lock:
+            if self.fp is None:
+                self.fp = open(self.path, "a", 1)
+            self.fp.write(line)
+
+def split_edit_path(path):
+    '''
+    (document, route) of a path under edit/, the way the server splits
+    it (see find_route), or None if no route serves it.
+    '''
+
+    found = find_route(path)
+    if found is not None:
+        document = found[1]
+        return document, path[len(document) + 1:]
+
+    document, slash, route = path.rpartition("/")
+    if document and route in DOCUMENT_ROUTES:
+        return document, route
+    return None
+
+def edit_result(response):
+    try:
+        result = json.loads(response)
+    except ValueError:
+        return None
+    if isinstance(result, dict):
+        result.pop("delta", None)
+        result.pop("revision", None)
+    return result
+
+class RecordingTransform(tornado.web.OutputTransform):
+    '''
+    Passes responses on unchanged, handing those of the requests being
+    recorded to the recorder once they are complete. Must come before
+    any transform that compresses the response.
+    '''
+
+    def __init__(self, request):
+        self.request = request
+        self.status = None
+        self.chunks = None
+        if recorder.recording(request):
+            self.chunks = []
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        self.status = status_code
+        return status_code, headers, self.transform_chunk(chunk, finishing)
+
+    def transform_chunk(self, chunk, finishing):
+        if self.chunks is not None:
+            self.chunks.append(chunk)
+            if finishing:
+                recorder.record(self.request, self.status, "".join(self.chunks))
+                self.chunks = None
+        return chunk
+
+recorder = Recorder(conf.EDIT_LOG, conf.APP_ROOT.rstrip("/") + "/edit/")
@@ -0,0 +1,116 @@
+class GridIndex:
+    '''
+    Spatial index of boxes (ulx, uly, lrx, lry) on a uniform grid of
+    square cells. Every key is registered in each cell its box touches,
+    so a query only looks at the keys in the cells the queried region
+    touches.
+
+    Coordinates must be finite. Boxes spanning more than `max_span`
+    cells along either axis are kept aside and checked by every query,
+    and a query never looks at more cells than there are in use, so
+    neither huge boxes nor huge regions cost more than a scan of the
+    index.
+    '''
+
+    def __init__(self, cell_size=256, max_span=64):
+        self.cell_size = cell_size
+        self.max_span = max_span
+
+        # key -> box
+        self.boxes = {}
+        # (column, row) -> set of keys
+        self.cells = {}
+        # keys of the boxes too large to register in cells
+        self.large = set()
+        # (first column, last column, first row, last row) of the cells
+        # ever used, None while there are none
+        self.extent = None
+
+    def insert(self, key, box):
+        '''
+        Add a box, replacing the one previously stored under key.
+        '''
+
+        self.remove(key)
+        self.boxes[key] = box
+
+        first_column, last_column, first_row, last_row = self.cell_range(box)
+        if last_column - first_column >= self.max_span or last_row - first_row >= self.max_span:
+            self.large.add(key)
+            return
+
+        for cell in self.cells_of(box):
+            self.cells.setdefault(cell, set()).add(key)
+
+        if self.extent is None:
+            self.extent = (first_column, last_column, first_row, last_row)
+        else:
+            self.extent = (min(self.extent[0], first_column), max(self.extent[1], last_column),
+                           min(self.extent[2], first_row), max(self.extent[3], last_row))
+
+    def remove(self, key):
+        box = self.boxes.pop(key, None)
+        if box is None:
+            return
+        if key in self.large:
+            self.large.discard(key)
+            return
+
+        for cell in self.cells_of(box):
+            keys = self.cells[cell]
+            keys.discard(key)
+            if not keys:
+                del self.cells[cell]
+
+    def query(self, region, inside=False):
+        '''
+        Keys whose box overlaps the region, or lies completely
+        inside it if inside is True.
+        '''
+
+        candidates = set(self.large)
+        if self.extent is not None:
+            # only the part of the region where cells are in use
+            first_column, last_column, first_row, last_row = self.cell_range(region)
+            first_column = max(first_column, self.extent[0])
+            last_column = min(last_column, self.extent[1])
+            first_row = max(first_row, self.extent[2])
+            last_row = min(last_row, self.extent[3])
+
+            if first_column > last_column or first_row > last_row:
+                pass
+            elif (last_column - first_column + 1) * (last_row - first_row + 1) <= len(self.cells):
+                for column in xrange(first_column, last_column + 1):
+                    for row in xrange(first_row, last_row + 1):
+                        candidates.update(self.cells.get((column, row), ()))
+            else:
+                for (column, row), keys in self.cells.iteritems():
+                    if first_column <= column <= last_column and first_row <= row <= last_row:
+                        candidates.update(keys)
+
+        if inside:
+            test = contains
+        else:
+            test = overlaps
+        return [key for key in candidates if test(region, self.boxes[key])]
+
+    def __len__(self):
+        return len(self.boxes)
+
+    # HELPER FUNCTIONS
+    def cell_range(self, box):
+        ulx, uly, lrx, lry = box
+        size = self.cell_size
+        return int(ulx // size), int(lrx // size), int(uly // size), int(lry // size)
+
+    def cells_of(self, box):
+        first_column, last_column, first_row, last_row = self.cell_range(box)
+        return [(column, row)
+                for column in range(first_column, last_column + 1)
+                for row in range(first_row, last_row + 1)]
+
+def overlaps(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def contains(outer, inner):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and inner[2] <= outer[2] and inner[3] <= outer[3]
@@ -0,0 +1,184 @@
+import json
+import math
+import os
+import shutil
+import threading
+
+from concurrent.futures import Future, ProcessPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:
+    # without PIL no tiles are made, and page images are only served whole
+    Image = None
+
+import tornado.web
+
+import conf
+
+class Tiler:
+    '''
+    Makes multi-resolution tile pyramids of page images, in a pool of
+    processes, so that the editor only fetches the tiles in view at
+    the current zoom instead of the whole image.
+
+    The pyramid of <type>/<page>.jpg lives in <type>/.tiles/<page>/<version>/,
+    where the version names the image revision (mtime and size) it was
+    made from: level 0 holds the image at full size, every further
+    level half the size of the one before, down to a single tile.
+    Tiles are <level>/<column>_<row>.jpg and info.json describes the
+    pyramid. A pyramid is made when an image is uploaded or discovered
+    (see Manifests.on_new_image), or when it is first asked for;
+    pyramids of older revisions are removed.
+    '''
+
+    def __init__(self, processes, tile_size, quality):
+        self.processes = processes
+        self.tile_size = tile_size
+        self.quality = quality
+
+        # started on first use
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        # image path -> Future of the info of the pyramid being made
+        self.building = {}
+        self.lock = threading.Lock()
+
+    def ensure(self, image_path):
+        '''
+        A Future of the info of the current pyramid of the image at
+        image_path (see build_pyramid), made if it doesn't exist yet.
+        '''
+
+        if Image is None:
+            raise tornado.web.HTTPError(501, "image tiling needs PIL")
+
+        image_path = os.path.abspath(image_path)
+        version = image_version(image_path)
+        info = read_info(os.path.join(pyramid_directory(image_path), version))
+        if info is not None:
+            future = Future()
+            future.set_result(info)
+            return future
+
+        with self.lock:
+            future = self.building.get(image_path)
+            if future is None:
+                future = self.submit(build_pyramid, image_path, version, self.tile_size, self.quality)
+                self.building[image_path] = future
+                future.add_done_callback(lambda future: self.built(image_path))
+            return future
+
+    def discover(self, image_path):
+        '''
+        Make the pyramid of a newly found image in the background.
+        '''
+
+        if Image is None:
+            return
+        try:
+            self.ensure(image_path)
+        except tornado.web.HTTPError:
+            # gone again
+            pass
+
+    def available(self):
+        return Image is not None
+
+    def submit(self, fn, *args):
+        '''
+        Run fn(*args) in the pool of image processes, which other
+        image work (see Previews) shares, and return its Future.
+        '''
+
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(self.processes)
+        return self.pool.submit(fn, *args)
+
+    def remove(self, image_path):
+        shutil.rmtree(pyramid_directory(os.path.abspath(image_path)), ignore_errors=True)
+
+    # HELPER FUNCTIONS
+    def built(self, image_path):
+        with self.lock:
+            self.building.pop(image_path, None)
+
+def pyramid_directory(image_path):
+    directory, name = os.path.split(image_path)
+    return os.path.join(directory, ".tiles", os.path.splitext(name)[0])
+
+def image_version(image_path):
+    try:
+        stat = os.stat(image_path)
+    except OSError:
+        raise tornado.web.HTTPError(404)
+    return "%x-%x" % (int(stat.st_mtime * 1000000), stat.st_size)
+
+def read_info(version_directory):
+    try:
+        fp = open(os.path.join(version_directory, "info.json"))
+        try:
+            return json.load(fp)
+        finally:
+            fp.close()
+    except (IOError, ValueError):
+        return None
+
+def build_pyramid(image_path, version, tile_size, quality):
+    '''
+    Cut the image into the tiles of every level, in a directory of its
+    own that is renamed into place when complete, and remove the
+    pyramids of older versions. Returns the info of the pyramid:
+    {"version", "width", "height", "tile_size", "levels"}.
+    Runs in a pool process.
+    '''
+
+    pyramid = pyramid_directory(image_path)
+    building = os.path.join(pyramid, version + ".%d.tmp" % os.getpid())
+    shutil.rmtree(building, ignore_errors=True)
+
+    image = Image.open(image_path)
+    image.load()
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    width, height = image.size
+    levels = int(math.ceil(math.log(max(width, height, tile_size) / float(tile_size), 2))) + 1
+
+    level_image = image
+    for level in range(levels):
+        level_directory = os.path.join(building, str(level))
+        os.makedirs(level_directory)
+
+        level_width, level_height = level_image.size
+        for column in range(int(math.ceil(level_width / float(tile_size)))):
+            for row in range(int(math.ceil(level_height / float(tile_size)))):
+                box = (column * tile_size, row * tile_size,
+                       min((column + 1) * tile_size, level_width), min((row + 1) * tile_size, level_height))
+                tile = level_image.crop(box)
+                tile.save(os.path.join(level_directory, "%d_%d.jpg" % (column, row)), "JPEG", quality=quality)
+
+        # each level is made from the one before, which is much cheaper
+        # than scaling the full image down every time
+        if level + 1 < levels:
+            level_image = level_image.resize((max(1, level_width // 2), max(1, level_height // 2)), Image.ANTIALIAS)
+
+    info = {"version": version, "width": width, "height": height, "tile_size": tile_size, "levels": levels}
+    fp = open(os.path.join(building, "info.json"), "w")
+    json.dump(info, fp)
+    fp.close()
+
+    try:
+        os.rename(building, os.path.join(pyramid, version))
+    except OSError:
+        # made concurrently by another process
+        shutil.rmtree(building, ignore_errors=True)
+
+    for name in os.listdir(pyramid):
+        if name != version and not name.endswith(".tmp"):
+            shutil.rmtree(os.path.join(pyramid, name), ignore_errors=True)
+
+    return info
+
+tiler = Tiler(conf.TILE_PROCESSES, conf.TILE_SIZE, conf.TILE_QUALITY)
@@ -1,540 +1,596 @@
+import inspect
 import os
-
-from modifymei import ModifyDocument
-
+import sys
+from contextlib import contextmanager
+
+from modifymei import ModifyDocument, AUTO_PITCH, utf8_all, is_finite
+from doccache import documents
+from writebehind import pending_writes
+from workers import workers
+from feed import feed
+import parsecache
+
+from tornado import gen
+import tornado.ioloop
 import tornado.web
+import tornado.websocket
 import json
 
 import conf
 
-#####################################################
-#              NEUME HANDLER CLASSES                #
-#####################################################
-class InsertNeumeHandler(tornado.web.RequestHandler):
-
-    def post(self, file):
-        name = str(self.get_argument("name", ""))
-        inclinatum = self.get_argument("inclinatum", None)
-        deminutus = self.get_argument("deminutus", None)
-        before_id = self.get_argument("beforeid", None)
-        pname = str(self.get_argument("pname", ""))
-        oct = str(self.get_argument("oct", ""))
-        dot_form = self.get_argument("dotform", None)
-        episema_form = self.get_argument("episemaform", None)
-        id = self.get_argument("id", None)
-
-        # Bounding box
-        lrx = str(self.get_argument("lrx", None))
-        lry = str(self.get_argument("lry", None))
-        ulx = str(self.get_argument("ulx", None))
-        uly = str(self.get_argument("uly", None))
-
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        result = md.insert_punctum(name, inclinatum, deminutus, before_id, pname, oct, dot_form, episema_form, ulx, uly, lrx, lry)
-        md.write_doc()
-
-        self.write(json.dumps(result))
-        self.set_status(200)
-
-class ChangeNeumePitchHandler(tornado.web.RequestHandler):
-
-    def post(self, file):
-        data = json.loads(self.get_argument("data", ""))
-
-        id = str(data["id"])
-        before_id = str(data["beforeid"])
-        
-        # Bounding box
-        ulx = str(data["ulx"])
-        uly = str(data["uly"])
-        lrx = str(data["lrx"])
-        lry = str(data["lry"])
-
-        pitch_info = data["pitchInfo"]
-
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        md.move_neume(id, before_id, pitch_info, ulx, uly, lrx, lry)
-        md.write_doc()
-
-        self.set_status(200)
-
-class DeleteNeumeHandler(tornado.web.RequestHandler):
-
-    def post(self, file):
-        ids = str(self.get_argument("ids", ""))
-
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        md.delete_neume(ids.split(","))
-        md.write_doc()
-
-        self.set_status(200)
-
-class UpdateNeumeHeadShapeHandler(tornado.web.RequestHandler):
-
-    def post(self, file):
-        id = str(self.get_argument("id", ""))
-        head_shape = str(self.get_argument("shape", ""))
-        lrx = str(self.get_argument("lrx", None))
-        lry = str(self.get_argument("lry", None))
-        ulx = str(self.get_argument("ulx", None))
-        uly = str(self.get_argument("uly", None))
-
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        md.update_neume_head_shape(id, head_shape, ulx, uly, lrx, lry)
-        md.write_doc()
-
-        self.set_status(200)
-
-class NeumifyNeumeHandler(tornado.web.RequestHandler):
-
-    def post(self, file):        
-        data = json.loads(self.get_argument("data", ""))
-        nids = str(data["nids"]).split(",")
-        type_id = str(data["typeid"])
-        liquescence = str(data.get("liquescence", None))
-        head_shapes = data["headShapes"]
-
+def save_document(md):
+    md.write_doc()
+    documents.refresh(md.filename)
+
+def document_path(file):
+    return os.path.join(os.path.abspath(conf.MEI_DIRECTORY), file) + ".mei"
+
+def load_document(file):
+    '''
+    The ModifyDocument for the given file, parsed at most once while
+    it stays unchanged on disk.
+    '''
+
+    mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
+    fname = os.path.join(mei_directory, file)
+
+    # a document evicted from the cache may still have edits waiting
+    # to be written, they must reach the disk before it is parsed again
+    if fname + ".mei" not in documents:
+        pending_writes.flush(fname + ".mei")
+
+    return documents.get(fname + ".mei", lambda path: parse_document(fname))
+
+def parse_document(fname):
+    if conf.PARSE_CACHE:
+        return ModifyDocument(fname, conf.DEBUG_ELEMENT_INDEX, parsecache.read)
+    return ModifyDocument(fname, conf.DEBUG_ELEMENT_INDEX)
+
+@contextmanager
+def modify_document(file):
+    '''
+    Yield the ModifyDocument for the given file (see load_document).
+    When the edit succeeds its changes
+    are recorded for undo and the document is scheduled to be written
+    back. The changes of a failed edit are rolled back; should even that
+    fail, the write still pending, which holds edits already committed
+    and acknowledged, is made of the tree as it stands before the tree
+    is dropped from the cache.
+    '''
+
+    md = load_document(file)
+    try:
+        yield md
+    except Exception:
+        exc = sys.exc_info()
         try:
-            lrx = str(data["lrx"])
-            lry = str(data["lry"])
-            ulx = str(data["ulx"])
-            uly = str(data["uly"])
-        except KeyError:
-            ulx = uly = lrx = lry = None
-        
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        result = md.neumify(nids, type_id, liquescence, head_shapes, ulx, uly, lrx, lry)
-        md.write_doc()
-
-        self.write(json.dumps(result))
+            md.rollback()
+        except Exception:
+            try:
+                pending_writes.flush(md.filename)
+            finally:
+                documents.invalidate(md.filename)
+        raise exc[0], exc[1], exc[2]
+
+    md.commit()
+    pending_writes.schedule(md.filename, lambda: save_document(md))
+
+def edit_document(file, edit, expected_revision=None):
+    '''
+    Run edit(md) on the document workers, within modify_document, and
+    return a Future of its result. Edits of the same document are
+    applied one at a time, in the order they arrived.
+
+    If expected_revision is given, the edit is only applied to that
+    revision of the document; otherwise it fails with a RevisionConflict.
+    '''
+
+    return workers.submit_document(document_path(file), apply_edit, file, edit, expected_revision)
+
+def apply_edit(file, edit, expected_revision=None):
+    with modify_document(file) as md:
+        if expected_revision is not None and md.revision() != expected_revision:
+            raise RevisionConflict(md.revision())
+        result = edit(md)
+
+    delta = md.delta
+    if delta["added"] or delta["moved"] or delta["removed"] or delta["changed"]:
+        feed.publish(md.filename, {"revision": delta["revision"], "delta": delta})
+
+    return edit_response(result, delta)
+
+def edit_response(result, delta):
+    '''
+    The response to an edit: the revision of the document after it,
+    what the edit changed (see ModifyDocument.describe_changes) and
+    the result of the edit itself.
+    '''
+
+    response = {"revision": delta["revision"], "delta": delta}
+    if isinstance(result, dict):
+        response.update(result)
+    elif result is not None:
+        response["result"] = result
+    return response
+
+class RevisionConflict(tornado.web.HTTPError):
+    '''
+    An edit meant for another revision of the document than the current one.
+    '''
+
+    def __init__(self, revision):
+        tornado.web.HTTPError.__init__(self, 412, "document is at revision %d" % revision)
+        self.revision = revision
+
+class EditHandler(tornado.web.RequestHandler):
+    '''
+    Base of the handlers applying an edit. A client may send the revision
+    it last saw as If-Match: "<revision>"; if the document has changed
+    since, the edit is refused with a 412 carrying the current revision
+    (as body and ETag), so that clients can send edits without waiting
+    for each response and still notice when they lost a race.
+    '''
+
+    def edit(self, file, edit):
+        return edit_document(file, edit, self.expected_revision())
+
+    def expected_revision(self):
+        header = self.request.headers.get("If-Match")
+        if header is None or header.strip() == "*":
+            return None
 
-        self.set_status(200)
-
-class UngroupNeumeHandler(tornado.web.RequestHandler):
-
-    def post(self, file):
-        data = json.loads(self.get_argument("data", ""))
-
-        nids = str(data["nids"]).split(",")
-        bboxes = data["bbs"]
-
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        result = md.ungroup(nids, bboxes)
-        md.write_doc()
-
-        self.write(json.dumps(result))
-
-        self.set_status(200)
+        try:
+            return int(header.strip().replace("W/", "", 1).strip('"'))
+        except ValueError:
+            raise tornado.web.HTTPError(400, "If-Match must be a document revision")
+
+    def write_error(self, status_code, **kwargs):
+        exc = kwargs.get("exc_info", (None, None))[1]
+        if isinstance(exc, RevisionConflict):
+            self.set_header("ETag", '"%d"' % exc.revision)
+            self.set_header("Content-Type", "application/json")
+            self.finish(json.dumps({"revision": exc.revision}))
+        else:
+            tornado.web.RequestHandler.write_error(self, status_code, **kwargs)
+
+def read_document(file, read):
+    '''
+    Like edit_document, for read(md) that leaves the document unchanged:
+    nothing is recorded or written back.
+    '''
+
+    return workers.submit_document(document_path(file), lambda: read(load_document(file)))
 
 #####################################################
-#              DIVISION HANDLER CLASSES             #
+#              EDIT ROUTES                          #
 #####################################################
-class InsertDivisionHandler(tornado.web.RequestHandler):
-
-    def post(self, file):
-        div_type = str(self.get_argument("type", ""))
-        before_id = self.get_argument("beforeid", None)
-
-        # bounding box
-        lrx = str(self.get_argument("lrx", None))
-        lry = str(self.get_argument("lry", None))
-        ulx = str(self.get_argument("ulx", None))
-        uly = str(self.get_argument("uly", None))
-
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        result = md.insert_division(before_id, div_type, ulx, uly, lrx, lry)
-        md.write_doc()
-
-        self.write(json.dumps(result))
-        self.set_status(200)
-
-class MoveDivisionHandler(tornado.web.RequestHandler):
-
-    def post(self, file):
-        id = str(self.get_argument("id", ""))
-        before_id = str(self.get_argument("beforeid", None))
-
-        # bounding box
-        ulx = str(self.get_argument("ulx", None))
-        uly = str(self.get_argument("uly", None))
-        lrx = str(self.get_argument("lrx", None))
-        lry = str(self.get_argument("lry", None))
-
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        md.move_division(id, before_id, ulx, uly, lrx, lry)
-        md.write_doc()
-
-        self.set_status(200)
-
-class UpdateDivisionShapeHandler(tornado.web.RequestHandler):
-
-    def post(self, file):
-        data = json.loads(self.get_argument("data", ""))
-        div_type = str(data["type"])
-        id = str(data["id"])
-
-        # bounding box
-        lrx = str(data["lrx"])
-        lry = str(data["lry"])
-        ulx = str(data["ulx"])
-        uly = str(data["uly"])
-
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        md.update_division_shape(id, div_type, ulx, uly, lrx, lry)
-        md.write_doc()
-
-        self.set_status(200)
-
-class DeleteDivisionHandler(tornado.web.RequestHandler):
-
-    def post(self, file):
-        ids = str(self.get_argument("ids", ""))
-
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        md.delete_division(ids.split(","))
-        md.write_doc()
-
-        self.set_status(200)
-
-class AddEpisemaHandler(tornado.web.RequestHandler):
-
-    def post(self, file):
-        id = str(self.get_argument("id", ""))
-        episema_form = str(self.get_argument("episemaform", ""))
-
-        # Bounding box
-        ulx = str(self.get_argument("ulx", None))
-        uly = str(self.get_argument("uly", None))
-        lrx = str(self.get_argument("lrx", None))
-        lry = str(self.get_argument("lry", None))
-
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        md.add_episema(id, episema_form, ulx, uly, lrx, lry)
-        md.write_doc()
-
-        self.set_status(200)
-
-class DeleteEpisemaHandler(tornado.web.RequestHandler):
-
-    def post(self, file):
-        id = str(self.get_argument("id", ""))
-
-        # Bounding box
-        ulx = str(self.get_argument("ulx", None))
-        uly = str(self.get_argument("uly", None))
-        lrx = str(self.get_argument("lrx", None))
-        lry = str(self.get_argument("lry", None))
-
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        md.delete_episema(id, ulx, uly, lrx, lry)
-        md.write_doc()
-
-        self.set_status(200)
-
-class AddDotHandler(tornado.web.RequestHandler):
-
-    def post(self, file):  
-        id = str(self.get_argument("id", ""))
-        dot_form = str(self.get_argument("dotform", ""))
-
-        # Bounding box
-        ulx = str(self.get_argument("ulx", None))
-        uly = str(self.get_argument("uly", None))
-        lrx = str(self.get_argument("lrx", None))
-        lry = str(self.get_argument("lry", None))
-
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        md.add_dot(id, dot_form, ulx, uly, lrx, lry)
-        md.write_doc()
-
-        self.set_status(200)
-
-class DeleteDotHandler(tornado.web.RequestHandler):
-
-    def post(self, file):
-        id = str(self.get_argument("id", ""))
-
-        # Bounding box
-        ulx = str(self.get_argument("ulx", None))
-        uly = str(self.get_argument("uly", None))
-        lrx = str(self.get_argument("lrx", None))
-        lry = str(self.get_argument("lry", None))
-
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        md.delete_dot(id, ulx, uly, lrx, lry)
-        md.write_doc()
-
+# where the arguments of an edit route are read from
+FORM = "form"
+DATA = "data"
+
+# default of an argument the request must provide
+REQUIRED = object()
+
+def text(value):
+    return str(value)
+
+def id_list(value):
+    if isinstance(value, list):
+        return [str(id) for id in value]
+    return str(value).split(",")
+
+def as_is(value):
+    return value
+
+def box(decode, default):
+    return [(coordinate, coordinate, decode, default) for coordinate in ("ulx", "uly", "lrx", "lry")]
+
+class EditRoute:
+    '''
+    How a request to an edit route becomes a call of a ModifyDocument
+    operation. The arguments are read either from the form fields (FORM)
+    or from the json object in the "data" field (DATA), each given as
+    (parameter, field, decode, default); a field of None stands for the
+    whole json value. With optional_box the bounding box (ulx, uly,
+    lrx, lry) may be left out of the data, in which case it is None.
+    Batches (see BatchHandler) have their arguments decoded the same
+    way, keyed by parameter rather than by field.
+    '''
+
+    def __init__(self, operation, source, arguments, optional_box=False):
+        self.operation = getattr(ModifyDocument, operation)
+        self.source = source
+        self.arguments = arguments
+        self.optional_box = optional_box
+
+    def decode(self, handler):
+        '''
+        The keyword arguments of the operation for the request
+        of the given handler.
+        '''
+
+        if self.source == DATA:
+            try:
+                fields = json.loads(handler.get_argument("data", ""))
+            except ValueError:
+                raise tornado.web.HTTPError(400, "data is not valid json")
+            get = lambda parameter, field, default: self.get_data(fields, field, default)
+        else:
+            get = lambda parameter, field, default: self.get_form(handler, field, default)
+
+        return self.decode_with(get)
+
+    def decode_args(self, args):
+        '''
+        The keyword arguments of the operation for the args
+        {<parameter>: <value>} of a batch operation.
+        '''
+
+        kwargs = self.decode_with(lambda parameter, field, default: self.get_data(args, parameter, default))
+        unknown = sorted(set(args) - set(kwargs))
+        if unknown:
+            raise tornado.web.HTTPError(400, "unknown arguments %s" % ", ".join(unknown))
+        return kwargs
+
+    # HELPER FUNCTIONS
+    def decode_with(self, get):
+        kwargs = {}
+        for parameter, field, decode, default in self.arguments:
+            kwargs[parameter] = decode(get(parameter, field, default))
+
+        if self.optional_box:
+            try:
+                for parameter, field, decode, default in box(text, REQUIRED):
+                    kwargs[parameter] = decode(get(parameter, field, default))
+            except tornado.web.HTTPError:
+                kwargs.update(ulx=None, uly=None, lrx=None, lry=None)
+
+        return kwargs
+
+    def get_form(self, handler, field, default):
+        if default is REQUIRED:
+            return handler.get_argument(field)
+        return handler.get_argument(field, default)
+
+    def get_data(self, fields, field, default):
+        if field is None:
+            return fields
+        if not isinstance(fields, dict):
+            raise tornado.web.HTTPError(400, "data must be a json object")
+        if field not in fields:
+            if default is REQUIRED:
+                raise tornado.web.HTTPError(400, "data is missing %s" % field)
+            return default
+        return fields[field]
+
+# /edit/<document>/<route> -> EditRoute
+EDIT_ROUTES = {
+    # neumes
+    "insert/neume": EditRoute("insert_punctum", FORM, [
+        ("name", "name", text, ""),
+        ("inclinatum", "inclinatum", as_is, None),
+        ("deminutus", "deminutus", as_is, None),
+        ("before_id", "beforeid", as_is, None),
+        ("pname", "pname", text, ""),
+        ("oct", "oct", text, ""),
+        ("dot_form", "dotform", as_is, None),
+        ("episema_form", "episemaform", as_is, None)] + box(text, None)),
+    "move/neume": EditRoute("move_neume", DATA, [
+        ("id", "id", text, REQUIRED),
+        ("before_id", "beforeid", text, REQUIRED),
+        ("pitch_info", "pitchInfo", as_is, REQUIRED)] + box(text, REQUIRED)),
+    "delete/neume": EditRoute("delete_neume", FORM, [
+        ("ids", "ids", id_list, "")]),
+    "update/neume/headshape": EditRoute("update_neume_head_shape", FORM, [
+        ("id", "id", text, ""),
+        ("shape", "shape", text, "")] + box(text, None)),
+    "neumify": EditRoute("neumify", DATA, [
+        ("ids", "nids", id_list, REQUIRED),
+        ("type_id", "typeid", text, REQUIRED),
+        ("liquescence", "liquescence", text, None),
+        ("head_shapes", "headShapes", as_is, REQUIRED)], optional_box=True),
+    "ungroup": EditRoute("ungroup", DATA, [
+        ("ids", "nids", id_list, REQUIRED),
+        ("bboxes", "bbs", as_is, REQUIRED)]),
+
+    # divisions, episemata and dots
+    "insert/division": EditRoute("insert_division", FORM, [
+        ("type", "type", text, ""),
+        ("before_id", "beforeid", as_is, None)] + box(text, None)),
+    "move/division": EditRoute("move_division", FORM, [
+        ("id", "id", text, ""),
+        ("before_id", "beforeid", text, None)] + box(text, None)),
+    "update/division/shape": EditRoute("update_division_shape", DATA, [
+        ("type", "type", text, REQUIRED),
+        ("id", "id", text, REQUIRED)] + box(text, REQUIRED)),
+    "delete/division": EditRoute("delete_division", FORM, [
+        ("ids", "ids", id_list, "")]),
+    "insert/episema": EditRoute("add_episema", FORM, [
+        ("id", "id", text, ""),
+        ("form", "episemaform", text, "")] + box(text, None)),
+    "delete/episema": EditRoute("delete_episema", FORM, [
+        ("id", "id", text, "")] + box(text, None)),
+    "insert/dot": EditRoute("add_dot", FORM, [
+        ("id", "id", text, ""),
+        ("form", "dotform", text, "")] + box(text, None)),
+    "delete/dot": EditRoute("delete_dot", FORM, [
+        ("id", "id", text, "")] + box(text, None)),
+
+    # clefs; without pitchInfo the pitches are recomputed on the server
+    "insert/clef": EditRoute("insert_clef", DATA, [
+        ("shape", "shape", text, REQUIRED),
+        ("line", "line", text, REQUIRED),
+        ("before_id", "beforeid", text, REQUIRED),
+        ("pitch_info", "pitchInfo", as_is, AUTO_PITCH)], optional_box=True),
+    "move/clef": EditRoute("move_clef", DATA, [
+        ("id", "id", text, REQUIRED),
+        ("line", "line", text, REQUIRED),
+        ("pitch_info", "pitchInfo", as_is, AUTO_PITCH)] + box(text, REQUIRED)),
+    "update/clef/shape": EditRoute("update_clef_shape", DATA, [
+        ("id", "id", text, REQUIRED),
+        ("shape", "shape", text, REQUIRED),
+        ("pitch_info", "pitchInfo", as_is, AUTO_PITCH)] + box(text, REQUIRED)),
+    "delete/clef": EditRoute("delete_clef", DATA, [
+        ("clef_data", None, as_is, REQUIRED)]),
+
+    # custodes
+    "insert/custos": EditRoute("insert_custos", FORM, [
+        ("pname", "pname", text, ""),
+        ("oct", "oct", text, ""),
+        ("before_id", "beforeid", as_is, None)] + box(text, None)),
+    "move/custos": EditRoute("move_custos", FORM, [
+        ("id", "id", text, ""),
+        ("pname", "pname", as_is, ""),
+        ("oct", "oct", as_is, "")] + box(text, None)),
+    "delete/custos": EditRoute("delete_custos", FORM, [
+        ("ids", "ids", id_list, "")]),
+
+    # staves/systems
+    "insert/system": EditRoute("insert_system", FORM, [
+        ("page_id", "pageid", text, None)] + box(text, None)),
+    "insert/systembreak": EditRoute("insert_system_break", FORM, [
+        ("system_id", "systemid", as_is, None),
+        ("order_number", "ordernumber", as_is, None),
+        ("next_sb_id", "nextsbid", as_is, None)]),
+    "modify/systembreak": EditRoute("modify_system_break", FORM, [
+        ("sb_id", "sbid", text, REQUIRED),
+        ("order_number", "ordernumber", text, REQUIRED)]),
+    "delete/systembreak": EditRoute("delete_system", FORM, [
+        ("ids", "sbids", id_list, "")]),
+    "delete/system": EditRoute("delete_system", FORM, [
+        ("ids", "sids", id_list, "")]),
+    "update/system/zone": EditRoute("update_system_zone", FORM, [
+        ("system_id", "sid", text, REQUIRED)] + box(text, REQUIRED))
+}
+
+# ModifyDocument operation -> an EditRoute calling it, whose
+# decoding batches of the operation share
+OPERATION_ROUTES = dict((route.operation.__name__, route) for route in EDIT_ROUTES.values())
+
+def find_route(path):
+    '''
+    Split <document>/<route> into the EditRoute and the document,
+    trying the longest route names first. None if there is no such route.
+    '''
+
+    parts = path.split("/")
+    for length in (3, 2, 1):
+        if len(parts) > length:
+            route = EDIT_ROUTES.get("/".join(parts[-length:]))
+            if route is not None:
+                return route, "/".join(parts[:-length])
+    return None
+
+class EditRouter(EditHandler):
+
+    @gen.coroutine
+    def post(self, path):
+        '''
+        Apply the edit of the route the path ends with (see EDIT_ROUTES)
+        to the document it starts with.
+        '''
+
+        found = find_route(path)
+        if found is None:
+            raise tornado.web.HTTPError(404)
+
+        route, file = found
+        kwargs = route.decode(self)
+
+        response = yield self.edit(file, lambda md: route.operation(md, **kwargs))
+
+        self.write(json.dumps(response))
         self.set_status(200)
 
 #####################################################
-#              CLEF HANDLER CLASSES                 #
+#              READ HANDLER CLASSES                 #
 #####################################################
-class MoveClefHandler(tornado.web.RequestHandler):
-
-    def post(self, file):
-        data = json.loads(self.get_argument("data", ""))
-        clef_id = str(data["id"])
-        
-        # bounding box
-        ulx = str(data["ulx"])
-        uly = str(data["uly"])
-        lrx = str(data["lrx"])
-        lry = str(data["lry"])
-
-        line = str(data["line"])
-
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        md.move_clef(clef_id, line, data["pitchInfo"], ulx, uly, lrx, lry)
-        md.write_doc()
-
-        self.set_status(200)
-
-class UpdateClefShapeHandler(tornado.web.RequestHandler):
-
-    def post(self, file):
-        data = json.loads(self.get_argument("data", ""))
-        clef_id = str(data["id"])
-
-        # bounding box
-        ulx = str(data["ulx"])
-        uly = str(data["uly"])
-        lrx = str(data["lrx"])
-        lry = str(data["lry"])
-
-        shape = str(data["shape"])
+class RegionHandler(tornado.web.RequestHandler):
 
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        md.update_clef_shape(clef_id, shape, data["pitchInfo"], ulx, uly, lrx, lry)
-        md.write_doc()
+    @gen.coroutine
+    def get(self, file):
+        '''
+        List the elements whose bounding box overlaps the given region,
+        or lies inside it with mode=inside:
+        {"elements": [{"id", "type", "ulx", "uly", "lrx", "lry"}, ...]}
+        '''
 
-        self.set_status(200)
-
-class InsertClefHandler(tornado.web.RequestHandler):
-
-    def post(self, file):
-        data = json.loads(self.get_argument("data", ""))
-        shape = str(data["shape"])
-        line = str(data["line"])
-        before_id = str(data["beforeid"])
-        pitchInfo = data["pitchInfo"]
-
-        # bounding box
         try:
-            lrx = str(data["lrx"])
-            lry = str(data["lry"])
-            ulx = str(data["ulx"])
-            uly = str(data["uly"])
-        except KeyError:
-            ulx = uly = lrx = lry = None
+            ulx = float(self.get_argument("ulx"))
+            uly = float(self.get_argument("uly"))
+            lrx = float(self.get_argument("lrx"))
+            lry = float(self.get_argument("lry"))
+        except ValueError:
+            raise tornado.web.HTTPError(400, "region coordinates must be numbers")
+        if not all(is_finite(x) for x in (ulx, uly, lrx, lry)):
+            raise tornado.web.HTTPError(400, "region coordinates must be finite")
+        inside = self.get_argument("mode", "overlap") == "inside"
 
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        result = md.insert_clef(line, shape, pitchInfo, before_id, ulx, uly, lrx, lry)
-        md.write_doc()
+        elements = yield read_document(file, lambda md: md.elements_in_region(ulx, uly, lrx, lry, inside))
 
-        self.write(json.dumps(result))
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps({"elements": elements}))
 
-        self.set_status(200)
+class RenderModelHandler(tornado.web.RequestHandler):
 
-class DeleteClefHandler(tornado.web.RequestHandler):
-    def post(self, file):
-        clefs_to_delete = json.loads(self.get_argument("data", ""))
+    @gen.coroutine
+    def get(self, file):
+        '''
+        The render model of the document (see ModifyDocument.render_model),
+        with every element's bounding box already resolved.
+        '''
 
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        md.delete_clef(clefs_to_delete)
-        md.write_doc()
+        model = yield read_document(file, lambda md: md.render_model())
 
-        self.set_status(200)
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(model, separators=(",", ":")))
 
 #####################################################
-#              CUSTOS HANDLER CLASSES               #
+#              FEED HANDLER CLASSES                 #
 #####################################################
-class InsertCustosHandler(tornado.web.RequestHandler):
-
-    def post(self, file):
-        pname = str(self.get_argument("pname", ""))
-        oct = str(self.get_argument("oct", ""))
-        before_id = self.get_argument("beforeid", None)
+class FeedHandler(tornado.websocket.WebSocketHandler):
+    '''
+    WebSocket sending the changes made to a document as they are
+    applied (see ChangeFeed). A client passes the revision it has as
+    ?since= to first receive the changes it missed; if they are no
+    longer known it is told to reload instead.
+
+    A client that doesn't read its messages fast enough is not sent
+    more than FEED_MAX_PENDING of them at a time: further changes are
+    skipped, and once it has caught up it is told to reload.
+    '''
+
+    def open(self, file):
+        self.path = document_path(file)
+        # messages written but not yet sent to the client
+        self.pending = 0
+        # revision of the latest message skipped, if any
+        self.skipped = None
+
+        since = self.get_argument("since", None)
+        if since is not None:
+            try:
+                since = int(since)
+            except ValueError:
+                self.close(1008, "since must be a revision number")
+                return
+
+        missed = feed.subscribe(self.path, self, since)
+        if missed is None:
+            try:
+                future = read_document(file, lambda md: md.revision())
+            except tornado.web.HTTPError:
+                self.close(1013, "too many requests waiting")
+                return
+            tornado.ioloop.IOLoop.current().add_future(future, lambda future: self.check_revision(future, since))
+        else:
+            for message in missed:
+                self.send(message)
+
+    def on_close(self):
+        feed.unsubscribe(self.path, self)
+
+    def send(self, message):
+        if self.skipped is not None or self.pending >= conf.FEED_MAX_PENDING:
+            self.skipped = message["revision"]
+            return
 
-        # bounding box
-        ulx = str(self.get_argument("ulx", None))
-        uly = str(self.get_argument("uly", None))
-        lrx = str(self.get_argument("lrx", None))
-        lry = str(self.get_argument("lry", None))
-
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        result = md.insert_custos(pname, oct, before_id, ulx, uly, lrx, lry)
-        md.write_doc()
-
-        self.write(json.dumps(result))
-
-        self.set_status(200)
-
-class MoveCustosHandler(tornado.web.RequestHandler):
-
-    def post(self, file):
-        custos_id = str(self.get_argument("id", ""))
-        pname = self.get_argument("pname", "")
-        oct = self.get_argument("oct", "")
-
-        # bounding box
-        ulx = str(self.get_argument("ulx", None))
-        uly = str(self.get_argument("uly", None))
-        lrx = str(self.get_argument("lrx", None))
-        lry = str(self.get_argument("lry", None))
-
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        md.move_custos(custos_id, pname, oct, ulx, uly, lrx, lry)
-        md.write_doc()
-
-        self.set_status(200)
-
-class DeleteCustosHandler(tornado.web.RequestHandler):
-
-    def post(self, file):
-        custos_ids = str(self.get_argument("ids", "")).split(",")
-
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        md.delete_custos(custos_ids)
-        md.write_doc()
+        try:
+            future = self.write_message(json.dumps(message))
+        except tornado.websocket.WebSocketClosedError:
+            return
+
+        self.pending += 1
+        future.add_done_callback(self.sent)
+
+    # HELPER FUNCTIONS
+    def sent(self, future):
+        self.pending -= 1
+        if self.pending == 0 and self.skipped is not None:
+            revision = self.skipped
+            self.skipped = None
+            self.send({"revision": revision, "reload": True})
+
+    def check_revision(self, future, since):
+        try:
+            revision = future.result()
+        except Exception:
+            self.close(1011, "document could not be read")
+            return
 
-        self.set_status(200)
+        if revision != since:
+            self.send({"revision": revision, "reload": True})
 
 #####################################################
-#           STAFF/SYSTEM HANDLER CLASSES            #
+#              BATCH HANDLER CLASSES                #
 #####################################################
-class InsertSystemHandler(tornado.web.RequestHandler):
-
-    def post(self, file):
-        page_id = str(self.get_argument("pageid", None))
-        ulx = str(self.get_argument("ulx", None))
-        uly = str(self.get_argument("uly", None))
-        lrx = str(self.get_argument("lrx", None))
-        lry = str(self.get_argument("lry", None))
-
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        result = md.insert_system(page_id, ulx, uly, lrx, lry)
-        md.write_doc()
-
-        self.write(json.dumps(result))
-
-        self.set_status(200)
-
-class InsertSystemBreakHandler(tornado.web.RequestHandler):
-
-    def post(self, file):
-        system_id = self.get_argument("systemid", None)
-        order_number = self.get_argument("ordernumber", None)
-        next_sb_id = self.get_argument("nextsbid", None)
-
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        result = md.insert_system_break(system_id, order_number, next_sb_id)
-        md.write_doc()
-
-        self.write(json.dumps(result))
-
-        self.set_status(200)
-
-class ModifySystemBreakHandler(tornado.web.RequestHandler):
-
-    def post(self, file):
-        sb_id = str(self.get_argument("sbid"))
-        order_number = str(self.get_argument("ordernumber"))
-
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        result = md.modify_system_break(sb_id, order_number)
-        md.write_doc()
-
-        self.write(json.dumps(result))
-
-        self.set_status(200)
-
-class DeleteSystemBreakHandler(tornado.web.RequestHandler):
-
+def check_operation(i, operation):
+    '''
+    The (operation, keyword arguments) to call for an operation of a
+    batch, {"op": <ModifyDocument operation>, "args": {<parameter>: <value>}},
+    its arguments decoded like those of the edit route of the operation.
+    Refused with a 400 if it is not of that shape, or if its arguments
+    do not fit the parameters of the operation.
+    '''
+
+    if not isinstance(operation, dict):
+        raise tornado.web.HTTPError(400, "operation %d: must be an object with op and args" % i)
+
+    op = operation.get("op")
+    if not isinstance(op, str) or op not in ModifyDocument.OPERATIONS:
+        raise tornado.web.HTTPError(400, "operation %d: unknown operation %r" % (i, op))
+
+    args = operation.get("args", {})
+    if not isinstance(args, dict):
+        raise tornado.web.HTTPError(400, "operation %d: args must be an object" % i)
+
+    route = OPERATION_ROUTES.get(op)
+    if route is not None:
+        try:
+            args = route.decode_args(args)
+        except tornado.web.HTTPError, e:
+            raise tornado.web.HTTPError(400, "operation %d: %s" % (i, e.log_message))
+
+    try:
+        inspect.getcallargs(getattr(ModifyDocument, op), None, **args)
+    except TypeError:
+        raise tornado.web.HTTPError(400, "operation %d: bad arguments for %s" % (i, op))
+    return op, args
+
+def apply_operations(md, calls):
+    '''
+    Apply the (operation, keyword arguments) of a checked batch
+    to the document in order.
+    '''
+
+    results = []
+    for op, kwargs in calls:
+        results.append(getattr(md, op)(**kwargs))
+    return {"results": results}
+
+class BatchHandler(EditHandler):
+
+    @gen.coroutine
     def post(self, file):
-        sb_ids = str(self.get_argument("sbids", "")).split(",")
-
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        md.delete_system(sb_ids)
-        md.write_doc()
-
-        self.set_status(200)
+        '''
+        Apply an ordered list of edit operations in one go:
+        data = [{"op": <ModifyDocument operation>, "args": {<parameter>: <value>}}, ...]
+        Either all of them are applied, and written as a single edit,
+        or none of them are. Responds with the result of each operation.
+        '''
 
-class DeleteSystemHandler(tornado.web.RequestHandler):
+        try:
+            operations = utf8_all(json.loads(self.get_argument("data", "")))
+        except ValueError:
+            raise tornado.web.HTTPError(400, "batch data is not valid json")
 
-    def post(self, file):
-        system_ids = str(self.get_argument("sids", "")).split(",")
-        
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        md.delete_system(system_ids)
-        md.write_doc()
+        if not isinstance(operations, list):
+            raise tornado.web.HTTPError(400, "batch data must be a list of operations")
 
-        self.set_status(200)
+        calls = [check_operation(i, operation) for i, operation in enumerate(operations)]
 
-class UpdateSystemZoneHandler(tornado.web.RequestHandler):
+        response = yield self.edit(file, lambda md: apply_operations(md, calls))
 
-    def post(self, file):
-        system_id = str(self.get_argument("sid"))
-        ulx = str(self.get_argument("ulx"))
-        uly = str(self.get_argument("uly"))
-        lrx = str(self.get_argument("lrx"))
-        lry = str(self.get_argument("lry"))
-        
-        mei_directory = os.path.abspath(conf.MEI_DIRECTORY)
-        fname = os.path.join(mei_directory, file)
-        md = ModifyDocument(fname)
-        md.update_system_zone(system_id, ulx, uly, lrx, lry)
-        md.write_doc()
+        self.write(json.dumps(response))
 
         self.set_status(200)
@@ -0,0 +1,172 @@
+import json
+import os
+
+def undo_directory(filename):
+    '''
+    Directory holding the undo history of the given MEI file:
+    undo/<document type>/<name>, where the undo directory sits
+    next to the document type directories.
+    '''
+
+    filename_dir, mei_filename = os.path.split(os.path.abspath(filename))
+    root_dir, document_type = os.path.split(filename_dir)
+    mei_name = os.path.splitext(mei_filename)[0]
+
+    return os.path.join(root_dir, "undo", document_type, mei_name)
+
+class UndoStore:
+    '''
+    Undo history of a single document, kept in its own directory as a
+    ring of `capacity` slot files plus a small index file recording the
+    oldest slot (head) and the number of entries (count). Each entry is
+    the JSON list of changes one edit made to the document tree (see
+    ModifyDocument), so an undo only reverts the elements that edit
+    touched.
+
+    Pushes, pops and resets are kept in memory until flush writes the
+    slots they touched and the index; once the ring is full, a push
+    overwrites the oldest entry. Nothing ever lists, renames or deletes
+    sibling files.
+
+    The index also holds the revision of the document, which every push
+    and pop (i.e. every edit and undo) and every bump increases by one.
+    '''
+
+    def __init__(self, path, capacity=50, document=None):
+        self.path = path
+        self.capacity = capacity
+        # the MEI file whose history this is, if the history is to be
+        # checked against it (see flush)
+        self.document = document
+
+        # {"head": ..., "count": ..., "revision": ...}, read on first use
+        self.index = None
+        # slot -> entry pushed since the last flush
+        self.pending = {}
+        self.dirty = False
+
+    def push(self, changes):
+        index = self.load_index()
+
+        slot = (index["head"] + index["count"]) % self.capacity
+        self.pending[slot] = json.dumps(changes)
+
+        if index["count"] == self.capacity:
+            # the oldest entry was just overwritten
+            index["head"] = (index["head"] + 1) % self.capacity
+        else:
+            index["count"] += 1
+        index["revision"] += 1
+        self.dirty = True
+
+    def pop(self):
+        '''
+        Remove the newest entry and return its changes, or None
+        if there is nothing to undo.
+        '''
+
+        index = self.load_index()
+        if index["count"] == 0:
+            return None
+
+        slot = (index["head"] + index["count"] - 1) % self.capacity
+        if slot in self.pending:
+            changes = json.loads(self.pending.pop(slot))
+        else:
+            fp = open(self.slot_path(slot), "r")
+            changes = json.load(fp)
+            fp.close()
+
+        index["count"] -= 1
+        index["revision"] += 1
+        self.dirty = True
+
+        return changes
+
+    def reset(self):
+        self.index = {"head": 0, "count": 0, "revision": self.revision()}
+        self.pending = {}
+        self.dirty = True
+
+    def bump(self):
+        '''
+        Count a change of the document made outside the undo history,
+        e.g. reverting it to its backup.
+        '''
+
+        self.load_index()["revision"] += 1
+        self.dirty = True
+
+    def flush(self):
+        '''
+        Write the entries and the index changed since the last flush.
+        Called once the document itself has been written, so that the
+        history on disk is never ahead of the document. The index records
+        the size and mtime of the document as written; if the document
+        was since replaced or written without its history (e.g. the
+        server stopped in between), the history is dropped when read.
+        '''
+
+        if not self.dirty:
+            return
+
+        for slot, contents in sorted(self.pending.items()):
+            self.write(self.slot_path(slot), contents)
+        self.pending = {}
+        self.save_index()
+        self.dirty = False
+
+    def revision(self):
+        return self.load_index()["revision"]
+
+    def __len__(self):
+        return self.load_index()["count"]
+
+    # HELPER FUNCTIONS
+    def slot_path(self, slot):
+        return os.path.join(self.path, "%02d.json" % slot)
+
+    def load_index(self):
+        if self.index is None:
+            self.index = {"head": 0, "count": 0, "revision": 0}
+
+            index_path = os.path.join(self.path, "index.json")
+            if os.path.exists(index_path):
+                fp = open(index_path, "r")
+                index = json.load(fp)
+                fp.close()
+
+                # slots laid out for another capacity can't be reused
+                if index.get("capacity") == self.capacity:
+                    self.index = index
+                self.index["revision"] = index.get("revision", 0)
+
+                if self.document is not None and index.get("document", False) not in (False, self.fingerprint()):
+                    # the entries don't apply to the document as it is
+                    self.index = {"head": 0, "count": 0, "revision": index.get("revision", 0) + 1}
+                    self.save_index()
+
+        return self.index
+
+    def save_index(self):
+        self.index["capacity"] = self.capacity
+        if self.document is not None:
+            self.index["document"] = self.fingerprint()
+        self.write(os.path.join(self.path, "index.json"), json.dumps(self.index))
+
+    def fingerprint(self):
+        try:
+            stat = os.stat(self.document)
+        except OSError:
+            return None
+        return [stat.st_size, stat.st_mtime]
+
+    def write(self, path, contents):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        # write aside and rename, so a crash never leaves a torn file
+        fp = open(path + ".tmp", "w")
+        fp.write(contents)
+        fp.close()
+        os.rename(path + ".tmp", path)
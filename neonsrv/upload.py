@@ -0,0 +1,234 @@
+import os
+import re
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+
+import tornado.web
+
+import conf
+from workers import workers
+
+# most bytes of part headers, and of a form field that is not a file
+MAX_HEADERS = 16 * 1024
+MAX_FIELD = 64 * 1024
+
+class MultipartSpool:
+    '''
+    Parses a multipart/form-data body as it arrives. The contents of
+    every file part are written to a spool file of their own, so an
+    upload never has to be held in memory; other form fields are
+    kept as strings.
+
+    After close(), `files` maps field names to lists of
+    {"filename", "path", "size"} and `fields` maps field names to values.
+    The spool files belong to the caller from then on: discard leaves
+    them alone, so that a client closing the connection while they are
+    being stored doesn't pull them away.
+    '''
+
+    def __init__(self, boundary, directory):
+        self.delimiter = "\r\n--" + boundary
+        self.directory = directory
+
+        # the body starts with the delimiter less its line break
+        self.buffer = "\r\n"
+        self.state = "preamble"
+
+        self.files = {}
+        self.fields = {}
+
+        # the part being read: (field name, open spool file or None, value)
+        self.part = None
+        # set once the files are handed over by close()
+        self.closed = False
+
+    def feed(self, data):
+        self.buffer += data
+        while self.step():
+            pass
+
+    def close(self):
+        if self.state != "done":
+            self.discard()
+            raise tornado.web.HTTPError(400, "incomplete multipart body")
+        self.closed = True
+        return self.files, self.fields
+
+    def discard(self):
+        if self.closed:
+            return
+        if self.part is not None and self.part[1] is not None:
+            self.part[1].close()
+        for parts in self.files.values():
+            for part in parts:
+                if os.path.exists(part["path"]):
+                    os.remove(part["path"])
+
+    # HELPER FUNCTIONS
+    def step(self):
+        '''
+        Consume as much of the buffer as the current state allows.
+        Returns True if the state changed and there may be more to do.
+        '''
+
+        if self.state == "preamble" or self.state == "body":
+            i = self.buffer.find(self.delimiter)
+            if i < 0:
+                # keep what could be the start of a delimiter
+                keep = len(self.delimiter) - 1
+                if len(self.buffer) > keep:
+                    self.write(self.buffer[:-keep])
+                    self.buffer = self.buffer[-keep:]
+                return False
+
+            self.write(self.buffer[:i])
+            self.end_part()
+            self.buffer = self.buffer[i + len(self.delimiter):]
+            self.state = "delimiter"
+            return True
+
+        if self.state == "delimiter":
+            if len(self.buffer) < 2:
+                return False
+            if self.buffer.startswith("--"):
+                self.state = "done"
+            elif self.buffer.startswith("\r\n"):
+                self.state = "headers"
+            else:
+                raise tornado.web.HTTPError(400, "malformed multipart body")
+            self.buffer = self.buffer[2:]
+            return True
+
+        if self.state == "headers":
+            i = self.buffer.find("\r\n\r\n")
+            if i < 0:
+                if len(self.buffer) > MAX_HEADERS:
+                    raise tornado.web.HTTPError(400, "multipart headers too long")
+                return False
+
+            self.start_part(self.buffer[:i])
+            self.buffer = self.buffer[i + 4:]
+            self.state = "body"
+            return True
+
+        # done: anything after the closing delimiter is ignored
+        self.buffer = ""
+        return False
+
+    def start_part(self, headers):
+        disposition = re.search(r"(?im)^content-disposition:(.*)$", headers)
+        if disposition is None:
+            raise tornado.web.HTTPError(400, "multipart part without content-disposition")
+
+        name = header_parameter(disposition.group(1), "name")
+        filename = header_parameter(disposition.group(1), "filename")
+        if not filename:
+            self.part = (name, None, "")
+            return
+
+        fd, path = tempfile.mkstemp(prefix="upload-", dir=self.directory)
+        # stored files get the usual permissions, not those of a temporary file
+        os.chmod(path, 0644)
+        self.files.setdefault(name, []).append({"filename": filename, "path": path, "size": 0})
+        self.part = (name, os.fdopen(fd, "wb"), None)
+
+    def write(self, data):
+        if self.part is None or not data:
+            return
+
+        name, fp, value = self.part
+        if fp is not None:
+            fp.write(data)
+            self.files[name][-1]["size"] += len(data)
+        elif len(value) + len(data) > MAX_FIELD:
+            raise tornado.web.HTTPError(400, "form field %s too long" % name)
+        else:
+            self.part = (name, None, value + data)
+
+    def end_part(self):
+        if self.part is None:
+            return
+
+        name, fp, value = self.part
+        if fp is not None:
+            fp.close()
+        else:
+            self.fields[name] = value
+        self.part = None
+
+def header_parameter(header, parameter):
+    match = re.search(r'(?i)(?:^|;)\s*%s="([^"]*)"' % parameter, header)
+    if match is None:
+        return None
+    return match.group(1)
+
+def start_spool(request):
+    '''
+    A MultipartSpool for the body of the given request.
+    '''
+
+    match = re.search(r'boundary="?([^";]+)"?', request.headers.get("Content-Type", ""))
+    if not request.headers.get("Content-Type", "").startswith("multipart/form-data") or match is None:
+        raise tornado.web.HTTPError(400, "uploads must be multipart/form-data")
+
+    directory = conf.UPLOAD_SPOOL_DIRECTORY or tempfile.gettempdir()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return MultipartSpool(match.group(1), directory)
+
+class UploadJobs:
+    '''
+    Uploads being ingested by the workers, and the outcome of the last
+    `keep` of them, by job id: {"state": "pending" | "done" | "failed",
+    "errors": ...}.
+    '''
+
+    def __init__(self, keep):
+        self.keep = keep
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        '''
+        Run fn(*args), which returns the errors of an upload, on the
+        workers. Returns the job id and the Future of the errors.
+        '''
+
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            self.jobs[job_id] = {"state": "pending", "errors": ""}
+            while len(self.jobs) > self.keep:
+                self.jobs.popitem(last=False)
+
+        try:
+            future = workers.submit(fn, *args)
+        except tornado.web.HTTPError:
+            with self.lock:
+                self.jobs.pop(job_id, None)
+            raise
+
+        future.add_done_callback(lambda future: self.finished(job_id, future))
+        return job_id, future
+
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            return dict(job)
+
+    # HELPER FUNCTIONS
+    def finished(self, job_id, future):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+
+            if future.exception() is not None:
+                job.update(state="failed", errors=str(future.exception()))
+            else:
+                job.update(state="done", errors=future.result())
+
+upload_jobs = UploadJobs(conf.UPLOAD_JOBS_KEPT)
@@ -0,0 +1,188 @@
+import os
+import threading
+import time
+from collections import deque
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import tornado.web
+
+import conf
+
+class DocumentQueue:
+    '''
+    Jobs waiting for one document, along with how long they waited
+    and how many were waiting at most. Only kept while the document
+    has jobs waiting or running.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        # (time queued, future, fn, args, kwargs), oldest first
+        self.jobs = deque()
+        self.running = False
+
+        self.processed = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def stats(self):
+        mean_wait = 0.0
+        if self.processed:
+            mean_wait = self.total_wait / self.processed
+
+        return {
+            "depth": len(self.jobs),
+            "max_depth": self.max_depth,
+            "processed": self.processed,
+            "mean_wait": mean_wait,
+            "max_wait": self.max_wait
+        }
+
+class Workers:
+    '''
+    Pool of threads for the blocking part of requests: parsing,
+    modifying and serializing documents, and copying files. Handlers
+    yield the returned futures, so the IOLoop stays free to serve
+    other requests in the meantime.
+
+    Jobs on a document are queued per document and run one at a time,
+    in the order they were submitted, while jobs on different documents
+    run in parallel. A document only holds a thread for one job at a
+    time, so a busy document can't starve the others.
+
+    At most `max_queued` jobs may be waiting or running at a time;
+    further submissions are refused with a 503 so that clients back
+    off instead of piling up work.
+    '''
+
+    def __init__(self, workers, max_queued):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.pool = ThreadPoolExecutor(workers)
+
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.queued = 0
+        self.rejected = 0
+        self.closed = False
+
+        # absolute path -> DocumentQueue, of the documents with jobs
+        self.queues = {}
+
+    def submit(self, fn, *args, **kwargs):
+        '''
+        Run fn(*args, **kwargs) on the pool and return its Future.
+        '''
+
+        with self.lock:
+            self.reserve()
+
+        future = self.pool.submit(fn, *args, **kwargs)
+        future.add_done_callback(self.done)
+        return future
+
+    def submit_document(self, path, fn, *args, **kwargs):
+        '''
+        Like submit, for jobs that read or modify the document at path.
+        The job runs after all jobs submitted before it for the same
+        document have finished.
+        '''
+
+        path = os.path.abspath(path)
+        future = Future()
+
+        with self.lock:
+            self.reserve()
+
+            queue = self.queues.get(path)
+            if queue is None:
+                queue = self.queues[path] = DocumentQueue(path)
+
+            queue.jobs.append((time.time(), future, fn, args, kwargs))
+            queue.max_depth = max(queue.max_depth, len(queue.jobs))
+
+            start = not queue.running
+            queue.running = True
+
+        if start:
+            self.pool.submit(self.run_next, queue)
+
+        return future
+
+    def shutdown(self):
+        '''
+        Refuse new jobs, wait for the submitted ones to finish
+        and stop the threads.
+        '''
+
+        with self.lock:
+            self.closed = True
+            while self.queued:
+                self.idle.wait()
+
+        self.pool.shutdown(wait=True)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "queued": self.queued,
+                "rejected": self.rejected,
+                "documents": dict((path, queue.stats()) for path, queue in self.queues.items())
+            }
+
+    # HELPER FUNCTIONS
+    def reserve(self):
+        '''
+        Count a new job, or refuse it. Called with the lock held.
+        '''
+
+        if self.closed or self.queued >= self.max_queued:
+            self.rejected += 1
+            raise tornado.web.HTTPError(503, "too many requests waiting")
+        self.queued += 1
+
+    def run_next(self, queue):
+        '''
+        Run the oldest job of a document, then hand the document back
+        to the pool if more jobs are waiting for it.
+        '''
+
+        with self.lock:
+            queued_at, future, fn, args, kwargs = queue.jobs.popleft()
+
+            wait = time.time() - queued_at
+            queue.processed += 1
+            queue.total_wait += wait
+            queue.max_wait = max(queue.max_wait, wait)
+
+        if future.set_running_or_notify_cancel():
+            try:
+                result = fn(*args, **kwargs)
+            except Exception, e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+        with self.lock:
+            more = len(queue.jobs) > 0
+            queue.running = more
+            if not more:
+                # idle, so that the queues don't pile up for every
+                # path ever asked for
+                del self.queues[queue.path]
+
+        if more:
+            self.pool.submit(self.run_next, queue)
+
+        self.done(future)
+
+    def done(self, future):
+        with self.lock:
+            self.queued -= 1
+            if self.queued == 0:
+                self.idle.notify_all()
+
+workers = Workers(conf.EDIT_WORKERS, conf.EDIT_QUEUE_DEPTH)
@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+
+import tornado.ioloop
+import tornado.web
+
+import conf
+from workers import workers
+
+class WriteBehind:
+    '''
+    Coalesces the writes of edited documents. Instead of writing a
+    document to disk after every edit, a write is scheduled once the
+    document has been left alone for `quiet` seconds, but no later
+    than `max_delay` seconds after the first unwritten edit. Further
+    edits in the meantime are folded into the same write.
+    With a quiet period of 0 every write happens immediately.
+
+    Due writes are picked up by a periodic sweep on the IOLoop (see
+    start) and performed by the document workers.
+    '''
+
+    def __init__(self, quiet, max_delay):
+        self.quiet = quiet
+        self.max_delay = max_delay
+
+        # path -> [time of first unwritten edit, deadline, write callback]
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.quiet > 0:
+            interval = min(self.quiet, self.max_delay) / 4.0
+            tornado.ioloop.PeriodicCallback(self.sweep, interval * 1000).start()
+
+    def schedule(self, path, write):
+        '''
+        Schedule write() to persist the document at the given path.
+        '''
+
+        if self.quiet <= 0:
+            write()
+            return
+
+        path = os.path.abspath(path)
+        now = time.time()
+
+        with self.lock:
+            first = now
+            if path in self.pending:
+                first = self.pending[path][0]
+
+            deadline = min(now + self.quiet, first + self.max_delay)
+            self.pending[path] = [first, deadline, write]
+
+    def flush(self, path):
+        '''
+        Perform the pending write of the given document now, if any.
+        Must be called, as document work, before anything else reads
+        or replaces the document on disk.
+        '''
+
+        with self.lock:
+            pending = self.pending.pop(os.path.abspath(path), None)
+
+        if pending is not None:
+            pending[2]()
+
+    def flush_all(self):
+        '''
+        Perform all pending writes. Only call once no document work
+        can be running any more, e.g. at shutdown.
+        '''
+
+        for path in list(self.pending):
+            self.flush(path)
+
+    def discard(self, path):
+        '''
+        Forget the pending write of the given document without performing it.
+        '''
+
+        with self.lock:
+            self.pending.pop(os.path.abspath(path), None)
+
+    def is_dirty(self, path):
+        return os.path.abspath(path) in self.pending
+
+    # HELPER FUNCTIONS
+    def sweep(self):
+        now = time.time()
+        with self.lock:
+            due = [path for path, pending in self.pending.items() if pending[1] <= now]
+            for path in due:
+                # don't submit it again while the flush is waiting to run
+                self.pending[path][1] = float("inf")
+
+        for i, path in enumerate(due):
+            try:
+                workers.submit_document(path, self.flush, path)
+            except tornado.web.HTTPError:
+                # the workers are saturated, try the rest on the next sweep
+                with self.lock:
+                    for path in due[i:]:
+                        if path in self.pending:
+                            self.pending[path][1] = now
+                break
+
+pending_writes = WriteBehind(conf.WRITE_BEHIND_QUIET, conf.WRITE_BEHIND_MAX_DELAY)
@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import os
+import signal
 
 import tornado.httpserver
 import tornado.ioloop
@@ -8,9 +9,12 @@ import tornado.web
 
 import conf
 import neonsrv.interface
+import neonsrv.recorder
 import neonsrv.tornadoapi
+from neonsrv.writebehind import pending_writes
+from neonsrv.workers import workers
 
-assert tornado.version_info > (2, 0, 0)
+assert tornado.version_info >= (4, 0, 0)
 
 settings = {
     "static_path": os.path.join(os.path.dirname(__file__), "static"),
@@ -28,39 +32,23 @@ def abs_path(relpath):
 rules = [
     (abs_path(r"/editor/(.*?)"), neonsrv.interface.SquareNoteEditorHandler),
     (abs_path(r"/stafflesseditor/(.*?)"), neonsrv.interface.StafflessEditorHandler),
-    (abs_path(r"/file/(.*)/(.*?)"), neonsrv.interface.DemoFileHandler),
-    (abs_path(r"/file/(.*?)"), neonsrv.interface.FileHandler),
+    (abs_path(r"/file/(.*)/(.*?)"), neonsrv.interface.DemoFileHandler, {"path": conf.MEI_DIRECTORY}),
+    (abs_path(r"/file/(.*?)"), neonsrv.interface.FileHandler, {"path": conf.MEI_DIRECTORY}),
+    (abs_path(r"/files/(.*?)"), neonsrv.interface.FileListHandler),
+    (abs_path(r"/tiles/([^/]+)/([^/]+)/info.json"), neonsrv.interface.TileInfoHandler),
+    (abs_path(r"/tiles/([^/]+)/([^/]+)/([0-9a-f]+-[0-9a-f]+)/([0-9]+)/([0-9]+_[0-9]+)\.jpg"), neonsrv.interface.TileHandler, {"path": conf.MEI_DIRECTORY}),
+    (abs_path(r"/previews/([^/]+)/([^/]+)/(thumbnail|preview)\.jpg"), neonsrv.interface.PreviewHandler, {"path": conf.MEI_DIRECTORY}),
+    (abs_path(r"/upload"), neonsrv.interface.UploadHandler),
+    (abs_path(r"/upload/(.*?)"), neonsrv.interface.UploadStatusHandler),
     (abs_path(r"/delete/(.*?)"), neonsrv.interface.DeleteFileHandler),
     (abs_path(r"/edit/(.*?)/(.*?)/revert"), neonsrv.interface.FileRevertHandler),
     (abs_path(r"/edit/(.*?)/(.*?)/undo"), neonsrv.interface.FileUndoHandler),
     (abs_path(r"/edit/(.*?)/(.*?)/delete"), neonsrv.interface.DeleteUndosHandler),
-    (abs_path(r"/edit/(.*?)/insert/neume"), neonsrv.tornadoapi.InsertNeumeHandler),
-    (abs_path(r"/edit/(.*?)/move/neume"), neonsrv.tornadoapi.ChangeNeumePitchHandler),
-    (abs_path(r"/edit/(.*?)/delete/neume"), neonsrv.tornadoapi.DeleteNeumeHandler),
-    (abs_path(r"/edit/(.*?)/update/neume/headshape"), neonsrv.tornadoapi.UpdateNeumeHeadShapeHandler),
-    (abs_path(r"/edit/(.*?)/neumify"), neonsrv.tornadoapi.NeumifyNeumeHandler),
-    (abs_path(r"/edit/(.*?)/ungroup"), neonsrv.tornadoapi.UngroupNeumeHandler),
-    (abs_path(r"/edit/(.*?)/insert/division"), neonsrv.tornadoapi.InsertDivisionHandler),
-    (abs_path(r"/edit/(.*?)/move/division"), neonsrv.tornadoapi.MoveDivisionHandler),
-    (abs_path(r"/edit/(.*?)/delete/division"), neonsrv.tornadoapi.DeleteDivisionHandler),
-    (abs_path(r"/edit/(.*?)/update/division/shape"), neonsrv.tornadoapi.UpdateDivisionShapeHandler),
-    (abs_path(r"/edit/(.*?)/insert/dot"), neonsrv.tornadoapi.AddDotHandler),
-    (abs_path(r"/edit/(.*?)/delete/dot"), neonsrv.tornadoapi.DeleteDotHandler),
-    (abs_path(r"/edit/(.*?)/insert/episema"), neonsrv.tornadoapi.AddEpisemaHandler),
-    (abs_path(r"/edit/(.*?)/delete/episema"), neonsrv.tornadoapi.DeleteEpisemaHandler),
-    (abs_path(r"/edit/(.*?)/insert/clef"), neonsrv.tornadoapi.InsertClefHandler),
-    (abs_path(r"/edit/(.*?)/move/clef"), neonsrv.tornadoapi.MoveClefHandler),
-    (abs_path(r"/edit/(.*?)/update/clef/shape"), neonsrv.tornadoapi.UpdateClefShapeHandler),
-    (abs_path(r"/edit/(.*?)/delete/clef"), neonsrv.tornadoapi.DeleteClefHandler),
-    (abs_path(r"/edit/(.*?)/insert/custos"), neonsrv.tornadoapi.InsertCustosHandler),
-    (abs_path(r"/edit/(.*?)/move/custos"), neonsrv.tornadoapi.MoveCustosHandler),
-    (abs_path(r"/edit/(.*?)/delete/custos"), neonsrv.tornadoapi.DeleteCustosHandler),
-    (abs_path(r"/edit/(.*?)/insert/system"), neonsrv.tornadoapi.InsertSystemHandler),
-    (abs_path(r"/edit/(.*?)/insert/systembreak"), neonsrv.tornadoapi.InsertSystemBreakHandler),
-    (abs_path(r"/edit/(.*?)/modify/systembreak"), neonsrv.tornadoapi.ModifySystemBreakHandler),
-    (abs_path(r"/edit/(.*?)/delete/systembreak"), neonsrv.tornadoapi.DeleteSystemBreakHandler),
-    (abs_path(r"/edit/(.*?)/delete/system"), neonsrv.tornadoapi.DeleteSystemHandler),
-    (abs_path(r"/edit/(.*?)/update/system/zone"), neonsrv.tornadoapi.UpdateSystemZoneHandler),
+    (abs_path(r"/edit/(.*?)/batch"), neonsrv.tornadoapi.BatchHandler),
+    (abs_path(r"/edit/(.*?)/region"), neonsrv.tornadoapi.RegionHandler),
+    (abs_path(r"/edit/(.*?)/render"), neonsrv.tornadoapi.RenderModelHandler),
+    (abs_path(r"/edit/(.*)"), neonsrv.tornadoapi.EditRouter),
+    (abs_path(r"/feed/(.*?)"), neonsrv.tornadoapi.FeedHandler),
     (abs_path(r"\/?(.*?)"), neonsrv.interface.RootHandler)
 ]
 
@@ -72,6 +60,7 @@ if conf.DEBUG:
     test_static = os.path.join(os.path.dirname(__file__), "test")
     rules.append((abs_path(r"/test/(.*)"), tornado.web.StaticFileHandler, {"path": test_static}))
     rules.append((abs_path(r"/test"), TestHandler))
+    rules.insert(0, (abs_path(r"/stats"), neonsrv.interface.StatsHandler))
 
 if __name__ == "__main__":
     import sys
@@ -106,7 +95,20 @@ if __name__ == "__main__":
     settings["default"] = default
 
     application = tornado.web.Application(rules, **settings)
+    if conf.EDIT_LOG:
+        # ahead of compression, so that responses are recorded as written
+        application.transforms.insert(0, neonsrv.recorder.RecordingTransform)
     
     server = tornado.httpserver.HTTPServer(application)
     server.listen(port)
-    tornado.ioloop.IOLoop.instance().start()
+
+    io_loop = tornado.ioloop.IOLoop.instance()
+    signal.signal(signal.SIGTERM, lambda signum, frame: io_loop.add_callback_from_signal(io_loop.stop))
+    pending_writes.start()
+    try:
+        io_loop.start()
+    finally:
+        # let running edits finish, then write out documents with
+        # edits still waiting in write-behind
+        workers.shutdown()
+        pending_writes.flush_all()
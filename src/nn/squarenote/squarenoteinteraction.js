@@ -1096,32 +1096,22 @@ Toe.View.SquareNoteInteraction.prototype.handleMergeSystems = function(e) {
 
     // 5. code for actually deleting the system! + adjusting system breaks after the deleted
     var finishMerge = function () {
+        // all deletions are sent to the server in a single batch
+        var operations = [];
         for (var i = systems[fullSystemIndex].eleRef.elements.length-1; i >= 0; i--) {
             // we must delete elements from the mei
             if (systems[fullSystemIndex].eleRef.elements[i] instanceof Toe.Model.Clef) {
                 var info = [{id: systems[fullSystemIndex].eleRef.elements[i].id, pitchInfo: null}];
-                $.post(gui.apiprefix + "/delete/clef", {data: JSON.stringify(info)})
-                    .error(function() {
-                        gui.showAlert("Server failed to delete clef. Client and server are not synchronized.");
-                    });
+                operations.push({op: "delete_clef", args: {clef_data: info}});
             }
             else if (systems[fullSystemIndex].eleRef.elements[i] instanceof Toe.Model.Neume) {
-                $.post(gui.apiprefix + "/delete/neume",  {ids: systems[fullSystemIndex].eleRef.elements[i].id})
-                    .error(function() {
-                        gui.showAlert("Server failed to delete neume. Client and server are not synchronized.");
-                    });
+                operations.push({op: "delete_neume", args: {ids: [systems[fullSystemIndex].eleRef.elements[i].id]}});
             }
             else if (systems[fullSystemIndex].eleRef.elements[i] instanceof Toe.Model.Division) {
-                $.post(gui.apiprefix + "/delete/division", {ids: systems[fullSystemIndex].eleRef.elements[i].id})
-                    .error(function() {
-                        gui.showAlert("Server failed to delete division. Client and server are not synchronized.");
-                    });
+                operations.push({op: "delete_division", args: {ids: [systems[fullSystemIndex].eleRef.elements[i].id]}});
             }
             else if (systems[fullSystemIndex].eleRef.elements[i] instanceof Toe.Model.Custos) {
-                $.post(gui.apiprefix + "/delete/custos", {ids: systems[fullSystemIndex].eleRef.elements[i].id})
-                    .error(function() {
-                        gui.showAlert("Server failed to delete custos. Client and server are not synchronized.");
-                    });
+                operations.push({op: "delete_custos", args: {ids: [systems[fullSystemIndex].eleRef.elements[i].id]}});
             }
 
             // we delete the elements from fabric
@@ -1129,6 +1119,12 @@ Toe.View.SquareNoteInteraction.prototype.handleMergeSystems = function(e) {
             gui.rendEng.canvas.remove(systems[fullSystemIndex].eleRef.elements[i]);
 
         }
+        if (operations.length > 0) {
+            $.post(gui.apiprefix + "/batch", {data: JSON.stringify(operations)})
+                .error(function() {
+                    gui.showAlert("Server failed to delete system elements. Client and server are not synchronized.");
+                });
+        }
         deleteSystem(systems[0]);
         deleteSystem(systems[1]);
         gui.showInfo("Merging Systems, this may take a minute!")
@@ -2363,34 +2359,27 @@ Toe.View.SquareNoteInteraction.prototype.deleteActiveSelection = function(aGui)
         }
     }
 
-    // Call the server to delete stuff.
+    // Call the server to delete stuff, all in one batch.
+    // Clefs go first: their pitch updates may still refer to elements deleted below.
+    var operations = [];
+    if (toDelete.clefs.length > 0) {
+        operations.push({op: "delete_clef", args: {clef_data: toDelete.clefs}});
+    }
     if (toDelete.nids.length > 0) {
-        // send delete command to server to change underlying MEI
-        $.post(aGui.apiprefix + "/delete/neume",  {ids: toDelete.nids.join(",")})
-        .error(function() {
-            gui.showAlert("Server failed to delete neume. Client and server are not synchronized.");
-        });
+        operations.push({op: "delete_neume", args: {ids: toDelete.nids}});
     }
     if (toDelete.dids.length > 0) {
-        // send delete command to server to change underlying MEI
-        $.post(aGui.apiprefix + "/delete/division", {ids: toDelete.dids.join(",")})
-        .error(function() {
-            gui.showAlert("Server failed to delete division. Client and server are not synchronized.");
-        });
+        operations.push({op: "delete_division", args: {ids: toDelete.dids}});
     }
     if (toDelete.cids.length > 0) {
-        // send delete command to server to change underlying MEI
-        $.post(aGui.apiprefix + "/delete/custos", {ids: toDelete.cids.join(",")})
-        .error(function() {
-            gui.showAlert("Server failed to delete custos. Client and server are not synchronized.");
-        });
+        operations.push({op: "delete_custos", args: {ids: toDelete.cids}});
     }
 
-    if (toDelete.clefs.length > 0) {
-        // send delete command to the server to change underlying MEI
-        $.post(aGui.apiprefix + "/delete/clef", {data: JSON.stringify(toDelete.clefs)})
+    if (operations.length > 0) {
+        // send delete command to server to change underlying MEI
+        $.post(aGui.apiprefix + "/batch", {data: JSON.stringify(operations)})
         .error(function() {
-            gui.showAlert("Server failed to delete clef. Client and server are not synchronized.");
+            gui.showAlert("Server failed to delete elements. Client and server are not synchronized.");
         });
     }
 
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from neonsrv.doccache import DocumentCache
+
+class DocumentCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.loads = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_file(self, name, contents):
+        path = os.path.join(self.dir, name)
+        fp = open(path, "w")
+        fp.write(contents)
+        fp.close()
+        return path
+
+    def load(self, path):
+        self.loads.append(path)
+        return object()
+
+    def testHit(self):
+        cache = DocumentCache(4, 1024)
+        path = self.make_file("a.mei", "abc")
+        first = cache.get(path, self.load)
+        self.assertTrue(first is cache.get(path, self.load))
+        self.assertEqual(1, len(self.loads))
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+    def testChangedOnDisk(self):
+        cache = DocumentCache(4, 1024)
+        path = self.make_file("a.mei", "abc")
+        first = cache.get(path, self.load)
+        self.make_file("a.mei", "abcdef")
+        self.assertFalse(first is cache.get(path, self.load))
+        self.assertEqual(2, cache.misses)
+        self.assertEqual(6, cache.size)
+
+    def testRefresh(self):
+        cache = DocumentCache(4, 1024)
+        path = self.make_file("a.mei", "abc")
+        first = cache.get(path, self.load)
+        self.make_file("a.mei", "abcdef")
+        cache.refresh(path)
+        self.assertTrue(first is cache.get(path, self.load))
+
+    def testEvictByCount(self):
+        cache = DocumentCache(2, 1024)
+        a = self.make_file("a.mei", "a")
+        b = self.make_file("b.mei", "b")
+        c = self.make_file("c.mei", "c")
+        cache.get(a, self.load)
+        cache.get(b, self.load)
+        # a becomes the most recently used, so b is evicted
+        cache.get(a, self.load)
+        cache.get(c, self.load)
+        self.assertEqual([a, c], list(cache.entries.keys()))
+        self.assertEqual(1, cache.evictions)
+
+    def testEvictByBytes(self):
+        cache = DocumentCache(8, 10)
+        a = self.make_file("a.mei", "x" * 6)
+        b = self.make_file("b.mei", "x" * 6)
+        cache.get(a, self.load)
+        cache.get(b, self.load)
+        self.assertEqual([b], list(cache.entries.keys()))
+        self.assertEqual(6, cache.size)
+
+    def testInvalidate(self):
+        cache = DocumentCache(4, 1024)
+        path = self.make_file("a.mei", "abc")
+        cache.get(path, self.load)
+        cache.invalidate(path)
+        self.assertEqual(0, cache.size)
+        cache.get(path, self.load)
+        self.assertEqual(2, len(self.loads))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/python
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from neonsrv.feed import ChangeFeed
+
+class Subscriber:
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, message):
+        self.messages.append(message)
+
+def change(revision):
+    return {"revision": revision, "delta": {}}
+
+class ChangeFeedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.feed = ChangeFeed(3)
+
+    def testDeliver(self):
+        a = Subscriber()
+        b = Subscriber()
+        self.assertEqual([], self.feed.subscribe("/mei/a.mei", a))
+        self.feed.subscribe("/mei/b.mei", b)
+
+        self.feed.deliver("/mei/a.mei", change(1))
+        self.assertEqual([change(1)], a.messages)
+        self.assertEqual([], b.messages)
+
+        self.feed.unsubscribe("/mei/a.mei", a)
+        self.feed.deliver("/mei/a.mei", change(2))
+        self.assertEqual([change(1)], a.messages)
+
+    def testCatchUp(self):
+        # nothing is known about the document yet
+        self.assertEqual(None, self.feed.subscribe("/mei/a.mei", Subscriber(), 0))
+
+        for revision in range(1, 6):
+            self.feed.deliver("/mei/a.mei", change(revision))
+
+        self.assertEqual([change(4), change(5)], self.feed.subscribe("/mei/a.mei", Subscriber(), 3))
+        self.assertEqual([], self.feed.subscribe("/mei/a.mei", Subscriber(), 5))
+        # revisions 2 and 3 have left the backlog
+        self.assertEqual(None, self.feed.subscribe("/mei/a.mei", Subscriber(), 1))
+
+if __name__ == "__main__":
+    unittest.main()
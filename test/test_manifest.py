@@ -0,0 +1,88 @@
+#!/usr/bin/python
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from neonsrv.manifest import Manifests
+
+class ManifestsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dir, "squarenote"))
+        self.manifests = Manifests(self.dir, 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_file(self, name, contents):
+        fp = open(os.path.join(self.dir, "squarenote", name), "w")
+        fp.write(contents)
+        fp.close()
+
+    def testEntries(self):
+        self.make_file("b.mei", '<layer><sb n="1"/><clef/><neume name="punctum"><nc/></neume><neume/></layer>')
+        self.make_file("b.jpg", "")
+        self.make_file("a.mei", "<layer/>")
+
+        entries = self.manifests.files("squarenote")
+        self.assertEqual(["a.mei", "b.mei"], [entry["name"] for entry in entries])
+        self.assertEqual([False, True], [entry["image"] for entry in entries])
+        self.assertEqual({"neume": 2, "clef": 1, "division": 0, "custos": 0, "sb": 1}, entries[1]["counts"])
+        self.assertEqual(["squarenote"], self.manifests.document_types())
+
+    def testChanges(self):
+        self.make_file("a.mei", "<layer/>")
+        self.assertEqual(0, self.manifests.files("squarenote")[0]["counts"]["neume"])
+
+        self.make_file("a.mei", "<layer><neume/></layer>")
+        self.make_file("c.mei", "<layer/>")
+        entries = self.manifests.files("squarenote")
+        self.assertEqual(["a.mei", "c.mei"], [entry["name"] for entry in entries])
+        self.assertEqual(1, entries[0]["counts"]["neume"])
+
+    def testNewImages(self):
+        found = []
+        self.manifests.on_new_image = found.append
+        image = os.path.join(os.path.abspath(self.dir), "squarenote", "a.jpg")
+
+        self.make_file("a.mei", "<layer/>")
+        self.manifests.files("squarenote")
+        self.assertEqual([], found)
+
+        # added, then replaced, next to the same MEI file
+        self.make_file("a.jpg", "jpeg")
+        self.manifests.files("squarenote")
+        self.make_file("a.jpg", "another jpeg")
+        self.manifests.files("squarenote")
+        self.assertEqual([image, image], found)
+
+        self.make_file("b.mei", "<layer/>")
+        self.manifests.files("squarenote")
+        self.assertEqual([image, image], found)
+
+    def testOverwrittenInPlace(self):
+        found = []
+        self.manifests.on_new_image = found.append
+        directory = os.path.join(self.dir, "squarenote")
+        # the directory looks unchanged since long ago
+        settled = time.time() - 100
+
+        self.make_file("a.mei", "<layer/>")
+        self.make_file("a.jpg", "jpeg")
+        os.utime(directory, (settled, settled))
+        self.manifests.files("squarenote")
+
+        self.make_file("a.mei", "<layer><neume/></layer>")
+        self.make_file("a.jpg", "another jpeg")
+        os.utime(directory, (settled, settled))
+        entries = self.manifests.files("squarenote")
+        self.assertEqual(1, entries[0]["counts"]["neume"])
+        self.assertEqual(2, len(found))
+
+if __name__ == "__main__":
+    unittest.main()
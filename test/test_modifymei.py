@@ -0,0 +1,267 @@
+#!/usr/bin/python
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
+import tornado.web
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from neonsrv.modifymei import ModifyDocument, snapshot_element, attribute_value, zone_box
+from neonsrv import tornadoapi
+from neonsrv.tornadoapi import check_operation, apply_operations, modify_document
+from neonsrv.writebehind import pending_writes
+
+DATA = os.path.join(os.path.dirname(__file__), "data", "allneumes.mei")
+
+# neumes of the first staff of allneumes.mei
+PUNCTUM = "m-c5db8f43-f4d7-4f55-99b5-f131a4ef25ac"
+PUNCTUM_ZONE = "m-6904e913-8171-4b87-b372-4562510b1711"
+PUNCTUM_NOTE = "m-481b58c2-bace-4b33-bad0-14dca21a9112"
+CAVUM = "m-4e7be433-7e4b-4caf-97f2-32e711a9eb74"
+CAVUM_NOTE = "m-4ce01c15-cdd0-4198-9ffd-0aa3c4fc66f0"
+CAVUM_ZONE = "m-7e519001-1bfd-4435-b23b-7766a9eaf3f3"
+# the neume after them
+NEXT = "m-24625709-de51-4cc0-9ac1-8d33fe385dee"
+# the first system
+SYSTEM = "m-3bef2631-94de-46cf-9664-d76d05b8a983"
+# the fourth and fifth of its nine staves
+STAFF_4 = "m-65d62af5-418c-4952-908d-88983279162b"
+STAFF_5 = "m-b2c2ff19-4ebe-4563-a29c-3bf5809f01da"
+
+class ModifyDocumentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dir, "squarenote"))
+        self.path = os.path.join(self.dir, "squarenote", "allneumes")
+        shutil.copy(DATA, self.path + ".mei")
+        # the index is checked against the tree on every commit
+        self.md = ModifyDocument(self.path, debug_index=True)
+        self.original = self.tree()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def load(self, mei):
+        fp = open(self.path + ".mei", "w")
+        fp.write(mei)
+        fp.close()
+        self.md = ModifyDocument(self.path, debug_index=True)
+        self.original = self.tree()
+
+    def read(self):
+        fp = open(self.path + ".mei")
+        mei = fp.read()
+        fp.close()
+        return mei
+
+    def staff_numbers(self, parent_name, name):
+        return [[attribute_value(e, "n") for e in parent.getChildrenByName(name)]
+                for parent in self.md.get_elements_by_name(parent_name)]
+
+    def split_staff(self, staff_id):
+        # a final division before the third element of the staff
+        layer = self.md.get_element(staff_id).getChildrenByName("layer")[0]
+        before = layer.getChildren()[2].getId()
+        self.edit("insert_division", before, "final", "1", "1", "5", "9")
+        return before
+
+    def tree(self):
+        return snapshot_element(self.md.mei.getRootElement())
+
+    def edit(self, operation, *args):
+        result = getattr(self.md, operation)(*args)
+        self.md.commit()
+        return result
+
+    def undo(self):
+        self.assertTrue(self.md.undo())
+        self.md.commit()
+
+    def testUndoAfterReopen(self):
+        self.md.write_doc()
+        written = self.read()
+
+        self.edit("insert_punctum", "punctum", None, None, CAVUM, "c", "4", None, None, "1", "1", "9", "9")
+        self.edit("update_neume_head_shape", PUNCTUM, "virga", "2", "2", "8", "8")
+        self.edit("delete_neume", [CAVUM])
+        self.md.write_doc()
+
+        # the history is read back along with the document
+        self.md = ModifyDocument(self.path, debug_index=True)
+        for i in range(3):
+            self.undo()
+        self.assertFalse(self.md.undo())
+        self.md.write_doc()
+        self.assertEqual(written, self.read())
+
+    def testFailedBatch(self):
+        operations = [
+            {"op": "move_neume", "args": {"id": PUNCTUM, "before_id": NEXT, "pitch_info": None,
+                                          "ulx": "1", "uly": "1", "lrx": "9", "lry": "9"}},
+            {"op": "neumify", "args": {"ids": [CAVUM], "type_id": "punctum", "liquescence": None,
+                                       "head_shapes": ["punctum"], "ulx": "1", "uly": "1", "lrx": "9", "lry": "9"}},
+            {"op": "delete_neume", "args": {"ids": ["m-missing"]}}
+        ]
+        calls = [check_operation(i, operation) for i, operation in enumerate(operations)]
+
+        # as modify_document does when an edit fails
+        self.assertRaises(AttributeError, apply_operations, self.md, calls)
+        self.md.rollback()
+        self.assertEqual(self.original, self.tree())
+        self.assertEqual(0, self.md.revision())
+        self.assertFalse(self.md.undo())
+
+    def testRenderAfterZoneUpdate(self):
+        entries = lambda model: dict((e["id"], e) for system in model["systems"] for e in system["elements"])
+        before = entries(self.md.render_model())
+
+        self.edit("update_neume_head_shape", CAVUM, "cavum", "1", "2", "3", "4")
+        self.edit("update_system_zone", SYSTEM, "5", "6", "7", "8")
+        model = self.md.render_model()
+        after = entries(model)
+
+        self.assertEqual((1.0, 2.0, 3.0, 4.0), after[CAVUM]["box"])
+        self.assertEqual((5.0, 6.0, 7.0, 8.0), model["systems"][0]["box"])
+        # only the entry of the neume was rendered again
+        self.assertEqual(sorted(before), sorted(after))
+        self.assertEqual([CAVUM], [id for id in after if after[id] is not before[id]])
+
+    def testDelta(self):
+        layer = self.md.get_element(PUNCTUM).getParent().getId()
+        self.edit("move_neume", PUNCTUM, NEXT, None, "1", "2", "3", "4")
+        delta = self.md.delta
+        self.assertEqual(1, delta["revision"])
+        self.assertEqual([{"id": PUNCTUM, "parent": layer, "before": NEXT}], delta["moved"])
+        self.assertEqual([PUNCTUM_ZONE, PUNCTUM], [e["id"] for e in delta["changed"]])
+        self.assertEqual((1.0, 2.0, 3.0, 4.0), delta["changed"][1]["box"])
+        self.undo()
+
+        neume = self.edit("neumify", [PUNCTUM, CAVUM], "clivis", None, ["punctum", "punctum"], "1", "1", "9", "9")["id"]
+        delta = self.md.delta
+        # the notes come within the new neume, and are not moved again
+        self.assertEqual([neume, self.md.get_zone(self.md.get_element(neume)).getId()],
+                         [a["element"]["id"] for a in delta["added"]])
+        self.assertEqual([PUNCTUM_NOTE, CAVUM_NOTE],
+                         [n["id"] for n in delta["added"][0]["element"]["children"][0]["children"]])
+        self.assertEqual([], delta["moved"])
+        self.assertEqual(sorted([PUNCTUM, PUNCTUM_ZONE, CAVUM, CAVUM_ZONE]), sorted(delta["removed"]))
+
+        self.undo()
+        delta = self.md.delta
+        self.assertEqual(4, delta["revision"])
+        self.assertEqual(sorted([PUNCTUM, PUNCTUM_ZONE, CAVUM, CAVUM_ZONE]),
+                         sorted(a["element"]["id"] for a in delta["added"]))
+        self.assertEqual({"parent": layer, "before": NEXT},
+                         dict((k, v) for k, v in delta["added"][0].items() if k != "element"))
+        self.assertEqual([], delta["moved"])
+        self.assertEqual(2, len(delta["removed"]))
+        self.assertTrue(neume in delta["removed"])
+
+    def testBatchArguments(self):
+        # numbers, and lists of ids, decoded like in single edits
+        calls = [check_operation(0, {"op": "move_neume", "args": {"id": PUNCTUM, "before_id": NEXT, "pitch_info": None,
+                                                                  "ulx": 1, "uly": 2, "lrx": 3.5, "lry": 4}}),
+                 check_operation(1, {"op": "delete_neume", "args": {"ids": [CAVUM]}})]
+        self.assertEqual(("delete_neume", {"ids": [CAVUM]}), calls[1])
+        apply_operations(self.md, calls)
+        self.md.commit()
+        self.assertEqual((1.0, 2.0, 3.5, 4.0), zone_box(self.md.get_zone(self.md.get_element(PUNCTUM))))
+        self.assertEqual(None, self.md.get_element(CAVUM))
+
+        for operation in ({"op": "move_neume", "args": {"id": PUNCTUM}},
+                          {"op": "delete_neume", "args": {"ids": [CAVUM], "id": CAVUM}}):
+            self.assertRaises(tornado.web.HTTPError, check_operation, 0, operation)
+
+    def testRollbackFailure(self):
+        def edit(operation, *args):
+            with modify_document("allneumes") as md:
+                getattr(md, operation)(*args)
+
+        def broken_rollback():
+            raise ValueError("rollback failed")
+
+        load_document, quiet = tornadoapi.load_document, pending_writes.quiet
+        tornadoapi.load_document = lambda file: self.md
+        pending_writes.quiet = 60
+        try:
+            edit("delete_neume", [PUNCTUM])
+            self.assertTrue(pending_writes.is_dirty(self.md.filename))
+
+            self.md.rollback = broken_rollback
+            self.assertRaises(AttributeError, edit, "delete_neume", ["m-missing"])
+        finally:
+            tornadoapi.load_document, pending_writes.quiet = load_document, quiet
+
+        # the committed edit was written rather than dropped
+        self.assertFalse(pending_writes.is_dirty(self.md.filename))
+        self.assertFalse(PUNCTUM in self.read())
+        self.assertTrue(CAVUM in self.read())
+
+    def testNeumifyUndo(self):
+        self.edit("neumify", [PUNCTUM, CAVUM], "clivis", None, ["punctum", "punctum"], "1", "1", "9", "9")
+        self.undo()
+        self.assertEqual(self.original, self.tree())
+
+        # the restored notes are found, and their changes undone
+        self.assertEqual(PUNCTUM_NOTE, self.md.get_element(PUNCTUM_NOTE).getId())
+        self.edit("move_neume", PUNCTUM, CAVUM, [{"pname": "g", "oct": "3"}], "1", "1", "9", "9")
+        self.assertEqual("g", self.md.get_element(PUNCTUM_NOTE).getAttribute("pname").getValue())
+        self.undo()
+        self.assertEqual(self.original, self.tree())
+
+    def testUngroupUndo(self):
+        neume = self.edit("neumify", [PUNCTUM, CAVUM], "clivis", None, ["punctum", "punctum"], "1", "1", "9", "9")["id"]
+        bboxes = [[{"ulx": 1, "uly": 1, "lrx": 5, "lry": 5}, {"ulx": 5, "uly": 1, "lrx": 9, "lry": 5}]]
+        self.edit("ungroup", [neume], bboxes)
+        self.undo()
+        self.assertEqual(neume, self.md.get_element(CAVUM_NOTE).getParent().getParent().getId())
+        self.undo()
+        self.assertEqual(self.original, self.tree())
+
+    def testSplitStaff(self):
+        before = self.split_staff(STAFF_5)
+        self.md.write_doc()
+        self.assertEqual([[str(n) for n in range(1, 11)]], self.staff_numbers("section", "staff"))
+        self.assertEqual([[str(n) for n in range(1, 11)]], self.staff_numbers("staffGrp", "staffDef"))
+        staves = self.md.get_elements_by_name("staff")
+        self.assertEqual(STAFF_5, staves[4].getId())
+        self.assertEqual(before, staves[5].getChildrenByName("layer")[0].getChildren()[0].getId())
+
+        division = staves[4].getChildrenByName("layer")[0].getChildren()[-1]
+        self.edit("delete_division", [division.getId()])
+        self.md.write_doc()
+        self.assertEqual([[str(n) for n in range(1, 10)]], self.staff_numbers("section", "staff"))
+        self.assertEqual([[str(n) for n in range(1, 10)]], self.staff_numbers("staffGrp", "staffDef"))
+
+    def testSplitStaffInSecondSection(self):
+        fp = open(DATA)
+        mei = fp.read()
+        fp.close()
+        # staves 4 to 9 in a section of their own, numbered from 1
+        start = mei.index('<staff xml:id="%s"' % STAFF_4)
+        numbers = iter(range(1, 7))
+        second = re.sub(r'(<staff [^>]*n=")\d+"', lambda m: '%s%d"' % (m.group(1), next(numbers)), mei[start:])
+        self.load(mei[:start] + '</section><section xml:id="m-section-2">' + second)
+
+        sections = self.md.get_elements_by_name("section")
+        first = self.md.section_staves(sections[0])
+        self.split_staff(STAFF_5)
+        self.md.write_doc()
+
+        self.assertEqual([["1", "2", "3"], ["1", "2", "3", "4", "5", "6", "7"]], self.staff_numbers("section", "staff"))
+        self.assertEqual(STAFF_5, sections[1].getChildrenByName("staff")[1].getId())
+        # the staves of the other section were not looked at again
+        self.assertTrue(self.md.section_staves(sections[0]) is first)
+        # the staff definitions only match the staves of a single section
+        self.assertEqual([[str(n) for n in range(1, 10)]], self.staff_numbers("staffGrp", "staffDef"))
+
+        self.undo()
+        self.md.write_doc()
+        self.assertEqual(self.original, self.tree())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+#!/usr/bin/python
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from pymei import XmlExport
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from neonsrv import parsecache
+
+DATA = os.path.join(os.path.dirname(__file__), "data", "allneumes.mei")
+
+class ParseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "allneumes.mei")
+        shutil.copy(DATA, self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, doc):
+        out = os.path.join(self.dir, "out.mei")
+        XmlExport.write(doc, out)
+        fp = open(out, "rb")
+        contents = fp.read()
+        fp.close()
+        return contents
+
+    def testWritesAlike(self):
+        direct = self.write(parsecache.read(self.path))
+        self.assertTrue(os.path.exists(parsecache.cache_path(self.path)))
+
+        # from the cache
+        self.assertEqual(direct, self.write(parsecache.read(self.path)))
+        self.assertEqual([".allneumes.mei.parsed", "allneumes.mei", "out.mei"], sorted(os.listdir(self.dir)))
+
+    def testNotCachedIfWrittenDifferently(self):
+        # as if the cache left out something the file relies on
+        build_element = parsecache.build_element
+        def lossy(snapshot):
+            element = build_element(snapshot)
+            element.setAttributes([])
+            return element
+
+        parsecache.build_element = lossy
+        try:
+            parsecache.read(self.path)
+        finally:
+            parsecache.build_element = build_element
+        self.assertFalse(os.path.exists(parsecache.cache_path(self.path)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,33 @@
+#!/usr/bin/python
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from neonsrv.pitch import staff_positions, pitches_at, reclef
+
+class PitchTest(unittest.TestCase):
+
+    def testClefReference(self):
+        self.assertEqual([2, -2], staff_positions([("c", 4), ("f", 3)], "C", 1))
+        self.assertEqual([8], staff_positions([("f", 3)], "F", 4))
+        self.assertEqual([("c", 4)], pitches_at([2], "C", 1))
+        self.assertEqual([("f", 3)], pitches_at([6], "f", 3))
+
+    def testOctaveChangesAtC(self):
+        self.assertEqual([("b", 3), ("c", 4), ("d", 4)], pitches_at([5, 6, 7], "c", 3))
+
+    def testRoundTrip(self):
+        pitches = [("g", 3), ("a", 3), ("b", 3), ("c", 4), ("e", 4)]
+        self.assertEqual(pitches, pitches_at(staff_positions(pitches, "f", 2), "f", 2))
+
+    def testMoveClefUp(self):
+        # moving the clef up a line lowers every note by a third
+        self.assertEqual([("a", 3), ("b", 3)], reclef([("c", 4), ("d", 4)], ("c", 2), ("c", 3)))
+
+    def testChangeShape(self):
+        # same line, f clef instead of c clef: a fifth lower
+        self.assertEqual([("f", 3), ("c", 3)], reclef([("c", 4), ("g", 3)], ("c", 3), ("f", 3)))
+
+if __name__ == "__main__":
+    unittest.main()
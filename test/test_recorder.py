@@ -0,0 +1,60 @@
+#!/usr/bin/python
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from tornado.httputil import HTTPServerRequest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from neonsrv.recorder import Recorder
+
+class RecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, "edits.log")
+        self.recorder = Recorder(self.log, "/neon/edit/")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def entries(self):
+        self.recorder.fp.close()
+        fp = open(self.log)
+        entries = [json.loads(line) for line in fp]
+        fp.close()
+        return entries
+
+    def testRecord(self):
+        insert = HTTPServerRequest("POST", "/neon/edit/squarenote/page/insert/neume", body="pname=c&oct=4")
+        region = HTTPServerRequest("GET", "/neon/edit/squarenote/page/region?ulx=0&uly=0&lrx=9&lry=9")
+        self.assertTrue(self.recorder.recording(insert))
+        self.assertFalse(self.recorder.recording(HTTPServerRequest("GET", "/neon/file/squarenote/page.mei")))
+
+        self.recorder.record(insert, 200, json.dumps({"revision": 3, "delta": {"added": []}, "id": "m-1"}))
+        self.recorder.record(region, 200, json.dumps({"elements": []}))
+
+        entries = self.entries()
+        self.assertEqual(["POST", "squarenote/page", "insert/neume", "pname=c&oct=4", 200, {"id": "m-1"}], entries[0][1:])
+        self.assertEqual(["GET", "squarenote/page", "region?ulx=0&uly=0&lrx=9&lry=9", "", 200, None], entries[1][1:])
+
+    def testDocumentWithoutType(self):
+        # as sent by the editors whose api prefix is edit/<page>
+        shape = HTTPServerRequest("POST", "/neon/edit/page/update/neume/headshape", body="id=m-1&shape=punctum")
+        undo = HTTPServerRequest("POST", "/neon/edit/page/undo", body="")
+        unknown = HTTPServerRequest("POST", "/neon/edit/page/neume/insert", body="")
+
+        self.recorder.record(shape, 200, json.dumps({"revision": 4, "delta": {}}))
+        self.recorder.record(undo, 200, json.dumps({"revision": 5, "delta": {}}))
+        self.recorder.record(unknown, 404, "")
+
+        entries = self.entries()
+        self.assertEqual(2, len(entries))
+        self.assertEqual(["page", "update/neume/headshape"], entries[0][2:4])
+        self.assertEqual(["page", "undo"], entries[1][2:4])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+#!/usr/bin/python
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from neonsrv.spatial import GridIndex
+
+class GridIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = GridIndex(cell_size=100)
+        self.index.insert("a", (10, 10, 50, 50))
+        self.index.insert("b", (90, 90, 260, 120))
+        self.index.insert("c", (500, 500, 520, 520))
+
+    def testOverlap(self):
+        self.assertEqual(["a", "b"], sorted(self.index.query((40, 40, 95, 95))))
+        self.assertEqual(["b"], self.index.query((250, 100, 300, 300)))
+        self.assertEqual([], self.index.query((300, 300, 400, 400)))
+
+    def testInside(self):
+        self.assertEqual(["a"], self.index.query((0, 0, 200, 200), inside=True))
+
+    def testMoveAndRemove(self):
+        self.index.insert("a", (510, 510, 530, 530))
+        self.assertEqual([], self.index.query((0, 0, 60, 60)))
+        self.assertEqual(["a", "c"], sorted(self.index.query((505, 505, 515, 515))))
+
+        self.index.remove("c")
+        self.index.remove("c")
+        self.assertEqual(["a"], self.index.query((505, 505, 515, 515)))
+        self.assertEqual(2, len(self.index))
+
+    def testHugeCoordinates(self):
+        # neither is enumerated cell by cell
+        self.index.insert("d", (0, 0, 1e15, 1e15))
+        self.assertEqual(["a", "b", "c", "d"], sorted(self.index.query((-1e15, -1e15, 1e15, 1e15))))
+        self.assertEqual(["c", "d"], sorted(self.index.query((505, 505, 1e15, 1e15))))
+        self.assertEqual(["d"], self.index.query((1e12, 1e12, 1e12 + 1, 1e12 + 1)))
+        self.assertEqual(["a", "b", "c"], sorted(self.index.query((-1e15, -1e15, 1e14, 1e14), inside=True)))
+
+        self.index.remove("d")
+        self.assertEqual([], self.index.query((1e12, 1e12, 1e12 + 1, 1e12 + 1)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from neonsrv.undo import UndoStore, undo_directory
+
+class UndoStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "squarenote", "doc")
+        self.store = UndoStore(self.path, capacity=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testUndoDirectory(self):
+        self.assertEqual("/mei/undo/squarenote/page", undo_directory("/mei/squarenote/page.mei"))
+
+    def testPopEmpty(self):
+        self.assertEqual(None, self.store.pop())
+        self.store.reset()
+        self.assertEqual(None, self.store.pop())
+
+    def testPushPop(self):
+        self.store.push([["attr", "m-1", "pname", "c"]])
+        self.store.push([["add", "m-2", "m-3"]])
+        self.assertEqual(2, len(self.store))
+        self.assertEqual([["add", "m-2", "m-3"]], self.store.pop())
+        self.assertEqual([["attr", "m-1", "pname", "c"]], self.store.pop())
+        self.assertEqual(None, self.store.pop())
+
+    def testRotation(self):
+        for i in range(7):
+            self.store.push([["add", "m-0", "m-%d" % i]])
+
+        # only the newest entries are kept, in a fixed number of slots
+        self.assertEqual(3, len(self.store))
+        self.store.flush()
+        self.assertEqual(3, len([f for f in os.listdir(self.path) if f != "index.json"]))
+        self.assertEqual("m-6", self.store.pop()[0][2])
+        self.assertEqual("m-5", self.store.pop()[0][2])
+        self.assertEqual("m-4", self.store.pop()[0][2])
+        self.assertEqual(None, self.store.pop())
+
+    def testReset(self):
+        self.store.push([["add", "m-0", "m-1"]])
+        self.store.reset()
+        self.assertEqual(0, len(self.store))
+        self.store.push([["add", "m-0", "m-2"]])
+        self.assertEqual("m-2", self.store.pop()[0][2])
+
+    def testReopen(self):
+        for i in range(4):
+            self.store.push([["add", "m-0", "m-%d" % i]])
+        self.store.flush()
+        reopened = UndoStore(self.path, capacity=3)
+        self.assertEqual(3, len(reopened))
+        self.assertEqual("m-3", reopened.pop()[0][2])
+
+    def testRevision(self):
+        self.store.push([["add", "m-0", "m-1"]])
+        self.store.push([["add", "m-0", "m-2"]])
+        self.store.pop()
+        self.store.reset()
+        self.store.bump()
+        self.assertEqual(4, self.store.revision())
+        self.store.flush()
+        self.assertEqual(4, UndoStore(self.path, capacity=5).revision())
+
+    def testFlush(self):
+        document = os.path.join(self.dir, "squarenote", "doc.mei")
+        self.write_document(document, "<mei/>")
+        store = UndoStore(self.path, capacity=3, document=document)
+        store.push([["add", "m-0", "m-1"]])
+        store.flush()
+
+        # nothing reaches the disk before the document was written
+        store.push([["add", "m-0", "m-2"]])
+        self.assertEqual(1, len(UndoStore(self.path, capacity=3, document=document)))
+
+        # a document written without its history drops the history
+        self.write_document(document, "<mei><music/></mei>")
+        reopened = UndoStore(self.path, capacity=3, document=document)
+        self.assertEqual(0, len(reopened))
+        self.assertEqual(2, reopened.revision())
+
+    def write_document(self, path, contents):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        fp = open(path, "w")
+        fp.write(contents)
+        fp.close()
+
+    def testOtherDocumentsUntouched(self):
+        other = UndoStore(os.path.join(self.dir, "squarenote", "other"), capacity=3)
+        other.push([["add", "m-0", "m-1"]])
+        self.store.push([["add", "m-0", "m-2"]])
+        self.store.reset()
+        self.assertEqual(1, len(other))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from neonsrv.upload import MultipartSpool
+
+BODY = ("--xyz\r\n"
+        'Content-Disposition: form-data; name="mei"; filename="page.mei"\r\n'
+        "Content-Type: text/xml\r\n"
+        "\r\n"
+        "<mei>\r\n--xy</mei>\r\n"
+        "--xyz\r\n"
+        'Content-Disposition: form-data; name="mei_img"; filename=""\r\n'
+        "\r\n"
+        "\r\n"
+        "--xyz\r\n"
+        'Content-Disposition: form-data; name="submit"\r\n'
+        "\r\n"
+        "Upload\r\n"
+        "--xyz--\r\n")
+
+class MultipartSpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def parse(self, chunk_size):
+        spool = MultipartSpool("xyz", self.dir)
+        for i in range(0, len(BODY), chunk_size):
+            spool.feed(BODY[i:i + chunk_size])
+        return spool.close()
+
+    def testChunks(self):
+        for chunk_size in (1, 3, 7, len(BODY)):
+            files, fields = self.parse(chunk_size)
+            self.assertEqual(["mei"], files.keys())
+            self.assertEqual("page.mei", files["mei"][0]["filename"])
+
+            fp = open(files["mei"][0]["path"])
+            self.assertEqual("<mei>\r\n--xy</mei>", fp.read())
+            fp.close()
+            self.assertEqual({"mei_img": "", "submit": "Upload"}, fields)
+
+    def testIncomplete(self):
+        spool = MultipartSpool("xyz", self.dir)
+        spool.feed(BODY[:120])
+        self.assertRaises(Exception, spool.close)
+        self.assertEqual([], os.listdir(self.dir))
+
+    def testDiscardAfterClose(self):
+        # as when the client goes away while the upload is stored
+        spool = MultipartSpool("xyz", self.dir)
+        spool.feed(BODY)
+        files, fields = spool.close()
+        spool.discard()
+        self.assertTrue(os.path.exists(files["mei"][0]["path"]))
+
+if __name__ == "__main__":
+    unittest.main()
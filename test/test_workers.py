@@ -0,0 +1,63 @@
+#!/usr/bin/python
+import os
+import sys
+import threading
+import unittest
+
+import tornado.web
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from neonsrv.workers import Workers
+
+class WorkersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workers = Workers(1, 2)
+
+    def tearDown(self):
+        self.workers.shutdown()
+
+    def testResult(self):
+        future = self.workers.submit_document("/mei/squarenote/page.mei", lambda x: x * 2, 21)
+        self.assertEqual(42, future.result())
+
+    def testDocumentOrder(self):
+        workers = Workers(4, 64)
+        order = []
+        futures = [workers.submit_document("/mei/a.mei", order.append, i) for i in range(20)]
+        for future in futures:
+            future.result()
+        workers.shutdown()
+
+        self.assertEqual(range(20), order)
+        # the queue went once the document was idle
+        self.assertEqual({}, workers.stats()["documents"])
+
+    def testDocumentsInParallel(self):
+        workers = Workers(2, 64)
+        release = threading.Event()
+        blocked = workers.submit_document("/mei/a.mei", release.wait, 5)
+        workers.submit_document("/mei/a.mei", lambda: None)
+        # b runs while a is still busy
+        self.assertEqual("b", workers.submit_document("/mei/b.mei", lambda: "b").result(5))
+        self.assertFalse(blocked.done())
+        self.assertEqual(1, workers.stats()["documents"]["/mei/a.mei"]["depth"])
+        release.set()
+        self.assertTrue(blocked.result(5))
+        workers.shutdown()
+
+    def testRefuseWhenFull(self):
+        release = threading.Event()
+        futures = [self.workers.submit(release.wait) for i in range(2)]
+
+        with self.assertRaises(tornado.web.HTTPError) as cm:
+            self.workers.submit(release.wait)
+        self.assertEqual(503, cm.exception.status_code)
+        self.assertEqual(1, self.workers.stats()["rejected"])
+
+        release.set()
+        for future in futures:
+            future.result()
+
+if __name__ == "__main__":
+    unittest.main()